@@ -0,0 +1,39 @@
+"""
+Runs a prosumer without Django.
+
+    python -m prosumer run prosumer.yaml
+"""
+
+import argparse
+from threading import Event
+
+
+def run(config_path: str) -> None:
+    # Imported here so that `--help` does not pay for the simulation imports.
+    # pylint: disable=import-outside-toplevel
+    from virtual_prosumer.config_loader import load_config
+
+    from prosumer.runtime import ProsumerRuntime
+
+    config = load_config(config_path)
+    runtime = ProsumerRuntime(config)
+    runtime.start()
+    print(f"Running prosumer {config['settings']['vpAddress']}", flush=True)
+    try:
+        Event().wait()
+    except KeyboardInterrupt:
+        runtime.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m prosumer")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Runs the prosumer of a config.")
+    run_parser.add_argument("config", nargs="?", default="prosumer.yaml")
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import os
+from bisect import bisect_right
+from collections import deque
+from typing import Callable, Optional
+
+from prosumer.mqtt import SNAPSHOT_SERIALIZERS
+from prosumer.recorder import RECORDED_STATES
+
+# Entities whose subsystems are also served on their own, by id.
+SUBSYSTEM_ENTITIES = ("generations", "consumptions", "storages")
+
+HISTORY_COLUMNS = ("timestamp", *RECORDED_STATES)
+
+serialize = SNAPSHOT_SERIALIZERS["json"]()
+
+
+class StateSnapshot:
+    """
+    The states of one tick, serialized to JSON once and shared by every
+    request until the next tick replaces it.
+
+    `subsystems` holds the states of each reported subsystem by entity and id,
+    which are serialized on their first request into `subsystem_bodies`, a
+    cache shared by the snapshots of every tick. `history` holds the aggregate
+    states of the ticks up to this one.
+    """
+
+    __slots__ = (
+        "version",
+        "etag",
+        "body",
+        "subsystems",
+        "subsystem_bodies",
+        "history",
+        "_windows",
+    )
+
+    def __init__(
+        self,
+        version: int,
+        etag: str,
+        body: bytes,
+        subsystems: dict[str, dict[str, dict]],
+        subsystem_bodies: dict[tuple[str, str], tuple[dict, str, bytes]],
+        history: deque,
+    ) -> None:
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self.subsystems = subsystems
+        self.subsystem_bodies = subsystem_bodies
+        self.history = history
+        # Bodies of the history windows requested during this tick, by rows.
+        self._windows: dict[int, bytes] = {}
+
+    def subsystem(self, entity: str, id_: str) -> Optional[tuple[str, bytes]]:
+        """
+        Returns the `(etag, body)` of the states of a subsystem, if reported.
+        Subsystems whose states didn't change since the last tick keep the
+        same states object, so their body and ETag are reused.
+        """
+        states = self.subsystems.get(entity, {}).get(id_)
+        if states is None:
+            return None
+        cached = self.subsystem_bodies.get((entity, id_))
+        if cached is None or cached[0] is not states:
+            etag = f'{self.etag[:-1]}-{entity}-{id_}"'
+            cached = (states, etag, serialize(states))
+            self.subsystem_bodies[(entity, id_)] = cached
+        return cached[1], cached[2]
+
+    def history_window(self, seconds: Optional[float] = None) -> tuple[str, bytes]:
+        """
+        Returns the `(etag, body)` of the aggregate states recorded over the
+        last `seconds`, or all of those kept, as one JSON list per column.
+        """
+        # Copied in one call, which a tick appending a row can't interleave.
+        rows = tuple(self.history)
+        # The rows may already include ticks after this snapshot.
+        rows = rows[: len(rows) - max(0, rows[-1][0] - self.version)] if rows else ()
+        start = 0
+        if seconds is not None and rows:
+            timestamps = [row[1] for row in rows]
+            start = bisect_right(timestamps, timestamps[-1] - seconds)
+        count = len(rows) - start
+        body = self._windows.get(count)
+        if body is None:
+            columns = [
+                [row[i] for row in rows[start:]]
+                for i in range(1, len(rows[0]) if rows else 0)
+            ]
+            body = serialize(
+                dict(zip(HISTORY_COLUMNS, columns))
+                or {name: [] for name in HISTORY_COLUMNS}
+            )
+            self._windows[count] = body
+        return f'{self.etag[:-1]}-{count}"', body
+
+    @property
+    def text(self) -> str:
+        return self.body.decode()
+
+
+class SnapshotCache:
+    """
+    Serializes the states of every tick once, into a `StateSnapshot` that the
+    HTTP views and WebSocket streams serve without touching the simulation.
+
+    Wraps the `set_states` of an `InterconnectedSubsystem`, forwarding the
+    states to `forward` after caching them. The aggregate states of the last
+    `history` ticks are kept for `/api/history`.
+    """
+
+    def __init__(self, forward: Optional[Callable] = None, history: int = 900) -> None:
+        self.forward = forward
+        self.snapshot: Optional[StateSnapshot] = None
+        self.version = 0
+        # ETags of a restarted process must not match those of the last one.
+        self._etag_prefix = os.urandom(4).hex()
+        # (version, timestamp, *RECORDED_STATES) of the last `history` ticks.
+        self.history: deque = deque(maxlen=history)
+        self._subsystem_bodies: dict[tuple[str, str], tuple[dict, str, bytes]] = {}
+        # Future resolved on the next tick, per event loop streaming states.
+        self._next_ticks: dict[asyncio.AbstractEventLoop, asyncio.Future] = {}
+
+    def __call__(self, states: dict[str, any]) -> None:
+        self.version += 1
+        # The states of each entity are updated in place by the next tick,
+        # unlike those of its subsystems, which are replaced when changed.
+        subsystems = {
+            entity: dict(states[entity])
+            for entity in SUBSYSTEM_ENTITIES
+            if isinstance(states.get(entity), dict)
+        }
+        self.history.append(
+            (
+                self.version,
+                states["last_updated_at"].timestamp(),
+                *(states[state] for state in RECORDED_STATES),
+            )
+        )
+        self.snapshot = StateSnapshot(
+            self.version,
+            f'"{self._etag_prefix}-{self.version}"',
+            serialize(states),
+            subsystems,
+            self._subsystem_bodies,
+            self.history,
+        )
+        for loop in list(self._next_ticks):
+            try:
+                loop.call_soon_threadsafe(self._resolve_next_tick, loop)
+            except RuntimeError:  # Closed
+                self._next_ticks.pop(loop, None)
+        if self.forward is not None:
+            self.forward(states)
+
+    def _resolve_next_tick(self, loop: asyncio.AbstractEventLoop) -> None:
+        future = self._next_ticks.pop(loop, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def next_tick(self) -> asyncio.Future:
+        """
+        Returns a future of the running event loop, resolved on the next tick.
+        Every stream of a loop shares it, so a tick wakes each loop only once.
+        """
+        loop = asyncio.get_running_loop()
+        future = self._next_ticks.get(loop)
+        if future is None or future.done():
+            future = self._next_ticks[loop] = loop.create_future()
+        return future
+
+
+# The cache of the prosumer run by this process, if it serves the API.
+SNAPSHOTS: Optional[SnapshotCache] = None
+
+
+async def _until_disconnected(receive: Callable) -> None:
+    while (await receive())["type"] != "websocket.disconnect":
+        pass
+
+
+async def stream(_scope: dict, receive: Callable, send: Callable) -> None:
+    """
+    ASGI application streaming the snapshot of every tick over a WebSocket,
+    as JSON text messages. Ticks missed by a slow client are skipped.
+    """
+    if (await receive())["type"] != "websocket.connect":
+        return
+    if SNAPSHOTS is None:
+        await send({"type": "websocket.close", "code": 1013})
+        return
+    await send({"type": "websocket.accept"})
+    disconnected = asyncio.ensure_future(_until_disconnected(receive))
+    version = None
+    try:
+        while not disconnected.done():
+            snapshot = SNAPSHOTS.snapshot
+            if snapshot is not None and snapshot.version != version:
+                version = snapshot.version
+                await send({"type": "websocket.send", "text": snapshot.text})
+            await asyncio.wait(
+                (disconnected, SNAPSHOTS.next_tick()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+    finally:
+        disconnected.cancel()
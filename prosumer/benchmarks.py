@@ -0,0 +1,624 @@
+"""
+Benchmarks of the per-tick hot path.
+
+    python -m prosumer.benchmarks [name ...]
+    python -m prosumer.benchmarks --save-baseline
+    python -m prosumer.benchmarks --check
+
+Every benchmark reports metrics where lower is better: CPU seconds, except
+for `startup` and `sharded_fleet`, which report wall time as they span
+processes, and those suffixed `.publishes` (per prosumer tick) and
+`.rss_mib`. Each benchmark is run `--runs` times, keeping the least of each
+metric, as the noise of a single run exceeds most regressions worth catching.
+
+`--check` exits with an error when a metric regressed by more than
+`--tolerance` from the baseline. Baselines are machine specific, so they're
+not committed: save one on the machine that checks against it, e.g. a CI
+runner saving one from the main branch and checking branches against it.
+`--save-baseline` merges the metrics of the named benchmarks into the
+baseline, or replaces it when all of them are run.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+from array import array
+from datetime import datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter, process_time
+from typing import Callable
+
+import yaml
+from utils.clock import SimulationClock
+from utils.rolling import BucketedAverages, RollingAverages
+from utils.scheduler import ScheduledJob
+from virtual_prosumer.config_loader import load_configs
+
+from prosumer.api import SnapshotCache, serialize
+from prosumer.checkpoint import Checkpointer
+from prosumer.ensemble import run_ensemble
+from prosumer.factory import build_prosumer, subsystems_of
+from prosumer.host import ProsumerHost
+from prosumer.mqtt import ProsumerPublisher
+from prosumer.profiles import ProfileEngine
+from prosumer.sharding import ShardedFleet
+from prosumer.storage import StorageFleet
+from prosumer.subsystems import Consumption, Generation, SubsystemBase
+from prosumer.tariffs import TariffTable
+from prosumer.testing import sample_config
+from prosumer.transport import CONNACK, encode_packet
+
+BASELINE_PATH = Path(__file__).with_name("benchmarks_baseline.json")
+
+BENCHMARKS: dict[str, Callable[[], dict[str, float]]] = {}
+
+
+def benchmark(function: Callable) -> Callable:
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+class FakeMqttClient:
+    "Stand-in for `paho.mqtt.client.Client` that only counts publishes."
+
+    def __init__(self) -> None:
+        self.published = 0
+
+    def publish(self, topic: str, payload: str, retain: bool = False, qos: int = 0):
+        self.published += 1
+
+
+def build_fleet(size: int, client: FakeMqttClient, **publishing) -> list:
+    fleet = []
+    for i in range(size):
+        config = sample_config(f"::{i:x}")
+        vp_address = config["settings"]["vpAddress"]
+        publisher = ProsumerPublisher(client, vp_address, **publishing)
+        prosumer = build_prosumer(config, publisher.publish_states, auto_start=False)
+        fleet.append(subsystems_of(prosumer))
+    return fleet
+
+
+class FakeMqttClientPool:
+    "Stand-in for `MqttClientPool` whose publishers share one fake client."
+
+    def __init__(self, client: FakeMqttClient) -> None:
+        self.client = client
+
+    def publisher_for(self, vp_address: str, publishing=None) -> ProsumerPublisher:
+        return ProsumerPublisher(self.client, vp_address, **(publishing or {}))
+
+
+class IdleScheduler:
+    "Stand-in for `TickScheduler` that never runs the jobs it's given."
+
+    def schedule(self, function: Callable, interval: float, priority: int = 0):
+        return ScheduledJob(function, interval, priority)
+
+
+def host_ticker(size: int, client: FakeMqttClient) -> Callable:
+    """
+    Returns a function running one tick of a `ProsumerHost` of `size`
+    prosumers, a second of simulated time after the last.
+    """
+    clock = SimulationClock(datetime(2024, 6, 1, 12))
+    configs = [sample_config(f"::{i:x}") for i in range(size)]
+    host = ProsumerHost(configs, FakeMqttClientPool(client), IdleScheduler(), clock)
+    host.start()
+    client.published = 0
+
+    def tick():
+        clock.advance(SubsystemBase.run_interval)
+        host.tick()
+
+    return tick
+
+
+def fleet_ticker(fleet: list) -> Callable:
+    def tick():
+        for subsystems in fleet:
+            for subsystem in subsystems:
+                subsystem.run()
+
+    return tick
+
+
+def timed(function: Callable, repeat: int) -> float:
+    """
+    Returns the mean CPU time in seconds of `function` over `repeat` runs.
+    """
+    started_at = process_time()
+    for _ in range(repeat):
+        function()
+    return (process_time() - started_at) / repeat
+
+
+@benchmark
+def rolling_averages(pushes: int = 20000) -> dict[str, float]:
+    "One moving average push per window, and one tick of the configured ones."
+    results = {}
+    for minutes in (1, 5, 15, 30, 60):
+        window = RollingAverages({f"{minutes}m": minutes * 60})
+        results[f"rolling_averages[{minutes}m]"] = timed(
+            lambda: window.push(1.0), pushes
+        )
+    bucketed = BucketedAverages({"24h": 86400})
+    results["rolling_averages[24h].bucketed"] = timed(
+        lambda: bucketed.push(1.0), pushes
+    )
+    subsystem = Consumption(
+        id=1,
+        peak_demand=7,
+        profile=sample_config()["consumptions"][0]["$profile"],
+        moving_avg_periods=[1, 5, 15, 30, 60],
+        auto_start=False,
+    )
+    results["update_timeseries_fields"] = timed(
+        subsystem.update_timeseries_fields, pushes
+    )
+    return results
+
+
+@benchmark
+def profile(repeat: int = 20000) -> dict[str, float]:
+    "Interpolating one profile value, and generating a profile."
+    subsystem = Consumption(
+        id=1,
+        peak_demand=7,
+        profile=sample_config()["consumptions"][0]["$profile"],
+        auto_start=False,
+    )
+    instant = datetime.now()
+    return {
+        "get_value": timed(lambda: subsystem.get_value(instant), repeat),
+        "generate_profile": timed(subsystem.generate_profile, repeat // 100),
+    }
+
+
+@benchmark
+def interconnected(repeat: int = 5000) -> dict[str, float]:
+    "Aggregating one prosumer, and building its states."
+    prosumer = build_prosumer(sample_config(), lambda states: None, auto_start=False)
+    return {
+        "interconnected.on_run": timed(prosumer.on_run, repeat),
+        "interconnected.get_states": timed(prosumer.get_states, repeat),
+    }
+
+
+@benchmark
+def aggregation(size: int = 1000, ticks: int = 200) -> dict[str, float]:
+    "Aggregating a prosumer of many generations, as more of them change."
+    config = sample_config()
+    config["generations"] = [{**config["generations"][0], "id": i} for i in range(size)]
+    prosumer = build_prosumer(config, lambda states: None, auto_start=False)
+    results = {}
+    for percent in (0, 1, 100):
+        changed = prosumer.generations[: size * percent // 100]
+        elapsed = 0.0
+        for _ in range(ticks):
+            for generation in changed:
+                generation.on_change(generation)
+            started_at = process_time()
+            prosumer.on_run()
+            elapsed += process_time() - started_at
+        results[f"aggregation[{size}, {percent}% changed]"] = elapsed / ticks
+    return results
+
+
+@benchmark
+def mqtt_set_states(repeat: int = 2000) -> dict[str, float]:
+    "Publishing the states of one prosumer tick, changed and unchanged."
+    states = {}
+    prosumer = build_prosumer(sample_config(), states.update, auto_start=False)
+    prosumer.run()
+    publisher = ProsumerPublisher(FakeMqttClient(), "::1")
+
+    def changed():
+        publisher.invalidate()
+        publisher.set_states(states)
+
+    return {
+        "mqtt_set_states.changed": timed(changed, repeat),
+        "mqtt_set_states.unchanged": timed(
+            lambda: publisher.set_states(states), repeat
+        ),
+    }
+
+
+@benchmark
+def publish_plan(repeat: int = 2000) -> dict[str, float]:
+    "Publishing the states of one prosumer tick, recursively vs planned."
+    states = {}
+    prosumer = build_prosumer(sample_config(), states.update, auto_start=False)
+    prosumer.run()
+    publisher = ProsumerPublisher(FakeMqttClient(), "::1")
+    results = {}
+    for name, publish in (
+        ("recursive", publisher.set_states),
+        ("planned", publisher.publish_topics),
+    ):
+
+        def changed():
+            publisher.invalidate()
+            publish(states)
+
+        results[f"publish_plan.{name}.changed"] = timed(changed, repeat)
+        results[f"publish_plan.{name}.unchanged"] = timed(
+            lambda: publish(states), repeat
+        )
+    return results
+
+
+@benchmark
+def fleet_tick(sizes=(1, 10, 100, 1000, 10000), ticks: int = 5) -> dict[str, float]:
+    "One tick of a whole `ProsumerHost`, as its fleet grows."
+    results = {}
+    for size in sizes:
+        client = FakeMqttClient()
+        per_tick = timed(host_ticker(size, client), ticks)
+        results[f"fleet_tick[{size}]"] = per_tick
+        results[f"fleet_tick[{size}].publishes"] = client.published / ticks / size
+    return results
+
+
+@benchmark
+def sharded_fleet(size: int = 2000, ticks: int = 10) -> dict[str, float]:
+    "Wall time of a fleet tick, as the fleet is sharded across more processes."
+    configs = [sample_config(f"::{i:x}") for i in range(size)]
+    results = {}
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        fleet = ShardedFleet(configs, workers, tick_timeout=60)
+        fleet.start()
+        try:
+            instant = datetime(2024, 6, 1, 12)
+            fleet.tick(instant)
+            started_at = perf_counter()
+            for tick in range(1, ticks + 1):
+                fleet.tick(instant + timedelta(seconds=tick))
+            per_tick = (perf_counter() - started_at) / ticks
+        finally:
+            fleet.stop()
+        results[f"sharded_fleet[{size}, {workers} workers]"] = per_tick
+    return results
+
+
+@benchmark
+def ensemble(members: int = 100) -> dict[str, float]:
+    "An ensemble of randomized profiles, without and with storage dispatch."
+    start, results = datetime(2024, 6, 1), {}
+    for name, config, span in (
+        ("7d].profiles", dict(sample_config(), storages=[]), timedelta(days=7)),
+        ("1h].storage", sample_config(), timedelta(hours=1)),
+    ):
+        started_at = process_time()
+        run_ensemble(config, members, start, start + span)
+        results[f"ensemble[{members} x {name}"] = process_time() - started_at
+    return results
+
+
+@benchmark
+def idle_skipping(days: int = 1) -> dict[str, float]:
+    "Ticks of a PV generation over a simulated day, always vs skipping the night."
+    # Zero from 19:00 until 07:00, like the PV generation of prosumer.yaml.
+    daylight = [0.0] * 14 + [0.5] * 24 + [0.0] * 10
+    profile = {"source": "range_30m", "r0": daylight, "r1": daylight}
+    results = {}
+    for name, skipping in (("always", False), ("skipping", True)):
+        start = datetime(2024, 6, 1)
+        clock = SimulationClock(start)
+        generation = Generation(
+            id=3,
+            installed_capacity=10.2,
+            export_price=5,
+            profile=profile,
+            moving_avg_periods=[1, 5, 15, 30, 60],
+            idle_skipping=skipping,
+            clock=clock,
+            auto_start=False,
+        )
+        started_at = process_time()
+        for _ in range(days * 86400):
+            clock.advance(1)
+            generation.run()
+        results[f"idle_skipping[{days}d].{name}"] = process_time() - started_at
+    return results
+
+
+@benchmark
+def checkpoint(repeat: int = 50) -> dict[str, float]:
+    "Saving the state of a prosumer, and restoring it into a new one."
+    config = dict(sample_config(), moving_avg_periods=[1, 5, 15, 30, 60, 1440])
+    prosumer = build_prosumer(config, lambda states: None, auto_start=False)
+    fleet_ticker([subsystems_of(prosumer)])()
+    results = {}
+    with TemporaryDirectory() as directory:
+        checkpointer = Checkpointer(prosumer, Path(directory) / "prosumer.ckpt")
+        results["checkpoint.save"] = timed(checkpointer.save, repeat)
+        restored = build_prosumer(config, lambda states: None, auto_start=False)
+        restorer = Checkpointer(restored, checkpointer.path)
+        results["checkpoint.restore"] = timed(restorer.restore, repeat)
+    return results
+
+
+@benchmark
+def snapshot_cache(size: int = 100, repeat: int = 2000) -> dict[str, float]:
+    "Caching the states of a tick for the API, vs serializing them whole."
+    config = sample_config()
+    config["generations"] = [dict(config["generations"][0], id=i) for i in range(size)]
+    states = []
+    prosumer = build_prosumer(config, states.append, auto_start=False)
+    fleet_ticker([subsystems_of(prosumer)])()
+    cache = SnapshotCache()
+    # Only the prosumer runs, so its generations keep their states.
+    return {
+        f"snapshot_cache[{size}].cached": timed(lambda: cache(states[-1]), repeat),
+        f"snapshot_cache[{size}].serialized": timed(
+            lambda: serialize(states[-1]), repeat
+        ),
+    }
+
+
+@benchmark
+def tariffs(size: int = 1000, ticks: int = 20) -> dict[str, float]:
+    "Weighted export prices of a fleet per tick, summed vs looked up, and updates."
+    config = sample_config()
+    # Half hourly prices of a day for generation, hourly ones of a week for storage.
+    config["generations"][0]["export_price"] = {
+        "source": "time_of_use",
+        "prices": [3 + i % 12 for i in range(48)],
+    }
+    config["storages"][0]["export_price"] = {
+        "source": "time_of_use",
+        "interval": 3600,
+        "prices": [8 + i % 24 / 4 for i in range(168)],
+    }
+    instant = datetime(2024, 6, 1, 12)
+    table = TariffTable(instant)
+    prosumers = [
+        build_prosumer(
+            config, lambda states: None, tariff_table=table, auto_start=False
+        )
+        for _ in range(size)
+    ]
+
+    def summed():
+        for prosumer in prosumers:
+            _ = prosumer.generations_weighted_unit_export_price
+
+    storage = prosumers[0].storages[0]
+    return {
+        f"tariffs[{size}].summed": timed(summed, ticks),
+        f"tariffs[{size}].looked_up": timed(lambda: table.step(instant), ticks),
+        "tariffs.update[1 slot]": timed(
+            lambda: storage.update_export_prices([9.5], 30), ticks * 50
+        ),
+        "tariffs.update[168 slots]": timed(
+            lambda: storage.update_export_prices(storage.export_prices), ticks
+        ),
+    }
+
+
+@benchmark
+def config_loading(size: int = 1000) -> dict[str, float]:
+    "Loading a fleet of prosumer configs, parsed vs from the compiled cache."
+    results = {}
+    with TemporaryDirectory() as directory:
+        fleet, cache_dir = Path(directory) / "fleet", Path(directory) / "cache"
+        fleet.mkdir()
+        for i in range(size):
+            config = sample_config(f"::{i:x}")
+            config["settings"].update(server="${PROSUMER_MQTT_SERVER}", mqttPort=1883)
+            with open(fleet / f"{i}.yaml", "w", encoding="utf-8") as file:
+                yaml.safe_dump(config, file)
+        os.environ.setdefault("PROSUMER_MQTT_SERVER", "127.0.0.1")
+        for name, cache in (("parsed", None), ("compiled", cache_dir)):
+            started_at = process_time()
+            load_configs([fleet], cache)
+            results[f"config_loading[{size}].{name}"] = process_time() - started_at
+        started_at = process_time()
+        load_configs([fleet], cache_dir)
+        results[f"config_loading[{size}].cached"] = process_time() - started_at
+    return results
+
+
+@benchmark
+def profile_engine(sizes=(100, 10000), ticks: int = 20) -> dict[str, float]:
+    "Computing every profile once, per subsystem vs batched."
+    results = {}
+    for size in sizes:
+        engine = ProfileEngine()
+        profile_config = sample_config()["consumptions"][0]["$profile"]
+        subsystems = [
+            Consumption(
+                id=i,
+                peak_demand=7,
+                profile=profile_config,
+                profile_engine=engine,
+                auto_start=False,
+            )
+            for i in range(size)
+        ]
+        instant = datetime.now()
+        results[f"profile_engine[{size}].scalar"] = timed(
+            lambda: [s.get_value(instant) for s in subsystems], ticks
+        )
+        results[f"profile_engine[{size}].batched"] = timed(
+            lambda: engine.step(instant), ticks
+        )
+    return results
+
+
+@benchmark
+def profile_lookup(lookups: int = 100000) -> dict[str, float]:
+    "One profile value, interpolated vs looked up."
+    with TemporaryDirectory() as directory:
+        subsystem = Consumption(
+            id=1,
+            peak_demand=7,
+            profile={**sample_config()["consumptions"][0]["$profile"], "seed": 1},
+            lookup_table_dir=directory,
+            auto_start=False,
+        )
+        instant = datetime.now()
+        return {
+            "profile_lookup.interpolated": timed(
+                lambda: subsystem.get_value(instant), lookups
+            ),
+            "profile_lookup.looked_up": timed(
+                lambda: subsystem.lookup_value(instant), lookups
+            ),
+        }
+
+
+@benchmark
+def storage_fleet(size: int = 10000, ticks: int = 20) -> dict[str, float]:
+    "One fleet wide storage step."
+    fleet = StorageFleet()
+    for _ in range(size):
+        fleet.add(18, 5, 5, 0.9, 0.92, 9)
+    requests = array("d", [(-1) ** i * 3.0 for i in range(size)])
+    return {
+        f"storage_fleet[{size}]": timed(lambda: fleet.step(requests, 1 / 3600), ticks)
+    }
+
+
+@benchmark
+def publishing_modes(size: int = 100, ticks: int = 20) -> dict[str, float]:
+    "A fleet tick, publishing per topic vs one snapshot."
+    results = {}
+    for mode in ("topics", "snapshot"):
+        client = FakeMqttClient()
+        per_tick = timed(fleet_ticker(build_fleet(size, client, mode=mode)), ticks)
+        results[f"publishing_modes[{mode}]"] = per_tick / size
+        results[f"publishing_modes[{mode}].publishes"] = client.published / ticks / size
+    return results
+
+
+# Runs the prosumer through Django, as the autoreloaded child of `runserver`.
+_DJANGO_STARTUP = """
+import django
+django.setup()
+print("Running prosumer", flush=True)
+"""
+
+
+def _acknowledge_mqtt(server: socket.socket) -> None:
+    """
+    Stand-in for an MQTT broker, that accepts every connection of `server`,
+    acknowledges it and then discards whatever the client sends.
+    """
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError:
+            return
+        with connection:
+            if connection.recv(1 << 16):
+                connection.sendall(encode_packet(CONNACK, 0, b"\x00\x00"))
+                while connection.recv(1 << 16):
+                    pass
+
+
+@benchmark
+def startup(runs: int = 5) -> dict[str, float]:
+    """
+    Wall time until `python -m prosumer run` of the shipped prosumer.yaml has
+    connected to a local stand-in broker and started its subsystems, and its
+    peak RSS, against starting the same prosumer through Django.
+    """
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        threading.Thread(target=_acknowledge_mqtt, args=(server,), daemon=True).start()
+        env = {
+            **os.environ,
+            "PROSUMER_LOCATION": "0, 0",
+            "PROSUMER_MQTT_SERVER": "127.0.0.1",
+            "PROSUMER_MQTT_PORT": str(server.getsockname()[1]),
+            "PROSUMER_VP_ADDRESS": "::1",
+            "DJANGO_SETTINGS_MODULE": "virtual_prosumer.settings",
+            "RUN_MAIN": "true",
+        }
+        commands = {
+            "standalone": [sys.executable, "-m", "prosumer", "run", "prosumer.yaml"],
+            "django": [sys.executable, "-c", _DJANGO_STARTUP],
+        }
+        results = {}
+        for name, command in commands.items():
+            elapsed, rss = [], 0
+            for _ in range(runs):
+                started_at = perf_counter()
+                with subprocess.Popen(
+                    command,
+                    cwd=Path(__file__).parent.parent,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                ) as process:
+                    while not process.stdout.readline().startswith("Running"):
+                        if process.poll() is not None:
+                            raise RuntimeError(f"{name} prosumer exited on startup")
+                    elapsed.append(perf_counter() - started_at)
+                    # ru_maxrss would include every process this one started.
+                    status = Path(f"/proc/{process.pid}/status").read_text("utf-8")
+                    rss = int(status.split("VmHWM:")[1].split()[0])
+                    process.kill()
+            results[f"startup[{name}]"] = min(elapsed)
+            results[f"startup[{name}].rss_mib"] = rss / 1024
+    return results
+
+
+def _format(metric: str, value: float) -> str:
+    if metric.endswith(".publishes"):
+        return f"{value:.1f} publishes"
+    if metric.endswith(".rss_mib"):
+        return f"{value:.1f} MiB"
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if value >= scale:
+            return f"{value / scale:.2f} {unit}"
+    return f"{value * 1e9:.0f} ns"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m prosumer.benchmarks")
+    parser.add_argument("names", nargs="*", help=", ".join(BENCHMARKS))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    args = parser.parse_args()
+
+    baseline = {}
+    if BASELINE_PATH.exists():
+        baseline = json.loads(BASELINE_PATH.read_text(encoding="utf-8"))
+    results, regressions = {}, []
+    for name in args.names or BENCHMARKS:
+        runs = [BENCHMARKS[name]() for _ in range(max(args.runs, 1))]
+        for metric in runs[0]:
+            value = min(run[metric] for run in runs)
+            results[metric] = value
+            line = f"{metric}: {_format(metric, value)}"
+            if baseline.get(metric):
+                change = value / baseline[metric] - 1
+                line += f" ({change:+.0%} vs baseline)"
+                if change > args.tolerance:
+                    regressions.append(metric)
+            print(line)
+
+    if args.save_baseline:
+        # Saving every benchmark drops the metrics they no longer report.
+        if args.names:
+            results = {**baseline, **results}
+        BASELINE_PATH.write_text(
+            json.dumps(results, indent=2, sort_keys=True) + "\n",
+            encoding="utf-8",
+        )
+    if args.check and regressions:
+        sys.exit(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from array import array
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional
+
+from utils.checkpoint import Checkpoint, write_checkpoint
+from utils.metrics import REGISTRY, Histogram
+from utils.scheduler import ScheduledJob, TickScheduler, get_default_scheduler
+
+from prosumer.subsystems import InterconnectedSubsystem, SubsystemBase
+
+CHECKPOINT_SECONDS = REGISTRY.register(
+    Histogram(
+        "prosumer_checkpoint_seconds",
+        "Duration of saving or restoring a checkpoint of a prosumer.",
+        (1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1),
+    )
+)
+
+
+class Checkpointer:
+    """
+    Saves the state of a prosumer and of its subsystems to `path` every
+    `interval` seconds, and restores it when the prosumer is started again, so
+    that its moving averages, drawn profiles and storage state of charge carry
+    on from the last checkpoint rather than starting over.
+
+    Checkpoints run in the scheduler thread after the prosumer's tick, so they
+    see a consistent state without locking, and cost nothing between them.
+    States published over MQTT aren't saved, as they're published again on
+    every connection anyway.
+    """
+
+    # Runs after the prosumer aggregated the tick.
+    run_priority = InterconnectedSubsystem.run_priority + 1
+
+    def __init__(
+        self,
+        prosumer: InterconnectedSubsystem,
+        path: str | Path,
+        interval: float = 60,
+        scheduler: Optional[TickScheduler] = None,
+    ) -> None:
+        self.prosumer = prosumer
+        self.path = Path(path)
+        self.interval = interval
+        self.scheduler = scheduler or get_default_scheduler()
+        self.runner: Optional[ScheduledJob] = None
+        self._save_seconds = CHECKPOINT_SECONDS.labels(operation="save")
+        self._restore_seconds = CHECKPOINT_SECONDS.labels(operation="restore")
+
+    def _subsystems(self) -> Iterator[tuple[str, SubsystemBase]]:
+        prosumer = self.prosumer
+        yield "prosumer/", prosumer
+        for entity in ("generations", "consumptions", "storages"):
+            for subsystem in getattr(prosumer, entity):
+                yield f"{entity}/{subsystem.id_}/", subsystem
+
+    def save(self) -> None:
+        """
+        Writes a checkpoint, atomically replacing the previous one.
+        """
+        started_at = perf_counter()
+        arrays: dict[str, array] = {}
+        meta: dict[str, any] = {}
+        for prefix, subsystem in self._subsystems():
+            subsystem.save_state(prefix, arrays, meta)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            write_checkpoint(self.path, meta, arrays)
+        except OSError as error:
+            print(f"Couldn't write checkpoint {self.path}: {error}")
+        self._save_seconds.observe(perf_counter() - started_at)
+
+    def restore(self) -> bool:
+        """
+        Restores the last checkpoint, if any, before the prosumer starts
+        running. Subsystems missing from it are left as they are. Returns
+        whether a checkpoint was restored.
+        """
+        started_at = perf_counter()
+        try:
+            checkpoint = Checkpoint(self.path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as error:
+            print(f"Ignoring unreadable checkpoint {self.path}: {error}")
+            return False
+        with checkpoint:
+            for prefix, subsystem in self._subsystems():
+                if prefix + "values" in checkpoint.meta:
+                    subsystem.restore_state(prefix, checkpoint, checkpoint.meta)
+        self._restore_seconds.observe(perf_counter() - started_at)
+        return True
+
+    def start(self) -> None:
+        if self.runner is None:
+            self.runner = self.scheduler.schedule(
+                self.save, self.interval, self.run_priority
+            )
+
+    def stop(self) -> None:
+        """
+        Stops checkpointing, after a last checkpoint.
+        """
+        if self.runner is not None:
+            self.runner.stop()
+            self.runner = None
+        self.save()
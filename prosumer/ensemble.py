@@ -0,0 +1,274 @@
+import copy
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Sequence
+
+import numpy as np
+from utils.interpolate import Curves
+
+from prosumer.factory import build_prosumer
+from prosumer.profiles import ProfileEngine, draw_profile
+from prosumer.storage import StorageDispatch, StorageFleet
+from prosumer.subsystems import InterconnectedSubsystem
+from prosumer.tariffs import TariffTable
+
+ENSEMBLE_FIELDS = ("generation", "consumption", "net_export")
+
+
+def _member_seed(seed: any, member: int, kind: str, subsystem_id: any) -> str:
+    return f"{seed}:{member}:{kind}:{subsystem_id}"
+
+
+def member_config(config: dict[str, any], seed: any, member: int) -> dict[str, any]:
+    """
+    Returns a copy of the prosumer config for one member of an ensemble, where
+    every profile draws from a stream seeded independently of the others'.
+    Moving averages and lookup tables are dropped, as ensembles don't use them.
+    """
+    config = copy.deepcopy(config)
+    config["moving_avg_periods"], config["ewma_periods"] = [], []
+    config.pop("profile_lookup_tables", None)
+    for kind in ("generations", "consumptions"):
+        for subsystem in config.get(kind, []):
+            # Configs may share one profile between subsystems, as yaml
+            # anchors do, but each subsystem draws from a stream of its own.
+            key = "$profile" if "$profile" in subsystem else "profile"
+            subsystem[key] = profile = dict(subsystem[key])
+            profile["seed"] = _member_seed(seed, member, kind, subsystem["id"])
+    return config
+
+
+def percentile(ordered: Sequence[float], q: float) -> float:
+    "The `q`th percentile of sorted values, linearly interpolated."
+    position = (len(ordered) - 1) * q / 100
+    below = int(position)
+    above = min(below + 1, len(ordered) - 1)
+    return ordered[below] + (ordered[above] - ordered[below]) * (position - below)
+
+
+def _discard_states(states: dict[str, any]) -> None:
+    pass
+
+
+def _check_profiles(configs: list[dict[str, any]]) -> None:
+    # Members are summed in closed form over the slots of a week shared by
+    # every profile, which measured traces have no part in.
+    for kind in ("generations", "consumptions"):
+        for config in configs:
+            for subsystem in config.get(kind, []):
+                profile = subsystem.get("$profile", subsystem.get("profile"))
+                if profile["source"] != "range_30m":
+                    raise ValueError(
+                        "Ensembles support range_30m profiles only, not the"
+                        f" {profile['source']} profile of {kind} {subsystem['id']}"
+                    )
+
+
+def _member_profile(
+    subsystems: list, kind: str, seed: any, member: int, slots: int
+) -> np.ndarray:
+    # Profiles interpolate linearly between their slots, so the power of many
+    # subsystems is the interpolation of their summed profiles. Each member
+    # draws its own, as the subsystems of `member_config` would.
+    total = np.zeros(slots)
+    for subsystem in subsystems:
+        profile = subsystem.profile
+        total += draw_profile(
+            profile["r0"] * 7,
+            profile["r1"] * 7,
+            getattr(subsystem, subsystem.profile_base_multiplier_field_name),
+            _member_seed(seed, member, kind, subsystem.id_),
+        )
+    return total
+
+
+def _tick_groups(
+    engine: ProfileEngine, start: datetime, ticks: int, resolution: int, slot: int
+) -> list[dict[int, list[float]]]:
+    """
+    Groups the ticks of every output slot by the profile slot they fall in,
+    as profile slot -> [ticks, sum of interpolation weights].
+    """
+    period = engine.slots * engine.interval
+    offset = (start - engine.origin).total_seconds()
+    groups = [{} for _ in range(-(-ticks * resolution // slot))]
+    for tick in range(1, ticks + 1):
+        seconds = (offset + tick * resolution) % period
+        group = groups[(tick - 1) * resolution // slot].setdefault(
+            int(seconds // engine.interval), [0, 0.0]
+        )
+        group[0] += 1
+        group[1] += Curves.sine((seconds / engine.interval) % 1)
+    return groups
+
+
+def simulate_members(
+    configs: list[dict[str, any]],
+    members: range,
+    start: datetime,
+    end: datetime,
+    seed: any = 0,
+    resolution: int = 1,
+    slot: int = 1800,
+) -> dict[str, list[array]]:
+    """
+    Simulates the given members of an ensemble of the fleet of `configs`, and
+    returns the mean of every field of each member per `slot` seconds, as a
+    list of arrays (slots x members).
+
+    The power of generations and consumptions per slot is summed in closed
+    form from the interpolation weights of its ticks, which are shared by all
+    members. Only storages are stepped tick by tick, every `resolution`
+    seconds, since their state of charge depends on every tick before.
+    Profiles must all be `range_30m` ones, drawn per member.
+    """
+    _check_profiles(configs)
+    # One prosumer per config holds what every member shares: storages,
+    # dispatch policy and tariffs. Only the profiles are drawn per member.
+    engine, tariffs, templates_fleet = (
+        ProfileEngine(start),
+        TariffTable(start),
+        StorageFleet(),
+    )
+    templates: list[InterconnectedSubsystem] = [
+        build_prosumer(
+            member_config(config, f"{seed}:{i}", members[0]),
+            _discard_states,
+            storage_fleet=templates_fleet,
+            tariff_table=tariffs,
+            auto_start=False,
+        )
+        for i, config in enumerate(configs)
+    ]
+    profiled = [
+        subsystem
+        for template in templates
+        for subsystem in (*template.generations, *template.consumptions)
+    ]
+    if not profiled:
+        raise ValueError("An ensemble needs at least one profiled subsystem")
+    slots = len(profiled[0].compiled_profile)
+    interval = profiled[0].profile_interval
+    # Rows of the engine are ordered (config, kind, member).
+    for i, template in enumerate(templates):
+        for kind in ("generations", "consumptions"):
+            for member in members:
+                engine.register(
+                    _member_profile(
+                        getattr(template, kind), kind, f"{seed}:{i}", member, slots
+                    ),
+                    interval,
+                )
+    shape = (len(templates), 2, len(members))
+
+    ticks = int((end - start).total_seconds() // resolution)
+    groups = _tick_groups(engine, start, ticks, resolution, slot)
+    profiles = engine.profiles
+    means = {field: [] for field in ENSEMBLE_FIELDS}
+    for slot_groups in groups:
+        count = sum(group[0] for group in slot_groups.values())
+        totals = np.zeros(len(engine))
+        for index, (ticks_in, weights) in slot_groups.items():
+            value = profiles[:, index]
+            totals += ticks_in * value
+            totals += weights * (profiles[:, (index + 1) % slots] - value)
+        generation, consumption = (totals / count).reshape(shape).sum(axis=0)
+        means["generation"].append(array("d", generation))
+        means["consumption"].append(array("d", consumption))
+        means["net_export"].append(array("d", generation - consumption))
+
+    dispatch = StorageDispatch(templates)
+    if not len(dispatch):
+        return means
+    # The storages of every member are stepped together as one fleet, in
+    # rows (storage, member), and requested from by the dispatch policies of
+    # every config and member at once.
+    fleet = StorageFleet()
+    for row in dispatch.rows:
+        for _ in members:
+            fleet.add(
+                templates_fleet.usable_capacity[row],
+                templates_fleet.max_charge_rate[row],
+                templates_fleet.max_discharge_rate[row],
+                templates_fleet.charge_efficiency[row],
+                templates_fleet.discharge_efficiency[row],
+                templates_fleet.state_of_charge[row],
+            )
+    tariff_rows = np.array([template.tariff_row for template in templates])
+    prices = np.frombuffer(tariffs.values)
+    hours, per_slot = resolution / 3600, slot // resolution
+    storage = np.zeros(len(members))
+    for tick in range(1, ticks + 1):
+        instant = start + timedelta(seconds=tick * resolution)
+        values = engine.step(instant).reshape(shape)
+        tariffs.step(instant)
+        net_export = values[:, 0] - values[:, 1]
+        export_price = np.broadcast_to(prices[tariff_rows, None], net_export.shape)
+        requests = dispatch.request(net_export, export_price)
+        fleet.step(requests.ravel(), hours)
+        storage += fleet.power.reshape(len(dispatch), -1).sum(axis=0)
+        if tick % per_slot == 0 or tick == ticks:
+            net_export = means["net_export"][(tick - 1) // per_slot]
+            count = (tick - 1) % per_slot + 1
+            for member, total in enumerate((storage / count).tolist()):
+                net_export[member] += total
+            storage[:] = 0.0
+    return means
+
+
+def run_ensemble(
+    configs: dict[str, any] | list[dict[str, any]],
+    members: int,
+    start: datetime,
+    end: datetime,
+    seed: any = 0,
+    resolution: int = 1,
+    slot: int = 1800,
+    percentiles: Sequence[float] = (5, 50, 95),
+    workers: Optional[int] = None,
+) -> dict[str, any]:
+    """
+    Simulates `members` realizations of the randomized profiles of a prosumer,
+    or of a fleet of them, from `start` until `end`, and returns the given
+    `percentiles` of the mean generation, consumption and net export of the
+    members in every `slot` seconds:
+
+        {"slots": [datetime, ...], "percentiles": (5, 50, 95),
+         "generation": {5: [kW per slot], 50: [...], 95: [...]}, ...}
+
+    Each member draws from seeded streams of its own, so results don't depend
+    on the number of `workers`. With more than one, members are simulated in
+    a pool of that many processes.
+    """
+    if isinstance(configs, dict):
+        configs = [configs]
+    if slot % resolution:
+        raise ValueError(f"Slot of {slot}s is not a multiple of {resolution}s ticks")
+    _check_profiles(configs)
+    workers = max(1, min(workers or 1, members))
+    chunks = [range(i, members, workers) for i in range(workers)]
+    arguments = (start, end, seed, resolution, slot)
+    if workers == 1:
+        results = [simulate_members(configs, chunks[0], *arguments)]
+    else:
+        with ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            futures = [
+                pool.submit(simulate_members, configs, chunk, *arguments)
+                for chunk in chunks
+            ]
+            results = [future.result() for future in futures]
+
+    bands: dict[str, any] = {"percentiles": tuple(percentiles)}
+    slot_count = len(results[0]["generation"])
+    bands["slots"] = [start + timedelta(seconds=i * slot) for i in range(slot_count)]
+    for field in ENSEMBLE_FIELDS:
+        bands[field] = {q: [] for q in percentiles}
+        for i in range(slot_count):
+            ordered = sorted(value for result in results for value in result[field][i])
+            for q in percentiles:
+                bands[field][q].append(percentile(ordered, q))
+    return bands
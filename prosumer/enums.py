@@ -5,3 +5,11 @@ class ProsumerStatus(Enum):
     IMPORT = "IMPORTING"
     EXPORT = "EXPORTING"
     SELF_SUSTAIN = "SELF SUSTAINING"
+
+    @classmethod
+    def of(cls, net_export: float) -> "ProsumerStatus":
+        if net_export > 0:
+            return cls.EXPORT
+        if net_export < 0:
+            return cls.IMPORT
+        return cls.SELF_SUSTAIN
@@ -0,0 +1,93 @@
+from typing import Callable, Optional
+
+from utils.utils import acclimate_dict_for_kwargs
+
+from prosumer.profiles import ProfileEngine
+from prosumer.storage import StorageFleet
+from prosumer.subsystems import (
+    Consumption,
+    Generation,
+    InterconnectedSubsystem,
+    Storage,
+)
+from prosumer.tariffs import TariffTable
+
+# Configuration published once when a prosumer comes online.
+ONLINE_STATE_KEYS = (
+    "generations",
+    "storages",
+    "consumptions",
+    "location",
+    "moving_avg_periods",
+)
+
+
+def online_states(config: dict[str, any]) -> dict[str, any]:
+    # Subsystems and moving averages are optional, and published as empty.
+    return {
+        "isOnline": True,
+        **{key: config.get(key, []) for key in ONLINE_STATE_KEYS},
+    }
+
+
+def build_prosumer(
+    config: dict[str, any],
+    set_states: Callable,
+    profile_engine: Optional[ProfileEngine] = None,
+    storage_fleet: Optional[StorageFleet] = None,
+    tariff_table: Optional[TariffTable] = None,
+    **kwargs,
+) -> InterconnectedSubsystem:
+    """
+    Builds the subsystems of a prosumer from its config, and returns the
+    `InterconnectedSubsystem` that aggregates them. Extra `kwargs` are passed
+    on to every subsystem. Generations and consumptions are computed by the
+    `profile_engine`, storages are kept in the `storage_fleet`, and export
+    prices are looked up by the `tariff_table`, if given.
+    """
+    subsystem_reporting = tuple(config.get("subsystem_reporting", []))
+    commons = {
+        "moving_avg_periods": config.get("moving_avg_periods", []),
+        "ewma_periods": config.get("ewma_periods", []),
+        "moving_avg_exact_limit": config.get("moving_avg_exact_limit", 60),
+        "idle_skipping": config.get("idle_skipping", True),
+        **kwargs,
+    }
+    profiled = {
+        **commons,
+        "profile_engine": profile_engine,
+        "lookup_table_dir": config.get("profile_lookup_tables"),
+    }
+    acclimate = acclimate_dict_for_kwargs
+    consumptions = [
+        Consumption(**profiled, **acclimate(subsystem_config))
+        for subsystem_config in config.get("consumptions", [])
+    ]
+    generations = [
+        Generation(**profiled, **acclimate(subsystem_config))
+        for subsystem_config in config.get("generations", [])
+    ]
+    storages = [
+        Storage(**commons, **acclimate(subsystem_config))
+        for subsystem_config in config.get("storages", [])
+    ]
+    return InterconnectedSubsystem(
+        **commons,
+        consumptions=consumptions,
+        generations=generations,
+        storages=storages,
+        set_states=set_states,
+        subsystem_reporting=subsystem_reporting,
+        storage_dispatch=config.get("storage_dispatch"),
+        storage_fleet=storage_fleet,
+        tariff_table=tariff_table,
+        id=-1,
+    )
+
+
+def subsystems_of(prosumer: InterconnectedSubsystem) -> list:
+    """
+    Returns the subsystems of the prosumer that run on their own, in the order
+    they run within a tick. Storages are run by the prosumer itself.
+    """
+    return [*prosumer.generations, *prosumer.consumptions, prosumer]
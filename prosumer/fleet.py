@@ -0,0 +1,426 @@
+from datetime import datetime
+from typing import Callable, Optional
+
+import numpy as np
+from utils.clock import WALL_CLOCK, Clock
+from utils.rolling import BatchedRollingAverages
+from utils.utils import MEASURED_SOURCES
+
+from prosumer.enums import ProsumerStatus
+from prosumer.factory import build_prosumer
+from prosumer.mqtt import PUBLISHES_PER_TICK, ProsumerPublisher, PublishPlan
+from prosumer.profiles import ProfileEngine
+from prosumer.storage import StorageDispatch, StorageFleet
+from prosumer.subsystems import InterconnectedSubsystem, SubsystemBase
+from prosumer.tariffs import TariffTable
+
+# Aggregate states of a prosumer, in the order `get_states` returns them.
+AGGREGATE_FIELDS = (
+    "generation",
+    "consumption",
+    "storage",
+    "self_consumption",
+    "net_export",
+    "export_price",
+)
+
+_STATUS_PAYLOADS = {
+    -1.0: ProsumerStatus.IMPORT.value,
+    0.0: ProsumerStatus.SELF_SUSTAIN.value,
+    1.0: ProsumerStatus.EXPORT.value,
+}
+
+
+def _status_payload(sign: float) -> str:
+    # A NaN net export has no sign, and `ProsumerStatus.of` calls it self
+    # sustaining like the object path publishes it.
+    return _STATUS_PAYLOADS.get(sign, ProsumerStatus.SELF_SUSTAIN.value)
+
+
+def steps_columnar(config: dict[str, any]) -> bool:
+    """
+    Whether a prosumer can be stepped by a `ColumnarFleet`: its moving
+    averages are all exact, its profiles are all drawn rather than measured,
+    and every state is published on its own topic whenever its payload
+    changed, without deadbands or a heartbeat.
+    """
+    interval = SubsystemBase.run_interval
+    exact_limit = config.get("moving_avg_exact_limit", 60) * 60 // interval
+    if config.get("ewma_periods") or any(
+        period * 60 // interval > exact_limit
+        for period in config.get("moving_avg_periods", [])
+    ):
+        return False
+    publishing = config.get("publishing") or {}
+    if (
+        publishing.get("mode", "topics") != "topics"
+        or publishing.get("deadbands")
+        or publishing.get("heartbeat") is not None
+    ):
+        return False
+    return not any(
+        subsystem.get("$profile", subsystem.get("profile", {})).get("source")
+        in MEASURED_SOURCES
+        for kind in ("generations", "consumptions")
+        for subsystem in config.get(kind, [])
+    )
+
+
+class ColumnPublisher:
+    """
+    Publishes the leaf states of many prosumers from one array of values per
+    tick, on the topics of their `ProsumerPublisher` and only when a payload
+    changed, as `ProsumerPublisher.publish_topics` would.
+
+    Values are rounded to the 3 decimals they're published with, and compared
+    with those last published, in one array operation for every leaf, so only
+    the changed ones are formatted. Leaves without a `payload` formatter are
+    published as the rounded value. A NaN value is always published. The values last published
+    for each prosumer are views into `last`, registered with its publisher so
+    that `ProsumerPublisher.invalidate` forgets them too.
+    """
+
+    def __init__(
+        self,
+        publishers: list[ProsumerPublisher],
+        leaves: list[list[tuple[str, Optional[Callable[[float], str]]]]],
+    ) -> None:
+        self.publishers = publishers
+        # Topic, payload formatter and client publish of every leaf.
+        self.topics: list[str] = []
+        self.payloads: list[Optional[Callable[[float], str]]] = []
+        self._publish: list[Callable] = []
+        owners = []
+        for owner, (publisher, publisher_leaves) in enumerate(zip(publishers, leaves)):
+            for topic, payload in publisher_leaves:
+                self.topics.append(topic)
+                self.payloads.append(payload)
+                self._publish.append(publisher.client.publish)
+                owners.append(owner)
+        self.owners = np.array(owners, dtype=np.intp)
+        self.last = np.full(len(owners), np.nan)
+        start = 0
+        for publisher, publisher_leaves in zip(publishers, leaves):
+            end = start + len(publisher_leaves)
+            publisher.published_columns.append(self.last[start:end])
+            start = end
+
+    def __len__(self) -> int:
+        return len(self.topics)
+
+    def publish(self, values: np.ndarray) -> np.ndarray:
+        """
+        Publishes the leaves whose rounded value changed, and returns the
+        number of messages published for each prosumer.
+        """
+        rounded = np.round(values, 3)
+        # -0.0 and 0.0 are published as different payloads, so changed too.
+        changed = np.flatnonzero(
+            (rounded != self.last) | (np.signbit(rounded) != np.signbit(self.last))
+        )
+        self.last[changed] = rounded[changed]
+        topics, payloads, publish = self.topics, self.payloads, self._publish
+        for i, value in zip(changed.tolist(), rounded[changed].tolist()):
+            payload = payloads[i]
+            publish[i](
+                topic=topics[i],
+                payload=str(value) if payload is None else payload(value),
+                retain=True,
+            )
+        counts = np.bincount(self.owners[changed], minlength=len(self.publishers))
+        for publisher, count in zip(self.publishers, counts.tolist()):
+            publisher.published += count
+            PUBLISHES_PER_TICK.observe(count)
+        return counts
+
+
+class ColumnarFleet:
+    """
+    Steps many prosumers as columns of arrays rather than as objects, with
+    one array operation per state for the whole fleet, and publishes their
+    states through their `ProsumerPublisher` as their `publish_states` would.
+
+    Prosumers are still built as subsystems, which register their profiles
+    with the `profile_engine`, their tariffs with the `tariff_table` and
+    their storages with the `storage_fleet`, but they're never run. The engine
+    and the table are stepped by whoever shares them before each `tick`, as is
+    the storage fleet if given, with the `request_storages` of the fleet.
+    Only prosumers for which `steps_columnar` holds can be stepped this way.
+    Their moving averages are kept per set of periods, in one
+    `BatchedRollingAverages` for every state of the prosumers sharing them.
+    """
+
+    def __init__(
+        self,
+        configs: list[dict[str, any]],
+        publishers: list[ProsumerPublisher],
+        profile_engine: ProfileEngine,
+        tariff_table: TariffTable,
+        clock: Clock = WALL_CLOCK,
+        storage_fleet: Optional[StorageFleet] = None,
+    ) -> None:
+        self.profile_engine = profile_engine
+        self.tariff_table = tariff_table
+        # Stepped by whoever shares the fleet, such as a `ProsumerHost`.
+        self._steps_storages = storage_fleet is None
+        self.storage_fleet = StorageFleet() if storage_fleet is None else storage_fleet
+        self.prosumers: list[InterconnectedSubsystem] = [
+            build_prosumer(
+                {**config, "moving_avg_periods": [], "ewma_periods": []},
+                publisher.publish_states,
+                profile_engine=profile_engine,
+                storage_fleet=self.storage_fleet,
+                tariff_table=tariff_table,
+                clock=clock,
+                auto_start=False,
+            )
+            for config, publisher in zip(configs, publishers)
+        ]
+        self._last_updated_at = ""
+        self._index_subsystems()
+        templates = self._index_states(
+            [config.get("moving_avg_periods", []) for config in configs]
+        )
+        leaves, columns = [], []
+        for publisher, states in zip(publishers, templates):
+            publisher_leaves = self._leaves(publisher, states)
+            leaves.append([(topic, payload) for topic, payload, _ in publisher_leaves])
+            columns += [column for _, _, column in publisher_leaves]
+        self.publisher = ColumnPublisher(publishers, leaves)
+        self._leaf_columns = np.array(columns, dtype=np.intp)
+
+    def __len__(self) -> int:
+        return len(self.prosumers)
+
+    def _index_subsystems(self) -> None:
+        generation_rows, generation_owners = [], []
+        consumption_rows, consumption_owners = [], []
+        for owner, prosumer in enumerate(self.prosumers):
+            for generation in prosumer.generations:
+                generation_rows.append(generation.profile_row)
+                generation_owners.append(owner)
+            for consumption in prosumer.consumptions:
+                consumption_rows.append(consumption.profile_row)
+                consumption_owners.append(owner)
+        self._generation_rows = np.array(generation_rows, dtype=np.intp)
+        self._generation_owners = np.array(generation_owners, dtype=np.intp)
+        self._consumption_rows = np.array(consumption_rows, dtype=np.intp)
+        self._consumption_owners = np.array(consumption_owners, dtype=np.intp)
+        self.dispatch = StorageDispatch(self.prosumers)
+        self._storage_rows = self.dispatch.rows
+        self._storage_owners = self.dispatch.owners
+        self._tariff_rows = np.array(
+            [prosumer.tariff_row for prosumer in self.prosumers], dtype=np.intp
+        )
+
+    def _index_states(self, periods_of: list[list[int]]) -> list[dict[str, any]]:
+        """
+        Lays out every state of the fleet as a column of `_states`: the power
+        of every generation, consumption and storage, the state of charge of
+        every storage and the aggregates of every prosumer, then the moving
+        averages of all of those, the status of every prosumer, and a NaN
+        standing for its last update. Returns the state tree of every
+        prosumer, with the column of each leaf.
+        """
+        size = len(self.prosumers)
+        counts = (
+            len(self._generation_rows),
+            len(self._consumption_rows),
+            len(self._storage_owners),
+            len(self._storage_owners),
+            *(size,) * len(AGGREGATE_FIELDS),
+        )
+        starts = np.cumsum((0, *counts)).tolist()
+        self._sources = [slice(start, end) for start, end in zip(starts, starts[1:])]
+        sources = self._sources[-1].stop
+        # Source columns averaged over each set of periods.
+        grouped: dict[tuple[int], list[int]] = {}
+        owned = [[] for _ in range(size)]
+        for kind, owners in enumerate(
+            (
+                self._generation_owners,
+                self._consumption_owners,
+                self._storage_owners,
+                self._storage_owners,
+            )
+        ):
+            for column, owner in enumerate(owners.tolist(), self._sources[kind].start):
+                owned[owner].append(column)
+        for owner, periods in enumerate(periods_of):
+            periods = tuple(dict.fromkeys(periods))
+            if not periods:
+                continue
+            columns = grouped.setdefault(periods, [])
+            columns += owned[owner]
+            columns += [
+                self._sources[4 + k].start + owner for k in range(len(AGGREGATE_FIELDS))
+            ]
+        # Column of the average over each period, by source column.
+        averaged: dict[int, dict[int, int]] = {}
+        self._averages = []
+        offset = sources
+        interval = SubsystemBase.run_interval
+        for periods, columns in grouped.items():
+            averages = BatchedRollingAverages(
+                {f"{period}m": period * 60 // interval for period in periods},
+                len(columns),
+            )
+            for j, column in enumerate(columns):
+                averaged[column] = {
+                    period: offset + w * len(columns) + j
+                    for w, period in enumerate(periods)
+                }
+            width = len(periods) * len(columns)
+            self._averages.append(
+                (
+                    np.array(columns, dtype=np.intp),
+                    averages,
+                    slice(offset, offset + width),
+                )
+            )
+            offset += width
+        self._status = slice(offset, offset + size)
+        self._states = np.zeros(offset + size + 1)
+        self._states[-1] = np.nan
+
+        def states_of(column: int, field: str) -> dict[str, int]:
+            return {
+                field: column,
+                **{
+                    f"{field}_{period}m": average
+                    for period, average in averaged.get(column, {}).items()
+                },
+            }
+
+        templates = []
+        generation = iter(range(self._sources[0].start, self._sources[0].stop))
+        consumption = iter(range(self._sources[1].start, self._sources[1].stop))
+        storage = iter(range(self._sources[2].start, self._sources[2].stop))
+        for owner, prosumer in enumerate(self.prosumers):
+            entities = {
+                "generations": {
+                    subsystem.id_: states_of(next(generation), "power")
+                    for subsystem in prosumer.generations
+                },
+                "consumptions": {
+                    subsystem.id_: states_of(next(consumption), "power")
+                    for subsystem in prosumer.consumptions
+                },
+                "storages": {},
+            }
+            for subsystem in prosumer.storages:
+                column = next(storage)
+                entities["storages"][subsystem.id_] = {
+                    **states_of(column, "power"),
+                    **states_of(column + len(self._storage_owners), "state_of_charge"),
+                }
+            states = {
+                f"{entity}s": entities[f"{entity}s"]
+                for entity in ("generation", "consumption", "storage")
+                if entity in prosumer.subsystem_reporting
+            }
+            aggregates = {
+                field: self._sources[4 + k].start + owner
+                for k, field in enumerate(AGGREGATE_FIELDS)
+            }
+            states.update(
+                {field: aggregates[field] for field in AGGREGATE_FIELDS[:-1]},
+                status=self._status.start + owner,
+                export_price=aggregates["export_price"],
+                last_updated_at=len(self._states) - 1,
+            )
+            for field in AGGREGATE_FIELDS:
+                states.update(states_of(aggregates[field], field))
+            templates.append(states)
+        return templates
+
+    def _leaves(
+        self, publisher: ProsumerPublisher, states: dict[str, any]
+    ) -> list[tuple[str, Optional[Callable[[float], str]], int]]:
+        # (topic, payload, column) of every leaf, in the order `publish_topics`
+        # publishes the states of a tick.
+        leaves = []
+        plan = PublishPlan(states, publisher.topic_prefix)
+        for path, _size, plan_leaves in plan.containers:
+            container = states
+            for key in path:
+                container = container[key]
+            for key, topic, _field in plan_leaves:
+                column = container[key]
+                if column == len(self._states) - 1:
+                    payload = self._last_updated_payload
+                elif self._status.start <= column < self._status.stop:
+                    payload = _status_payload
+                else:
+                    payload = None
+                leaves.append((topic, payload, column))
+        return leaves
+
+    def _last_updated_payload(self, _value: float) -> str:
+        return self._last_updated_at
+
+    def _profiled(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Generation, consumption and export price of every prosumer, from the
+        # engine and the table stepped to the present tick.
+        states, sources, size = self._states, self._sources, len(self.prosumers)
+        engine_values = self.profile_engine.values
+        generations, consumptions = states[sources[0]], states[sources[1]]
+        np.take(engine_values, self._generation_rows, out=generations)
+        np.take(engine_values, self._consumption_rows, out=consumptions)
+        return (
+            np.bincount(self._generation_owners, generations, size),
+            np.bincount(self._consumption_owners, consumptions, size),
+            np.frombuffer(self.tariff_table.values)[self._tariff_rows],
+        )
+
+    def request_storages(self, requested: np.ndarray) -> None:
+        """
+        Writes the power requested from every storage of the fleet at the
+        present tick into its row of `requested`, for whoever shares the
+        `storage_fleet` to step it before the `tick`.
+        """
+        if len(self._storage_rows):
+            generation, consumption, export_price = self._profiled()
+            requested[self._storage_rows] = self.dispatch.request(
+                generation - consumption, export_price
+            )
+
+    def tick(self, instant: datetime) -> None:
+        """
+        Steps every prosumer to `instant`, once the engine and the tariff
+        table were stepped to it, and publishes their states.
+        """
+        if not self.prosumers:
+            return
+        states, sources, size = self._states, self._sources, len(self.prosumers)
+        generation, consumption, export_price = self._profiled()
+        fleet = self.storage_fleet
+        if self._steps_storages and len(self._storage_rows):
+            fleet.step(
+                self.dispatch.request(generation - consumption, export_price),
+                SubsystemBase.run_interval / 3600,
+            )
+        np.take(fleet.power, self._storage_rows, out=states[sources[2]])
+        np.take(fleet.state_of_charge, self._storage_rows, out=states[sources[3]])
+        storage = np.bincount(self._storage_owners, states[sources[2]], size)
+        self_consumption = np.minimum(
+            generation + np.maximum(storage, 0), consumption + np.maximum(-storage, 0)
+        )
+        net_export = generation - consumption + storage
+        for source, values in zip(
+            sources[4:],
+            (
+                generation,
+                consumption,
+                storage,
+                self_consumption,
+                net_export,
+                export_price,
+            ),
+        ):
+            states[source] = values
+        for columns, averages, target in self._averages:
+            states[target] = averages.push(states[columns]).ravel()
+        np.sign(net_export, out=states[self._status])
+        self._last_updated_at = str(instant)
+        self.publisher.publish(states[self._leaf_columns])
@@ -0,0 +1,167 @@
+from typing import Optional
+
+import numpy as np
+from utils.clock import WALL_CLOCK, Clock
+from utils.scheduler import TickScheduler
+
+from prosumer.factory import build_prosumer, online_states, subsystems_of
+from prosumer.fleet import ColumnarFleet, steps_columnar
+from prosumer.mqtt import MqttClientPool, ProsumerPublisher
+from prosumer.profiles import ProfileEngine
+from prosumer.sharding import ShardedFleet
+from prosumer.storage import StorageFleet
+from prosumer.subsystems import InterconnectedSubsystem, SubsystemBase
+from prosumer.tariffs import TariffTable
+
+
+class ProsumerHost:
+    """
+    Runs many prosumers in one process, ticked by a shared scheduler and
+    publishing through a shared pool of MQTT connections. Each prosumer keeps
+    publishing under its own `vpAddress`.
+
+    Profiles of the whole fleet are computed in one batch per tick by a
+    `ProfileEngine`, export prices looked up by a `TariffTable`, and storages
+    of every prosumer charged and discharged in one step of a shared
+    `StorageFleet`. Prosumers that `steps_columnar` allows are then stepped
+    together by a `ColumnarFleet`, in the same job, before the subsystems of
+    the others.
+    """
+
+    def __init__(
+        self,
+        configs: list[dict[str, any]],
+        pool: MqttClientPool,
+        scheduler: Optional[TickScheduler] = None,
+        clock: Clock = WALL_CLOCK,
+    ) -> None:
+        self.configs = configs
+        self.pool = pool
+        self.scheduler = scheduler or TickScheduler()
+        self.clock = clock
+        self.profile_engine = ProfileEngine(clock.now())
+        self.tariff_table = TariffTable(self.profile_engine.origin)
+        self.storage_fleet = StorageFleet()
+        self.publishers: list[ProsumerPublisher] = []
+        self.prosumers: list[InterconnectedSubsystem] = []
+        self.fleet: Optional[ColumnarFleet] = None
+
+    def start(self) -> None:
+        """
+        Builds every prosumer, and only then schedules the engine, the tariff
+        table, the columnar fleet and the subsystems, so that no tick steps a
+        half built fleet.
+        """
+        columnar = []
+        for config in self.configs:
+            publisher = self.pool.publisher_for(
+                config["settings"]["vpAddress"], config.get("publishing")
+            )
+            publisher.set_states(online_states(config))
+            self.publishers.append(publisher)
+            if steps_columnar(config):
+                columnar.append((config, publisher))
+                continue
+            prosumer = build_prosumer(
+                config,
+                publisher.publish_states,
+                profile_engine=self.profile_engine,
+                storage_fleet=self.storage_fleet,
+                tariff_table=self.tariff_table,
+                scheduler=self.scheduler,
+                clock=self.clock,
+                auto_start=False,
+            )
+            self.prosumers.append(prosumer)
+        self.fleet = ColumnarFleet(
+            [config for config, _ in columnar],
+            [publisher for _, publisher in columnar],
+            self.profile_engine,
+            self.tariff_table,
+            self.clock,
+            self.storage_fleet,
+        )
+        # Power requested from every storage of the host, by fleet row.
+        self._requested = np.zeros(len(self.storage_fleet))
+        self._dispatched = [
+            prosumer for prosumer in self.prosumers if prosumer.storages
+        ]
+        self.runner = self.scheduler.schedule(
+            self.tick, SubsystemBase.run_interval, priority=-1
+        )
+        for prosumer in self.prosumers:
+            for subsystem in subsystems_of(prosumer):
+                subsystem.start()
+        self.prosumers += self.fleet.prosumers
+
+    def tick(self) -> None:
+        """
+        Steps the engine, the tariff table and the storages of every prosumer
+        to the present tick, and then the columnar fleet.
+        """
+        instant = self.clock.now()
+        self.profile_engine.step(instant)
+        self.tariff_table.step(instant)
+        requested = self._requested
+        self.fleet.request_storages(requested)
+        for prosumer in self._dispatched:
+            start = prosumer.storage_fleet_start
+            requested[
+                start : start + len(prosumer.storages)
+            ] = prosumer.request_storages_at(instant)
+        self.storage_fleet.step(requested, SubsystemBase.run_interval / 3600)
+        self.fleet.tick(instant)
+
+    def stop(self) -> None:
+        self.runner.stop()
+        for prosumer in self.prosumers:
+            for subsystem in subsystems_of(prosumer):
+                subsystem.stop()
+        for publisher in self.publishers:
+            publisher.set_state("isOnline", False)
+        self.prosumers, self.publishers = [], []
+
+
+class ShardedProsumerHost:
+    """
+    Like `ProsumerHost`, but stepping the prosumers in a `ShardedFleet` of
+    `workers` processes. Ticking and publishing stay in this process.
+    """
+
+    def __init__(
+        self,
+        configs: list[dict[str, any]],
+        pool: MqttClientPool,
+        workers: Optional[int] = None,
+        scheduler: Optional[TickScheduler] = None,
+    ) -> None:
+        self.configs = configs
+        self.pool = pool
+        self.workers = workers
+        self.scheduler = scheduler or TickScheduler()
+        self.publishers: list[ProsumerPublisher] = []
+        self.fleet: Optional[ShardedFleet] = None
+
+    def start(self) -> None:
+        for config in self.configs:
+            publisher = self.pool.publisher_for(
+                config["settings"]["vpAddress"], config.get("publishing")
+            )
+            publisher.set_states(online_states(config))
+            self.publishers.append(publisher)
+        self.fleet = ShardedFleet(
+            self.configs,
+            self.workers,
+            [publisher.publish_states for publisher in self.publishers],
+        )
+        self.fleet.start()
+        self.runner = self.scheduler.schedule(
+            self.fleet.tick, SubsystemBase.run_interval
+        )
+
+    def stop(self) -> None:
+        self.runner.stop()
+        self.fleet.stop()
+        for publisher in self.publishers:
+            publisher.set_state("isOnline", False)
+        self.publishers = []
@@ -0,0 +1,81 @@
+import csv
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from virtual_prosumer.config_loader import load_configs
+
+from prosumer.ensemble import ENSEMBLE_FIELDS, run_ensemble
+
+
+class Command(BaseCommand):
+    help = "Simulates many realizations of a prosumer, writing percentile bands."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths",
+            nargs="*",
+            help="Prosumer configs or dirs. Defaults to the configured prosumer.",
+        )
+        parser.add_argument(
+            "--members", type=int, default=1000, help="Realizations to simulate."
+        )
+        parser.add_argument(
+            "--start",
+            type=datetime.fromisoformat,
+            default=datetime.combine(datetime.now().date(), datetime.min.time()),
+            help="ISO 8601 start of the simulation. Defaults to today's midnight.",
+        )
+        parser.add_argument(
+            "--days", type=float, default=7, help="Days to simulate. Defaults to 7."
+        )
+        parser.add_argument("--seed", default="0", help="Seed of the ensemble.")
+        parser.add_argument(
+            "--resolution", type=int, default=1, help="Seconds per tick."
+        )
+        parser.add_argument(
+            "--slot", type=int, default=1800, help="Seconds per percentile band."
+        )
+        parser.add_argument(
+            "--percentiles",
+            type=lambda value: [float(q) for q in value.split(",")],
+            default=[5, 50, 95],
+            help="Comma separated percentiles. Defaults to 5,50,95.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=1, help="Processes to simulate in."
+        )
+        parser.add_argument("--output", default="ensemble.csv", help="CSV file.")
+
+    def handle(self, *args, **options):
+        configs = (
+            load_configs(options["paths"])
+            if options["paths"]
+            else [settings.PROSUMER_CONFIG]
+        )
+        start = options["start"]
+        bands = run_ensemble(
+            configs,
+            options["members"],
+            start,
+            start + timedelta(days=options["days"]),
+            seed=options["seed"],
+            resolution=options["resolution"],
+            slot=options["slot"],
+            percentiles=options["percentiles"],
+            workers=options["workers"],
+        )
+        columns = [
+            (field, q) for field in ENSEMBLE_FIELDS for q in bands["percentiles"]
+        ]
+        with open(options["output"], "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["slot", *(f"{field}_p{q:g}" for field, q in columns)])
+            for i, slot in enumerate(bands["slots"]):
+                writer.writerow(
+                    [slot.isoformat(), *(bands[field][q][i] for field, q in columns)]
+                )
+        self.stdout.write(
+            f"Wrote {len(bands['slots'])} slots of {options['members']} members"
+            f" to {options['output']}"
+        )
@@ -0,0 +1,47 @@
+from threading import Event
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from virtual_prosumer.config_loader import load_configs
+
+from prosumer.host import ProsumerHost, ShardedProsumerHost
+from prosumer.mqtt import MqttClientPool
+
+
+class Command(BaseCommand):
+    help = "Runs every prosumer in the given config files or directories."
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Prosumer configs or dirs.")
+        parser.add_argument(
+            "--connections",
+            type=int,
+            default=1,
+            help="Number of MQTT connections shared by the prosumers.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help="Number of processes to step the prosumers in, 0 for this one.",
+        )
+
+    def handle(self, *args, **options):
+        configs = load_configs(options["paths"])
+        grid = settings.PROSUMER_CONFIG["settings"]
+        pool = MqttClientPool(
+            server=grid["server"],
+            port=int(grid["mqttPort"]),
+            size=options["connections"],
+        )
+        if options["workers"]:
+            host = ShardedProsumerHost(configs, pool, options["workers"])
+        else:
+            host = ProsumerHost(configs, pool)
+        host.start()
+        self.stdout.write(f"Hosting {len(configs)} prosumers")
+        try:
+            Event().wait()
+        except KeyboardInterrupt:
+            host.stop()
+            pool.disconnect()
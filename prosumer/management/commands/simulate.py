@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from virtual_prosumer.config_loader import load_config
+
+from prosumer.recorder import StateRecorder
+from prosumer.simulation import JsonLinesWriter, simulate
+
+
+class Command(BaseCommand):
+    help = "Simulates a prosumer faster than real time, writing states to a file."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--config", help="Prosumer config. Defaults to the configured one."
+        )
+        parser.add_argument(
+            "--start",
+            type=datetime.fromisoformat,
+            default=datetime.combine(datetime.now().date(), datetime.min.time()),
+            help="ISO 8601 start of the simulation. Defaults to today's midnight.",
+        )
+        parser.add_argument(
+            "--days", type=float, default=7, help="Days to simulate. Defaults to 7."
+        )
+        parser.add_argument(
+            "--every",
+            type=int,
+            default=1,
+            help="Write the states of every Nth tick only. Defaults to 1.",
+        )
+        parser.add_argument(
+            "--output", default="simulation.jsonl", help="JSON lines output file."
+        )
+        parser.add_argument(
+            "--record", help="Also record every tick as .npy columns in this dir."
+        )
+
+    def handle(self, *args, **options):
+        config = (
+            load_config(options["config"])
+            if options["config"]
+            else settings.PROSUMER_CONFIG
+        )
+        start = options["start"]
+        end = start + timedelta(days=options["days"])
+        with open(options["output"], "w", encoding="utf-8") as file:
+            recorder = StateRecorder(options["record"]) if options["record"] else None
+            result = simulate(
+                config,
+                start,
+                end,
+                JsonLinesWriter(file),
+                recorder=recorder,
+                every=options["every"],
+            )
+        self.stdout.write(
+            f"Simulated {result['ticks']} ticks in {result['seconds']:.2f}s "
+            f"({result['ticks_per_second']:.0f} ticks/s)"
+        )
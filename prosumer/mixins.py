@@ -1,18 +1,81 @@
-from functools import cached_property
+from array import array
+from datetime import datetime
+from typing import Optional, Sequence
+
+from utils.clock import Clock
+
+from prosumer.tariffs import TariffTable, compile_tariff
 
 
 class SupportsExport:
+    """
+    Subsystem that may export, at a flat price or at a time-varying tariff
+    compiled by `compile_tariff` into `export_prices` per slot of
+    `export_price_interval` seconds.
+
+    Once registered in the `tariff_table` of the prosumer it's part of, its
+    prices are shared with that table, and changed through it.
+    """
+
+    tariff_table: Optional[TariffTable] = None
+    tariff_row: Optional[int] = None
+    # Set by the `SubsystemBase` it's mixed into.
+    clock: Clock
+    started_at: datetime
+    # Midnight the prices started at, once first read or registered.
+    _tariff_origin: Optional[datetime] = None
+
     def __init__(self, **kwargs) -> None:
         self.export_allowed = bool(kwargs.pop("can_export", True))
-        self._unit_export_price = (
-            float(kwargs.pop("export_price")) if self.export_allowed else None
-        )
+        self.export_prices: Optional[Sequence[float]] = None
+        self.export_price_interval: Optional[int] = None
+        if self.export_allowed:
+            self.export_prices, self.export_price_interval = compile_tariff(
+                kwargs.pop("export_price"), kwargs.get("lookup_table_dir")
+            )
         super().__init__(**kwargs)
 
-    @cached_property
-    def export_price(self):
+    @property
+    def tariff_origin(self) -> datetime:
+        if self._tariff_origin is None:
+            d = self.started_at.date()
+            self._tariff_origin = datetime(d.year, d.month, d.day)
+        return self._tariff_origin
+
+    @property
+    def export_price(self) -> float:
+        return self.export_price_at(self.clock.now())
+
+    def export_price_at(self, instant: datetime) -> float:
         if not self.export_allowed:
             raise PermissionError(
                 "Not allowed to read unit_export_price as `export_allowed` is set to False"
             )
-        return float(self._unit_export_price)
+        prices = self.export_prices
+        elapsed = (instant - self.tariff_origin).total_seconds()
+        return prices[int(elapsed // self.export_price_interval) % len(prices)]
+
+    def register_tariff(self, table: TariffTable) -> int:
+        """
+        Adds the prices of the subsystem to the `table`, and returns its row.
+        """
+        self.tariff_table = table
+        self._tariff_origin = table.origin
+        self.tariff_row = table.register(self.export_prices, self.export_price_interval)
+        return self.tariff_row
+
+    def update_export_prices(self, prices: Sequence[float], start: int = 0) -> None:
+        """
+        Replaces the export prices from slot `start`, e.g. with the next day's
+        dynamic prices, recompiling only what they change in the `tariff_table`.
+        """
+        if self.tariff_table is not None:
+            self.tariff_table.update(self.tariff_row, prices, start)
+            # The table copies mapped prices before changing them.
+            self.export_prices = self.tariff_table.schedules[self.tariff_row][0]
+        elif start < 0 or start + len(prices) > len(self.export_prices):
+            raise ValueError(f"Prices beyond the {len(self.export_prices)} slots")
+        else:
+            if isinstance(self.export_prices, memoryview):
+                self.export_prices = array("d", self.export_prices)
+            self.export_prices[start : start + len(prices)] = array("d", prices)
@@ -1,10 +1,31 @@
-from typing import Optional
+import json
+import sys
+from datetime import datetime
+from time import monotonic
+from typing import Callable, Optional
+from weakref import WeakSet
 
 from paho.mqtt.client import Client
+from utils.metrics import REGISTRY, Gauge, Histogram
 
+from prosumer.transport import AsyncMqttTransport
 
-def _on_connect(_client, _userdata, _flags, _rc) -> None:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _on_connect(_client, publishers, _flags, _rc) -> None:
     print("MQTT Client connected")
+    # Retained states may have been replaced by the last will while offline.
+    for publisher in publishers:
+        publisher.invalidate()
 
 
 def _on_message(_client, _userdata, msg) -> None:
@@ -19,25 +40,183 @@ def _on_disconnect(*args, **kwargs) -> None:
     print(f"MQTT Client Disconnected! {args} {kwargs}")
 
 
-class ProsumerMqttClient(Client):
-    "Custom MQTT client for prosumer."
+def short_vp_address(vp_address: str) -> str:
+    return vp_address.split(":")[-1]
 
-    def __init__(self, vp_address: str, server: str, port: int, *args, **kwargs):
-        self.short_vp_addr = vp_address.split(":")[-1]
-        super().__init__(client_id=self.short_vp_addr, *args, **kwargs)
-        self.on_connect = _on_connect
-        self.on_disconnect = _on_disconnect
-        self.on_message = _on_message
-        self.on_connect_fail = _on_connect_fail
-        self.will_set(**self._state_to_mqtt_payload(*("isOnline", False)))
-        self.connect(server, port)
-        self.loop_start()
+
+def _serialize_default(value: any) -> str:
+    # Datetimes are written in ISO 8601 as orjson does natively, so that every
+    # serializer writes the same payload.
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _json_serializer() -> Callable[[dict], bytes]:
+    if orjson is not None:
+        dumps = orjson.dumps  # pylint: disable=no-member
+        return lambda states: dumps(states, default=_serialize_default)
+    return lambda states: json.dumps(
+        states, default=_serialize_default, separators=(",", ":")
+    ).encode()
+
+
+def _msgpack_serializer() -> Callable[[dict], bytes]:
+    if msgpack is None:
+        raise ImportError("msgpack is required for the msgpack snapshot format")
+    return lambda states: msgpack.packb(states, default=_serialize_default)
+
+
+SNAPSHOT_SERIALIZERS = {"json": _json_serializer, "msgpack": _msgpack_serializer}
+
+PUBLISHES_PER_TICK = REGISTRY.register(
+    Histogram(
+        "prosumer_mqtt_publishes_per_tick",
+        "MQTT messages published for the states of one prosumer tick.",
+        (0, 1, 2, 5, 10, 20, 50, 100),
+    )
+).labels()
+
+# Connected clients, whose outbound queues are summed up on every scrape.
+_connected_clients: WeakSet = WeakSet()
+
+
+def _queue_depth(client: Client | AsyncMqttTransport) -> int:
+    if isinstance(client, AsyncMqttTransport):
+        return client.queued
+    return len(client._out_packet)  # pylint: disable=protected-access
+
+
+def _outbound_queue_depth() -> int:
+    return sum(_queue_depth(client) for client in list(_connected_clients))
+
+
+REGISTRY.register(
+    Gauge(
+        "prosumer_mqtt_outbound_queue_depth",
+        "Packets queued by the MQTT clients but not yet written to the socket.",
+    )
+).labels().set_function(_outbound_queue_depth)
+
+
+_CONTAINER_TYPES = (dict, list)
+
+
+class PublishPlan:
+    """
+    The leaf states of a state tree, flattened into their MQTT topics.
+
+    `containers` holds one `(path, size, leaves)` entry per dict or list of
+    the tree, where `path` is the keys leading to it from the root and every
+    leaf is a `(key, topic, field)` tuple. Topics are built and interned once,
+    so publishing a tick only looks values up and formats them.
+    """
+
+    __slots__ = ("containers",)
+
+    def __init__(self, states: dict[str, any], prefix: str) -> None:
+        self.containers: list[tuple[tuple, int, list[tuple[any, str, str]]]] = []
+        self._compile(states, prefix, ())
+
+    def _compile(self, container: dict | list, prefix: str, path: tuple) -> None:
+        leaves = []
+        self.containers.append((path, len(container), leaves))
+        items = (
+            enumerate(container) if isinstance(container, list) else container.items()
+        )
+        for key, value in items:
+            if str(key).startswith("$"):
+                continue
+            topic = f"{prefix}/{key}"
+            if isinstance(value, _CONTAINER_TYPES):
+                self._compile(value, topic, (*path, key))
+            else:
+                leaves.append((key, sys.intern(topic), str(key)))
+
+
+class ProsumerPublisher:
+    """
+    Publishes the states of a single prosumer under `prosumers/<addr>/` using
+    an MQTT client that may be shared with other prosumers.
+
+    A state is only published when its payload changed since it was last
+    published, or when it's outside the deadband configured for its field
+    (e.g. `{"power": {"absolute": 0.01}, "default": {"relative": 0.001}}`).
+    Unchanged states are still republished every `heartbeat` seconds, if set.
+
+    In `snapshot` mode, the states of each tick are instead published as one
+    message on `prosumers/<addr>/snapshot`, serialized in `snapshot_format`.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        vp_address: str,
+        deadbands: Optional[dict[str, dict[str, float]]] = None,
+        heartbeat: Optional[float] = None,
+        mode: str = "topics",
+        snapshot_format: str = "json",
+    ) -> None:
+        if mode not in ("topics", "snapshot"):
+            raise ValueError(f"Unknown publishing mode: {mode}")
+        self.client = client
+        self.short_vp_addr = short_vp_address(vp_address)
+        self.topic_prefix = f"prosumers/{self.short_vp_addr}"
+        self.mode = mode
+        self.serialize_snapshot = SNAPSHOT_SERIALIZERS[snapshot_format]()
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+        self.published = 0
+        # topic -> (payload, value, published at)
+        self._published: dict[str, tuple[str, any, float]] = {}
+        self._plan: Optional[PublishPlan] = None
+        # Arrays of the values last published for the prosumer by a
+        # `ColumnPublisher`, if it publishes the states of its ticks.
+        self.published_columns: list = []
+
+    def invalidate(self) -> None:
+        """
+        Forgets what was published, so that every state is published again.
+
+        Transports call it from their own thread when they reconnect, racing
+        the tick publishing. That's harmless: what was published is only read
+        and written one topic or column at a time, so a state that's found
+        unchanged just before being forgotten is published on the next tick.
+        """
+        self._published.clear()
+        for column in self.published_columns:
+            column.fill(float("nan"))
+
+    def _within_deadband(self, field: str, value: any, last_value: any) -> bool:
+        if not self.deadbands or not isinstance(value, (int, float)):
+            return False
+        deadband = self.deadbands.get(field, self.deadbands.get("default"))
+        if not deadband or not isinstance(last_value, (int, float)):
+            return False
+        change = abs(value - last_value)
+        relative_change = abs(last_value) * deadband.get("relative", 0)
+        return change <= max(deadband.get("absolute", 0), relative_change)
+
+    def _publish_value(self, topic: str, field: str, value: any) -> None:
+        payload = str(round(value, 3) if type(value) is float else value)
+        now = monotonic()
+        last = self._published.get(topic)
+        if last is not None:
+            last_payload, last_value, published_at = last
+            if (self.heartbeat is None or now - published_at < self.heartbeat) and (
+                last_payload == payload
+                or self._within_deadband(field, value, last_value)
+            ):
+                return
+        self._published[topic] = (payload, value, now)
+        self.client.publish(topic=topic, payload=payload, retain=True)
+        self.published += 1
 
     def _state_to_mqtt_payload(self, state: str, value: any):
         if isinstance(value, float):
             value = round(value, 3)
         return {
-            "topic": f"prosumers/{self.short_vp_addr}/{state}",
+            "topic": f"{self.topic_prefix}/{state}",
             "payload": str(value),
             "retain": True,
         }
@@ -54,10 +233,175 @@ class ProsumerMqttClient(Client):
             )
         if isinstance(value, dict):
             return self.set_states(states=value, parent_state=state)
-        self.publish(**self._state_to_mqtt_payload(state, value))
+        field = state.rsplit("/", 1)[-1]
+        self._publish_value(f"{self.topic_prefix}/{state}", field, value)
 
     def set_states(
         self, states: dict[str, any], parent_state: str | None = None
     ) -> None:
         for item in states.items():
             self.set_state(*item, parent_state=parent_state)
+
+    def publish_snapshot(self, states: dict[str, any]) -> None:
+        self.client.publish(
+            topic=f"{self.topic_prefix}/snapshot",
+            payload=self.serialize_snapshot(states),
+            retain=True,
+        )
+        self.published += 1
+
+    def _publish_planned(self, plan: PublishPlan, states: dict[str, any]) -> bool:
+        try:
+            for path, size, leaves in plan.containers:
+                container = states
+                for key in path:
+                    container = container[key]
+                if len(container) != size:
+                    return False
+                for key, topic, field in leaves:
+                    value = container[key]
+                    if type(value) in _CONTAINER_TYPES:
+                        return False
+                    self._publish_value(topic, field, value)
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+
+    def publish_topics(self, states: dict[str, any]) -> None:
+        """
+        Publishes every state on its own topic, like `set_states`, using a
+        plan compiled from the shape of the states. The plan is recompiled
+        whenever the states no longer have that shape.
+        """
+        if self._plan is None or not self._publish_planned(self._plan, states):
+            self._plan = PublishPlan(states, self.topic_prefix)
+            self._publish_planned(self._plan, states)
+
+    def publish_states(self, states: dict[str, any]) -> None:
+        """
+        Publishes the states of a tick, as per the publishing `mode`.
+        """
+        published = self.published
+        if self.mode == "snapshot":
+            self.publish_snapshot(states)
+        else:
+            self.publish_topics(states)
+        PUBLISHES_PER_TICK.observe(self.published - published)
+
+
+def _setup_client(client: Client, server: str, port: int) -> None:
+    client.on_connect = _on_connect
+    client.on_disconnect = _on_disconnect
+    client.on_message = _on_message
+    client.on_connect_fail = _on_connect_fail
+    _connected_clients.add(client)
+    client.connect(server, port)
+    client.loop_start()
+
+
+class _PublishesStates:
+    publisher: ProsumerPublisher
+
+    def set_state(
+        self, state: str, value: any, parent_state: Optional[str] = None
+    ) -> None:
+        self.publisher.set_state(state, value, parent_state)
+
+    def set_states(
+        self, states: dict[str, any], parent_state: str | None = None
+    ) -> None:
+        self.publisher.set_states(states, parent_state)
+
+
+class ProsumerMqttClient(_PublishesStates, Client):
+    "Custom MQTT client for prosumer."
+
+    def __init__(
+        self,
+        vp_address: str,
+        server: str,
+        port: int,
+        *args,
+        publishing: Optional[dict[str, any]] = None,
+        **kwargs,
+    ):
+        self.publisher = ProsumerPublisher(self, vp_address, **(publishing or {}))
+        self.short_vp_addr = self.publisher.short_vp_addr
+        super().__init__(
+            client_id=self.short_vp_addr, userdata=[self.publisher], *args, **kwargs
+        )
+        self.will_set(**self.publisher._state_to_mqtt_payload("isOnline", False))
+        _setup_client(self, server, port)
+
+
+class AsyncProsumerMqttClient(_PublishesStates, AsyncMqttTransport):
+    """
+    Like `ProsumerMqttClient`, but publishing through an `AsyncMqttTransport`
+    configured by `transport`, which bounds and coalesces what's queued for a
+    slow broker.
+    """
+
+    def __init__(
+        self,
+        vp_address: str,
+        server: str,
+        port: int,
+        publishing: Optional[dict[str, any]] = None,
+        **transport,
+    ) -> None:
+        self.publisher = ProsumerPublisher(self, vp_address, **(publishing or {}))
+        self.short_vp_addr = self.publisher.short_vp_addr
+        super().__init__(
+            server,
+            port,
+            client_id=self.short_vp_addr,
+            on_connect=lambda _transport: self.publisher.invalidate(),
+            **transport,
+        )
+        self.will_set(**self.publisher._state_to_mqtt_payload("isOnline", False))
+        _connected_clients.add(self)
+        self.loop_start()
+
+
+class MqttClientPool:
+    """
+    A fixed number of MQTT connections shared by many prosumers, each keeping
+    its own topic namespace.
+
+    Pooled connections can't carry a per prosumer last will, so `isOnline` has
+    to be cleared explicitly when the prosumers are stopped.
+    """
+
+    def __init__(
+        self, server: str, port: int, size: int = 1, client_id: str = "prosumer-host"
+    ) -> None:
+        self.clients: list[Client] = []
+        # The publishers of each client, invalidated whenever it (re)connects.
+        self.publishers: list[list[ProsumerPublisher]] = []
+        for i in range(max(1, size)):
+            publishers = []
+            client = Client(client_id=f"{client_id}-{i}", userdata=publishers)
+            _setup_client(client, server, port)
+            self.clients.append(client)
+            self.publishers.append(publishers)
+        self._assigned = 0
+
+    def publisher_for(
+        self, vp_address: str, publishing: Optional[dict[str, any]] = None
+    ) -> ProsumerPublisher:
+        """
+        Returns a publisher for the prosumer, balancing prosumers across the
+        pooled connections.
+        """
+        index = self._assigned % len(self.clients)
+        self._assigned += 1
+        publisher = ProsumerPublisher(
+            self.clients[index], vp_address, **(publishing or {})
+        )
+        self.publishers[index].append(publisher)
+        return publisher
+
+    def disconnect(self) -> None:
+        for client in self.clients:
+            client.disconnect()
+            client.loop_stop()
@@ -0,0 +1,348 @@
+import ast
+import csv
+import hashlib
+import mmap
+import os
+import tempfile
+from array import array
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+from utils.interpolate import Curves, pi_by_2
+
+try:
+    import pyarrow.parquet as parquet
+except ImportError:
+    parquet = None
+
+# Rows converted per chunk when caching a csv or parquet trace.
+_TRACE_CHUNK_ROWS = 65536
+
+
+def draw_profile(
+    r0: Sequence[float], r1: Sequence[float], scale: float, seed: any = None
+) -> list[float]:
+    """
+    Draws a profile uniformly between the bounds `r0` and `r1` of each slot,
+    scaled by `scale`. Draws come from a numpy `Generator` seeded by a hash of
+    `seed` if given, so that seeds of any type, such as the strings of an
+    ensemble's members, seed independent streams.
+    """
+    if seed is not None:
+        seed = int.from_bytes(hashlib.sha256(str(seed).encode()).digest(), "little")
+    low, high = np.asarray(r0, dtype=float), np.asarray(r1, dtype=float)
+    # As `random.uniform`, which unlike `Generator.uniform` allows r1 < r0.
+    draws = low + (high - low) * np.random.default_rng(seed).random(len(low))
+    return (scale * draws).tolist()
+
+
+class ProfileEngine:
+    """
+    Computes the power of many profiled subsystems in one batched step per
+    tick, instead of each subsystem interpolating its own profile.
+
+    Compiled profiles are stored in one 2-D array (subsystems x slots). All
+    rows share the engine's `origin` and slot interval, so the slot index and
+    the interpolation weight are computed once per step, and every row is
+    interpolated in a few array operations.
+    """
+
+    def __init__(self, origin: Optional[datetime] = None) -> None:
+        origin = origin or datetime.now()
+        self.origin = datetime(origin.year, origin.month, origin.day)
+        self.interval: Optional[int] = None
+        self.slots: Optional[int] = None
+        self.profiles = np.empty((0, 0))
+        self.values = np.empty(0)
+        # Rows allocated for `profiles` and `values`, doubled when full.
+        self._profiles = self.profiles
+        self._values = self.values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def register(self, profile: Sequence[float], interval: int) -> int:
+        """
+        Adds a compiled profile to the engine, and returns its row index into
+        `values`.
+        """
+        if self.slots is None:
+            self.interval, self.slots = interval, len(profile)
+            self.profiles = self._profiles = np.empty((0, self.slots))
+        if (interval, len(profile)) != (self.interval, self.slots):
+            raise ValueError(
+                f"Profile of {len(profile)} slots of {interval}s does not match"
+                f" the engine's {self.slots} slots of {self.interval}s"
+            )
+        row = len(self.values)
+        if row == len(self._values):
+            capacity = max(64, 2 * row)
+            self._profiles = np.empty((capacity, self.slots))
+            self._profiles[:row] = self.profiles
+            self._values = np.zeros(capacity)
+            self._values[:row] = self.values
+        self._profiles[row] = profile
+        self.profiles, self.values = self._profiles[: row + 1], self._values[: row + 1]
+        return row
+
+    def update(self, row: int, profile: Sequence[float]) -> None:
+        """
+        Replaces the compiled profile of a registered row, e.g. when restored.
+        """
+        if len(profile) != self.slots:
+            raise ValueError(f"Profile of {len(profile)} slots, not {self.slots}")
+        self.profiles[row] = profile
+
+    def step(self, instant: Optional[datetime] = None) -> np.ndarray:
+        """
+        Interpolates every registered profile at `instant`, and stores the
+        results in `values`.
+        """
+        if not len(self.values):
+            return self.values
+        profiles, values, slots = self.profiles, self.values, self.slots
+        elapsed = ((instant or datetime.now()) - self.origin).total_seconds()
+        seconds = elapsed % (slots * self.interval)
+        start_idx = int(seconds // self.interval)
+        weight = Curves.sine((seconds / self.interval) % 1)
+        start = profiles[:, start_idx]
+        np.subtract(profiles[:, (start_idx + 1) % slots], start, out=values)
+        values *= weight
+        values += start
+        return values
+
+
+# Curves applied to many interpolation weights at once, by curve.
+_ARRAY_CURVES = {
+    Curves.linear: lambda x: x,
+    Curves.sine: lambda x: np.sin(x * pi_by_2),
+}
+
+
+def interpolate_profile(
+    profile: Sequence[float], interval: int, seconds: np.ndarray, curve=Curves.sine
+) -> np.ndarray:
+    """
+    Interpolates a compiled profile at each of the `seconds` since its start,
+    easing between slots with `curve` the same way
+    `SubsystemWithProfile.get_value` does. The profile repeats once all of its
+    slots elapsed.
+    """
+    # Mapped traces are indexed in place, and only their samples in use are
+    # converted to float64, rather than copying the whole trace every call.
+    profile = np.asarray(profile)
+    seconds = np.asarray(seconds, dtype=float) % (len(profile) * interval)
+    start_idx = (seconds // interval).astype(np.intp)
+    weights = _ARRAY_CURVES[curve]((seconds / interval) % 1)
+    start = profile[start_idx].astype(float)
+    end = profile[(start_idx + 1) % len(profile)].astype(float)
+    return (end - start) * weights + start
+
+
+def compile_lookup_table(
+    profile: Sequence[float], interval: int, resolution: int = 1
+) -> array:
+    """
+    Interpolates the profile at every `resolution` seconds of its whole span,
+    the same way `SubsystemWithProfile.get_value` does, as float32.
+    """
+    steps = interval // resolution
+    weights = [Curves.sine(step * resolution / interval) for step in range(steps)]
+    table = array("f")
+    for i, start in enumerate(profile):
+        span = profile[(i + 1) % len(profile)] - start
+        table.extend([weight * span + start for weight in weights])
+    return table
+
+
+# Lookup tables mapped by this process, by path, shared by all subsystems with
+# identical profiles.
+_mapped_tables: dict[Path, memoryview] = {}
+
+# Most lookup tables kept in a cache directory, of 2.4 MB each for a week at 1s
+# resolution. The least recently used ones are evicted first.
+LOOKUP_TABLE_CACHE_SIZE = 64
+
+
+def _evict_lookup_tables(directory: Path, keep: int) -> None:
+    used_at = []
+    for path in directory.glob("*.f32"):
+        try:
+            used_at.append((path.stat().st_mtime_ns, path))
+        except FileNotFoundError:  # Evicted by another process
+            pass
+    used_at.sort()
+    for _, path in used_at[: max(len(used_at) - max(keep, 1), 0)]:
+        # Processes that mapped the table keep their mapping.
+        path.unlink(missing_ok=True)
+        _mapped_tables.pop(path, None)
+
+
+def load_lookup_table(
+    profile: Sequence[float],
+    interval: int,
+    resolution: int,
+    directory: str | Path,
+    cache_size: int = LOOKUP_TABLE_CACHE_SIZE,
+) -> memoryview:
+    """
+    Returns the lookup table of the profile, memory-mapped from the cache in
+    `directory`. The table is compiled and cached first if it's not yet, and
+    the least recently used tables beyond `cache_size` are evicted. Since
+    tables are keyed by a hash of the compiled profile, seeded profiles are
+    reused across restarts and processes.
+    """
+    digest = hashlib.sha256(array("d", profile).tobytes())
+    digest.update(f"{interval}:{resolution}".encode())
+    path = Path(directory) / f"{digest.hexdigest()}.f32"
+    if path in _mapped_tables:
+        return _mapped_tables[path]
+    try:
+        # Marks the table as recently used.
+        os.utime(path)
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as file:
+            compile_lookup_table(profile, interval, resolution).tofile(file)
+        os.replace(tmp_path, path)
+        _evict_lookup_tables(path.parent, cache_size)
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    _mapped_tables[path] = memoryview(mapping).cast("f")
+    return _mapped_tables[path]
+
+
+# Measured traces mapped by this process, by path and column, shared by all
+# subsystems reading the same trace.
+_mapped_traces: dict[tuple[Path, any], memoryview] = {}
+
+
+def _map_file(path: Path, offset: int, format: str) -> memoryview:
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, "madvise"):
+        # Traces are read front to back, so the kernel reads ahead of the tick.
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return memoryview(mapping)[offset:].cast(format)
+
+
+def _map_npy(path: Path, column: Optional[int]) -> memoryview:
+    """
+    Maps the values of a 1-D float `.npy` file, or of one `column` of a 2-D
+    one, such as the columns written by the `StateRecorder`, by index since
+    `.npy` files don't name their columns. The first one by default.
+    """
+    with open(path, "rb") as file:
+        if file.read(6) != b"\x93NUMPY":
+            raise ValueError(f"{path} is not a .npy file")
+        major = file.read(2)[0]
+        length = int.from_bytes(file.read(2 if major == 1 else 4), "little")
+        header = ast.literal_eval(file.read(length).decode("latin1"))
+        offset = file.tell()
+    formats = {"<f8": "d", "<f4": "f"}
+    if header["descr"] not in formats or header["fortran_order"]:
+        raise ValueError(f"{path} is not a little endian, C ordered float array")
+    if len(header["shape"]) not in (1, 2):
+        raise ValueError(f"{path} is not a 1-D or 2-D array")
+    values = _map_file(path, offset, formats[header["descr"]])
+    if len(header["shape"]) == 1:
+        return values
+    width = header["shape"][1]
+    index = 0 if column is None else column
+    if (
+        not isinstance(index, int)
+        or isinstance(index, bool)
+        or not -width <= index < width
+    ):
+        raise ValueError(f"{path} has {width} columns, no column {column!r}")
+    return values[index % width :: width]
+
+
+def _csv_chunks(path: Path, column: any) -> Iterator[array]:
+    with open(path, newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        # Blank lines, such as trailing ones, are read as empty rows.
+        rows = (row for row in reader if row)
+        header, chunk = next(rows, None), array("d")
+        if header is None:
+            return
+        if isinstance(column, str):
+            if column not in header:
+                raise ValueError(f"{path} has no column {column!r}")
+            index = header.index(column)
+        else:
+            index = -1 if column is None else column
+            try:
+                # Headerless, so the first row is a sample already.
+                chunk.append(float(header[index]))
+            except (IndexError, ValueError):
+                pass
+        for row in rows:
+            try:
+                chunk.append(float(row[index]))
+            except (IndexError, ValueError):
+                raise ValueError(
+                    f"{path}:{reader.line_num}: no sample in {row!r}"
+                ) from None
+            if len(chunk) == _TRACE_CHUNK_ROWS:
+                yield chunk
+                chunk = array("d")
+        yield chunk
+
+
+def _parquet_chunks(path: Path, column: any) -> Iterator[array]:
+    if parquet is None:
+        raise ImportError("pyarrow is required for the parquet profile source")
+    file = parquet.ParquetFile(path)
+    if not isinstance(column, str):
+        column = file.schema_arrow.names[-1 if column is None else column]
+    for batch in file.iter_batches(_TRACE_CHUNK_ROWS, columns=[column]):
+        yield array("d", batch.column(0).to_pylist())
+
+
+def load_trace(
+    source: str,
+    path: str | Path,
+    column: any = None,
+    cache_dir: Optional[str | Path] = None,
+) -> memoryview:
+    """
+    Returns the values of a measured trace, memory-mapped rather than loaded,
+    so that months of samples cost no more memory than the pages in use.
+
+    `npy` traces are mapped in place. `csv` and `parquet` traces are streamed
+    once, chunk by chunk, into a float64 cache in `cache_dir`, keyed by the
+    path, size and modification time of the trace, and mapped from there.
+    `column` is the name or index of the column, the last one by default,
+    except for `npy` traces, see `_map_npy`.
+    """
+    path = Path(path).resolve()
+    key = (path, column)
+    if key in _mapped_traces:
+        return _mapped_traces[key]
+    if source == "npy":
+        _mapped_traces[key] = _map_npy(path, column)
+        return _mapped_traces[key]
+    chunks = {"csv": _csv_chunks, "parquet": _parquet_chunks}[source]
+    stat = path.stat()
+    digest = hashlib.sha256(
+        f"{path}:{stat.st_size}:{stat.st_mtime_ns}:{column}".encode()
+    )
+    cache_dir = Path(cache_dir or Path(tempfile.gettempdir()) / "prosumer-traces")
+    cache_path = cache_dir / f"{digest.hexdigest()}.f64"
+    if not cache_path.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, "wb") as file:
+                for chunk in chunks(path, column):
+                    chunk.tofile(file)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        os.replace(tmp_path, cache_path)
+    _mapped_traces[key] = _map_file(cache_path, 0, "d")
+    return _mapped_traces[key]
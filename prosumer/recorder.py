@@ -0,0 +1,126 @@
+import os
+from array import array
+from pathlib import Path
+from typing import Callable, Mapping, Optional
+
+import numpy as np
+
+from prosumer.subsystems import InterconnectedSubsystem
+
+# Aggregate states recorded every tick, besides the power of each subsystem.
+RECORDED_STATES = (
+    "generation",
+    "consumption",
+    "storage",
+    "net_export",
+    "self_consumption",
+)
+
+
+def write_npy(path: Path, column: array) -> None:
+    """
+    Atomically writes a float64 array as a version 1.0 `.npy` file, which
+    `numpy.load(path, mmap_mode="r")` reads without copying.
+    """
+    header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({len(column)},), }}"
+    # Magic, version and header length take 10 bytes, and the whole header
+    # is padded with spaces to a multiple of 64 bytes, ending in a newline.
+    header += " " * (63 - (10 + len(header)) % 64) + "\n"
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(b"\x93NUMPY\x01\x00")
+        file.write(len(header).to_bytes(2, "little"))
+        file.write(header.encode("latin1"))
+        file.write(column.tobytes())
+    os.replace(tmp_path, path)
+
+
+class StateRecorder:
+    """
+    Records the states of every tick into preallocated columnar buffers, and
+    flushes them every `chunk_size` ticks to `<directory>/<column>/<chunk>.npy`,
+    so memory stays bounded by one chunk regardless of how long it runs.
+
+    Wraps the `set_states` of an `InterconnectedSubsystem`, forwarding the
+    states to `forward` after recording them. Once bound to the prosumer, the
+    power of each of its subsystems is recorded as `<entity>/<id>/power`.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        forward: Optional[Callable] = None,
+        chunk_size: int = 3600,
+    ) -> None:
+        self.directory = Path(directory)
+        self.forward = forward
+        self.chunk_size = chunk_size
+        self.prosumer: Optional[InterconnectedSubsystem] = None
+        self.columns: dict[str, array] = {}
+        self._subsystem_columns: list[tuple[array, any]] = []
+        self.rows = 0
+        self.chunk = 0
+
+    def bind(self, prosumer: InterconnectedSubsystem) -> None:
+        self.prosumer = prosumer
+
+    def _allocate_column(self, name: str) -> array:
+        self.columns[name] = array("d", [0.0]) * self.chunk_size
+        return self.columns[name]
+
+    def _allocate_columns(self) -> None:
+        for name in ("timestamp", *RECORDED_STATES):
+            self._allocate_column(name)
+        if self.prosumer is None:
+            return
+        for entity in ("generations", "consumptions", "storages"):
+            for subsystem in getattr(self.prosumer, entity):
+                column = self._allocate_column(f"{entity}/{subsystem.id_}/power")
+                self._subsystem_columns.append((column, subsystem))
+
+    def __call__(self, states: dict[str, any]) -> None:
+        if not self.columns:
+            self._allocate_columns()
+        row, columns = self.rows, self.columns
+        columns["timestamp"][row] = states["last_updated_at"].timestamp()
+        for state in RECORDED_STATES:
+            columns[state][row] = states[state]
+        for column, subsystem in self._subsystem_columns:
+            column[row] = getattr(subsystem, "power", 0.0)
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+        if self.forward is not None:
+            self.forward(states)
+
+    def record_over(self, columns: Mapping[str, np.ndarray]) -> None:
+        """
+        Records many ticks at once, given the values of every column over
+        them, such as those of a simulation. Unlike calling the recorder, the
+        states aren't forwarded.
+        """
+        if not self.columns:
+            self._allocate_columns()
+        ticks, done = len(columns["timestamp"]), 0
+        while done < ticks:
+            count = min(self.chunk_size - self.rows, ticks - done)
+            for name, column in self.columns.items():
+                rows = np.frombuffer(column)[self.rows : self.rows + count]
+                rows[:] = columns[name][done : done + count]
+            self.rows += count
+            done += count
+            if self.rows == self.chunk_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered rows as the next chunk, and reuses the buffers.
+        """
+        if not self.rows:
+            return
+        for name, column in self.columns.items():
+            path = self.directory / name / f"{self.chunk:06d}.npy"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_npy(path, column[: self.rows])
+        self.rows = 0
+        self.chunk += 1
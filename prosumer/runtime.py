@@ -0,0 +1,82 @@
+from typing import Optional
+
+from prosumer import api
+from prosumer.checkpoint import Checkpointer
+from prosumer.factory import build_prosumer, online_states, subsystems_of
+from prosumer.mqtt import AsyncProsumerMqttClient, ProsumerMqttClient
+from prosumer.recorder import StateRecorder
+from prosumer.subsystems import InterconnectedSubsystem
+
+
+class ProsumerRuntime:
+    """
+    Connects a single prosumer to the grid and runs its subsystems. Used by
+    both the Django app and the standalone `python -m prosumer run`. States
+    are only kept for the `api` when it's served, i.e. by Django.
+    """
+
+    def __init__(self, config: dict[str, any], serves_api: bool = False) -> None:
+        self.config = config
+        self.serves_api = serves_api
+        self.settings: dict[str, any] = config["settings"]
+        self.mqtt_client: Optional[ProsumerMqttClient | AsyncProsumerMqttClient] = None
+        self.recorder: Optional[StateRecorder] = None
+        self.snapshots: Optional[api.SnapshotCache] = None
+        self.checkpointer: Optional[Checkpointer] = None
+        self.master_subsystem: Optional[InterconnectedSubsystem] = None
+
+    def connect_to_grid(self) -> None:
+        transport = dict(self.config.get("mqtt_transport") or {})
+        client_class = {"paho": ProsumerMqttClient, "asyncio": AsyncProsumerMqttClient}[
+            transport.pop("type", "paho")
+        ]
+        self.mqtt_client = client_class(
+            vp_address=self.settings["vpAddress"],
+            server=self.settings["server"],
+            port=int(self.settings["mqttPort"]),
+            publishing=self.config.get("publishing"),
+            **transport,
+        )
+
+    def initialize_subsystems(self) -> None:
+        set_states = self.mqtt_client.publisher.publish_states
+        recording = self.config.get("recording")
+        if recording:
+            self.recorder = StateRecorder(forward=set_states, **recording)
+            set_states = self.recorder
+        # A bare `api:` turns it on with the defaults.
+        if "api" in self.config and self.serves_api:
+            api_config = self.config["api"] or {}
+            self.snapshots = api.SnapshotCache(forward=set_states, **api_config)
+            set_states = api.SNAPSHOTS = self.snapshots
+        # Started only once restored, so no tick runs on a half restored state.
+        self.master_subsystem = build_prosumer(
+            self.config, set_states, auto_start=False
+        )
+        if recording:
+            self.recorder.bind(self.master_subsystem)
+        checkpoint = self.config.get("checkpoint")
+        if checkpoint:
+            self.checkpointer = Checkpointer(self.master_subsystem, **checkpoint)
+            if self.checkpointer.restore():
+                print(f"Restored prosumer state from {self.checkpointer.path}")
+        for subsystem in subsystems_of(self.master_subsystem):
+            subsystem.start()
+        if self.checkpointer is not None:
+            self.checkpointer.start()
+
+    def start(self) -> None:
+        self.connect_to_grid()
+        self.mqtt_client.set_states(online_states(self.config))
+        self.initialize_subsystems()
+
+    def stop(self) -> None:
+        for subsystem in subsystems_of(self.master_subsystem):
+            subsystem.stop()
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+        if self.recorder is not None:
+            self.recorder.flush()
+        self.mqtt_client.set_state("isOnline", False)
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
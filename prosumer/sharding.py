@@ -0,0 +1,290 @@
+import multiprocessing
+import os
+from datetime import datetime
+from math import fsum
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from time import monotonic
+from typing import Callable, Optional
+
+from utils.clock import SimulationClock
+
+from prosumer.enums import ProsumerStatus
+from prosumer.factory import build_prosumer, subsystems_of
+from prosumer.profiles import ProfileEngine
+from prosumer.subsystems import SubsystemBase
+from prosumer.tariffs import TariffTable
+
+# Aggregate states of a prosumer that are shared with the coordinator, along
+# with their moving averages.
+SHARED_FIELDS = (
+    "generation",
+    "consumption",
+    "storage",
+    "self_consumption",
+    "net_export",
+    "export_price",
+)
+
+
+def shared_columns(config: dict[str, any]) -> tuple[str]:
+    """
+    Names of the states of a prosumer that are written to shared memory.
+    """
+    periods = [f"_{period}m" for period in config.get("moving_avg_periods", [])]
+    periods += [f"_ewma_{period}m" for period in config.get("ewma_periods", [])]
+    return tuple(
+        name
+        for field in SHARED_FIELDS
+        for name in (field, *(field + p for p in periods))
+    )
+
+
+class _SharedRowWriter:
+    """
+    `set_states` of a prosumer in a worker, writing to its row of the half of
+    the array that the tick is written to.
+    """
+
+    def __init__(self, values: memoryview, offset: int, columns: tuple[str]) -> None:
+        self.values = values
+        self.slots = tuple(enumerate(columns, offset))
+
+    def __call__(self, states: dict[str, any]) -> None:
+        values = self.values
+        for slot, column in self.slots:
+            values[slot] = states[column]
+
+
+def _run_shard(
+    memory_name: str,
+    rows: list[tuple[int, tuple[str], dict[str, any]]],
+    origin: datetime,
+    connection: Connection,
+) -> None:
+    """
+    Builds the prosumers of a shard, then steps them once per tick received
+    from the coordinator as (timestamp, half of the array to write), until it
+    sends `None`.
+    """
+    memory = shared_memory.SharedMemory(name=memory_name)
+    values = memory.buf.cast("d")
+    size = len(values) // 2
+    halves = (values[:size], values[size:])
+    clock = SimulationClock(origin)
+    engine, tariff_table = ProfileEngine(origin), TariffTable(origin)
+    subsystems: list[SubsystemBase] = []
+    writers: list[_SharedRowWriter] = []
+    for offset, columns, config in rows:
+        writers.append(_SharedRowWriter(halves[0], offset, columns))
+        prosumer = build_prosumer(
+            config,
+            writers[-1],
+            profile_engine=engine,
+            tariff_table=tariff_table,
+            clock=clock,
+            auto_start=False,
+        )
+        subsystems += subsystems_of(prosumer)
+    connection.send("ready")
+    try:
+        while (tick := connection.recv()) is not None:
+            timestamp, half = tick
+            for writer in writers:
+                writer.values = halves[half]
+            clock.instant = datetime.fromtimestamp(timestamp)
+            engine.step(clock.instant)
+            tariff_table.step(clock.instant)
+            for subsystem in subsystems:
+                subsystem.run()
+            connection.send(timestamp)
+    finally:
+        for half in halves:
+            half.release()
+        values.release()
+        memory.close()
+
+
+class _Worker:
+    __slots__ = ("process", "connection", "ready", "busy_since", "written")
+
+    def __init__(self, process, connection: Connection, written: int) -> None:
+        self.process = process
+        self.connection = connection
+        self.ready = False
+        # When the tick the worker is stepping was sent, if any.
+        self.busy_since: Optional[float] = None
+        # Half of the array holding the last tick the worker finished. The
+        # tick it's stepping, if any, is written to the other.
+        self.written = written
+
+
+class ShardedFleet:
+    """
+    Steps many prosumers in a pool of worker processes, so that the fleet is
+    simulated on every core rather than one.
+
+    Prosumers are dealt round robin into one shard per worker, and each worker
+    writes the `shared_columns` of its prosumers into a single float64 array
+    in shared memory. The coordinator ticks the workers, then reads the array
+    back to total the fleet and to hand every prosumer's states to its
+    `set_states`, e.g. a `ProsumerPublisher.publish_states`. Only the
+    aggregate states of each prosumer are shared, not those of its
+    subsystems.
+
+    The array is double buffered: each worker writes a tick to one half while
+    the coordinator reads its prosumers' rows of the tick before from the
+    other. A tick waits at most `tick_timeout` seconds for the workers. A
+    worker that hasn't finished by then is skipped until it has, rather than
+    holding up the tick, and its prosumers keep the states of the last tick
+    it finished rather than a half written row. One that crashed, or is still
+    busy after `restart_after` seconds, is replaced. Its prosumers keep their last states until the new
+    worker has built them again from their config, losing their moving
+    averages and storage state of charge.
+    """
+
+    def __init__(
+        self,
+        configs: list[dict[str, any]],
+        workers: Optional[int] = None,
+        set_states: Optional[list[Callable]] = None,
+        tick_timeout: float = 0.8 * SubsystemBase.run_interval,
+        restart_after: float = 10 * SubsystemBase.run_interval,
+        origin: Optional[datetime] = None,
+    ) -> None:
+        self.configs = configs
+        self.set_states = set_states
+        self.tick_timeout = tick_timeout
+        self.restart_after = restart_after
+        self.origin = ProfileEngine(origin).origin
+        self.columns = [shared_columns(config) for config in configs]
+        self.offsets, size = [], 0
+        for columns in self.columns:
+            self.offsets.append(size)
+            size += len(columns)
+        self.size = max(size, 1)
+        self.memory = shared_memory.SharedMemory(create=True, size=16 * self.size)
+        self.values = self.memory.buf.cast("d")
+        workers = max(1, min(workers or os.cpu_count() or 1, len(configs)))
+        self.shards = [range(shard, len(configs), workers) for shard in range(workers)]
+        self._shard_of = [i % workers for i in range(len(configs))]
+        self.totals = dict.fromkeys(SHARED_FIELDS, 0.0)
+        self.restarts = 0
+        self._slots = {
+            field: [
+                offset + columns.index(field)
+                for offset, columns in zip(self.offsets, self.columns)
+            ]
+            for field in SHARED_FIELDS
+        }
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[Optional[_Worker]] = [None] * workers
+
+    def _spawn(self, shard: int, written: int = 0) -> None:
+        rows = [
+            (self.offsets[i], self.columns[i], self.configs[i])
+            for i in self.shards[shard]
+        ]
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_shard,
+            args=(self.memory.name, rows, self.origin, child_connection),
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        self._workers[shard] = _Worker(process, connection, written)
+
+    def _restart(self, shard: int) -> None:
+        worker = self._workers[shard]
+        print(f"Restarting shard {shard} worker (exit code {worker.process.exitcode})")
+        worker.process.kill()
+        worker.process.join()
+        worker.connection.close()
+        self.restarts += 1
+        self._spawn(shard, worker.written)
+
+    def start(self, timeout: Optional[float] = None) -> None:
+        """
+        Starts the workers, and waits until they've built their prosumers.
+        """
+        for shard in range(len(self.shards)):
+            self._spawn(shard)
+        for worker in self._workers:
+            self._collect(worker, timeout)
+
+    def _collect(self, worker: _Worker, timeout: float = 0) -> None:
+        # Raises EOFError or OSError if the worker died.
+        if not worker.connection.poll(timeout):
+            return
+        message = worker.connection.recv()
+        if worker.ready:
+            worker.busy_since = None
+            worker.written = 1 - worker.written
+        else:
+            worker.ready = message == "ready"
+
+    def tick(self, instant: Optional[datetime] = None) -> dict[str, float]:
+        """
+        Steps every prosumer to `instant`, publishes their states, and returns
+        the totals of the fleet.
+        """
+        instant = instant or datetime.now()
+        now = monotonic()
+        for shard, worker in enumerate(self._workers):
+            try:
+                self._collect(worker)
+                if worker.busy_since is not None:
+                    if now - worker.busy_since > self.restart_after:
+                        self._restart(shard)
+                elif worker.ready:
+                    worker.connection.send((instant.timestamp(), 1 - worker.written))
+                    worker.busy_since = now
+                elif not worker.process.is_alive():
+                    self._restart(shard)
+            except (EOFError, OSError):
+                self._restart(shard)
+        deadline = now + self.tick_timeout
+        for shard, worker in enumerate(self._workers):
+            try:
+                if worker.busy_since is not None:
+                    self._collect(worker, max(deadline - monotonic(), 0))
+            except (EOFError, OSError):
+                self._restart(shard)
+        return self._aggregate(instant)
+
+    def _aggregate(self, instant: datetime) -> dict[str, float]:
+        values = self.values
+        # Start of the half holding the last finished tick of each prosumer.
+        written = [self.size * worker.written for worker in self._workers]
+        starts = [written[shard] for shard in self._shard_of]
+        for field, slots in self._slots.items():
+            self.totals[field] = fsum(
+                values[start + slot] for start, slot in zip(starts, slots)
+            )
+        if self.set_states is not None:
+            for start, offset, columns, set_states in zip(
+                starts, self.offsets, self.columns, self.set_states
+            ):
+                offset += start
+                states = dict(zip(columns, values[offset : offset + len(columns)]))
+                states["status"] = ProsumerStatus.of(states["net_export"]).value
+                states["last_updated_at"] = instant
+                set_states(states)
+        return self.totals
+
+    def stop(self) -> None:
+        for worker in self._workers:
+            if worker is None:
+                continue
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+            worker.connection.close()
+        self.values.release()
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,222 @@
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import IO, Callable, Optional
+
+import numpy as np
+from utils.clock import SimulationClock
+
+from prosumer.enums import ProsumerStatus
+from prosumer.factory import build_prosumer
+from prosumer.mqtt import SNAPSHOT_SERIALIZERS
+from prosumer.recorder import StateRecorder
+from prosumer.subsystems import InterconnectedSubsystem, SubsystemBase
+
+# Ticks simulated at once, as arrays.
+_BLOCK_TICKS = 3600
+
+# Statuses by the sign of the net export.
+_STATUSES = np.array(
+    [
+        ProsumerStatus.IMPORT.value,
+        ProsumerStatus.SELF_SUSTAIN.value,
+        ProsumerStatus.EXPORT.value,
+    ],
+    dtype=object,
+)
+
+# Aggregate states of the prosumer, in the order of its `get_states`.
+_AGGREGATE_STATES = (
+    "generation",
+    "consumption",
+    "storage",
+    "self_consumption",
+    "net_export",
+)
+
+
+class JsonLinesWriter:
+    """
+    Writes the states of every `every`th tick as a line of JSON, serialized
+    the same way as published snapshots.
+    """
+
+    def __init__(self, file: IO[str], every: int = 1) -> None:
+        self.file = file
+        self.every = max(1, every)
+        self.ticks = 0
+        self.serialize = SNAPSHOT_SERIALIZERS["json"]()
+
+    def __call__(self, states: dict[str, any]) -> None:
+        if self.ticks % self.every == 0:
+            self.file.write(self.serialize(states).decode())
+            self.file.write("\n")
+        self.ticks += 1
+
+
+def _total(series: list[np.ndarray], ticks: int) -> np.ndarray:
+    return np.sum(series, axis=0) if series else np.zeros(ticks)
+
+
+def _simulate_block(
+    prosumer: InterconnectedSubsystem,
+    start: datetime,
+    seconds: np.ndarray,
+    handed: np.ndarray,
+    set_states: Callable,
+    recorder: Optional[StateRecorder],
+) -> None:
+    """
+    Simulates the ticks at each of the `seconds` after `start` at once, then
+    hands the states of the `handed` ticks of the block to `set_states` in
+    turn, and records every tick with the `recorder` if given.
+    """
+    ticks = len(seconds)
+    profiled = (*prosumer.generations, *prosumer.consumptions)
+    power = {subsystem: subsystem.values_at(start, seconds) for subsystem in profiled}
+    generation = _total([power[s] for s in prosumer.generations], ticks)
+    consumption = _total([power[s] for s in prosumer.consumptions], ticks)
+    export_price = prosumer.tariff_table.prices_at(prosumer.tariff_row, start, seconds)
+    storage_power, state_of_charge = prosumer.dispatch_storages_over(
+        generation, consumption, export_price
+    )
+    storage = _total(list(storage_power), ticks)
+    self_consumption = np.minimum(
+        generation + np.maximum(storage, 0), consumption + np.maximum(-storage, 0)
+    )
+    aggregates = dict(
+        zip(
+            _AGGREGATE_STATES,
+            (
+                generation,
+                consumption,
+                storage,
+                self_consumption,
+                generation - consumption + storage,
+            ),
+        )
+    )
+    for subsystem in profiled:
+        subsystem.power = float(power[subsystem][-1])
+    for state in ("generation", "consumption", "storage"):
+        setattr(prosumer, state, float(aggregates[state][-1]))
+
+    # Names of the states of every subsystem, and their values per tick.
+    states_of = {
+        subsystem: subsystem.update_timeseries_fields_over({"power": power[subsystem]})
+        for subsystem in profiled
+    }
+    for i, storage_system in enumerate(prosumer.storages):
+        states_of[storage_system] = storage_system.update_timeseries_fields_over(
+            {"power": storage_power[i], "state_of_charge": state_of_charge[i]}
+        )
+    names, averages = prosumer.update_timeseries_fields_over(
+        {**aggregates, "export_price": export_price}
+    )
+    # The fields themselves were already added with the aggregates.
+    kept = [i for i, name in enumerate(names) if name not in prosumer.timeseries_fields]
+
+    if recorder is not None:
+        columns = {"timestamp": start.timestamp() + seconds, **aggregates}
+        power.update(zip(prosumer.storages, storage_power))
+        columns.update(
+            (f"{entity}/{subsystem.id_}/power", power[subsystem])
+            for entity in ("generations", "consumptions", "storages")
+            for subsystem in getattr(prosumer, entity)
+        )
+        recorder.record_over(columns)
+
+    # The states of every handed tick, as one row of the table per tick.
+    keys, columns = [], []
+    for kind, entity in (
+        ("generation", "generations"),
+        ("consumption", "consumptions"),
+        ("storage", "storages"),
+    ):
+        if kind not in prosumer.subsystem_reporting:
+            continue
+        subsystems = getattr(prosumer, entity)
+        ids = [subsystem.id_ for subsystem in subsystems]
+        per_tick = zip(
+            *(
+                [
+                    dict(zip(states_of[s][0], row))
+                    for row in states_of[s][1][handed].tolist()
+                ]
+                for s in subsystems
+            )
+        )
+        keys.append(entity)
+        columns.append(
+            [dict(zip(ids, states)) for states in per_tick] or [{}] * len(handed)
+        )
+    net_export = aggregates["net_export"][handed]
+    keys += [*_AGGREGATE_STATES, "status", "export_price", "last_updated_at"]
+    columns += [values[handed] for values in aggregates.values()]
+    # A NaN net export has no sign, and is self sustaining like `ProsumerStatus.of`
+    # calls it.
+    signs = np.nan_to_num(np.sign(net_export)).astype(np.intp)
+    columns.append(_STATUSES[signs + 1])
+    columns.append(export_price[handed])
+    columns.append(
+        [start + timedelta(seconds=offset) for offset in seconds[handed].tolist()]
+    )
+    keys += [names[i] for i in kept]
+    columns += list(averages[handed][:, kept].T)
+    table = np.empty((len(handed), len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        table[:, i] = column
+    for row in table.tolist():
+        set_states(dict(zip(keys, row)))
+
+
+def simulate(
+    config: dict[str, any],
+    start: datetime,
+    end: datetime,
+    set_states: Callable,
+    recorder: Optional[StateRecorder] = None,
+    every: int = 1,
+    **kwargs,
+) -> dict[str, float]:
+    """
+    Simulates the prosumer described by `config` from `start` until `end`, as
+    fast as possible. The states of every `every`th tick are handed to
+    `set_states` instead of being published, and every tick is recorded by the
+    `recorder` if given.
+
+    Rather than running every subsystem tick by tick, the power of profiled
+    subsystems, the aggregates and the moving averages of `_BLOCK_TICKS` ticks
+    are computed at once as arrays, and only storages are dispatched tick by
+    tick, since their state of charge depends on every tick before. The states
+    are those the prosumer would publish running in real time.
+
+    Returns the number of ticks simulated and the rate they were simulated at.
+    """
+    clock, every = SimulationClock(start), max(1, every)
+    prosumer = build_prosumer(
+        config, set_states, clock=clock, auto_start=False, **kwargs
+    )
+    if recorder is not None:
+        recorder.bind(prosumer)
+    interval = SubsystemBase.run_interval
+    ticks = int((end - start).total_seconds() // interval)
+    started_at = perf_counter()
+    for first in range(0, ticks, _BLOCK_TICKS):
+        block = np.arange(first, min(first + _BLOCK_TICKS, ticks))
+        _simulate_block(
+            prosumer,
+            start,
+            (block + 1) * interval,
+            np.flatnonzero(block % every == 0),
+            set_states,
+            recorder,
+        )
+    clock.advance(ticks * interval)
+    if recorder is not None:
+        recorder.flush()
+    elapsed = perf_counter() - started_at
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "ticks_per_second": ticks / elapsed if elapsed else float("inf"),
+    }
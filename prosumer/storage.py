@@ -0,0 +1,284 @@
+from typing import Sequence
+
+import numpy as np
+
+# Fewest storages stepped as arrays, below which numpy's overhead per call
+# outweighs stepping them one by one.
+_VECTORIZED_FROM = 16
+
+
+class StorageFleet:
+    """
+    State of charge of many storage systems, kept in flat arrays and stepped
+    together in one call per tick.
+
+    Power is in kW, positive when discharging into the prosumer and negative
+    when charging. State of charge is in kWh, bounded by the usable capacity.
+    """
+
+    def __init__(self) -> None:
+        # One row per array, of columns allocated for the storages, doubled
+        # when full. The arrays are views of their row.
+        self._rows = np.zeros((7, 0))
+        self._view(0)
+
+    def _view(self, size: int) -> None:
+        (
+            self.state_of_charge,
+            self.usable_capacity,
+            self.max_charge_rate,
+            self.max_discharge_rate,
+            self.charge_efficiency,
+            self.discharge_efficiency,
+            self.power,
+        ) = self._rows[:, :size]
+
+    def __len__(self) -> int:
+        return len(self.power)
+
+    def add(
+        self,
+        usable_capacity: float,
+        max_charge_rate: float,
+        max_discharge_rate: float,
+        charge_efficiency: float,
+        discharge_efficiency: float,
+        state_of_charge: float,
+    ) -> int:
+        """
+        Adds a storage system to the fleet, and returns its row index.
+        """
+        row = len(self.power)
+        if row == self._rows.shape[1]:
+            rows = np.zeros((len(self._rows), max(64, 2 * row)))
+            rows[:, :row] = self._rows[:, :row]
+            self._rows = rows
+        self._rows[:, row] = (
+            min(max(state_of_charge, 0), usable_capacity),
+            usable_capacity,
+            max_charge_rate,
+            max_discharge_rate,
+            charge_efficiency,
+            discharge_efficiency,
+            0.0,
+        )
+        self._view(row + 1)
+        return row
+
+    def step(
+        self, requested: Sequence[float], hours: float, start: int = 0
+    ) -> np.ndarray:
+        """
+        Charges or discharges the storages from row `start` onwards with the
+        requested power for `hours`, limited by their rates and state of
+        charge. Returns the power actually delivered by every storage.
+        """
+        if len(requested) < _VECTORIZED_FROM:
+            self._step_each(requested, hours, start)
+            return self.power
+        requested = np.asarray(requested, dtype=float)
+        soc, power = self.state_of_charge, self.power
+        power[start : start + len(requested)] = 0.0
+        discharging = np.flatnonzero(requested > 0)
+        rows = discharging + start
+        discharge_eff = self.discharge_efficiency[rows]
+        delivered = np.minimum(
+            np.minimum(requested[discharging], self.max_discharge_rate[rows]),
+            soc[rows] * discharge_eff / hours,
+        )
+        soc[rows] = np.maximum(soc[rows] - delivered * hours / discharge_eff, 0.0)
+        power[rows] = delivered
+        charging = np.flatnonzero(requested < 0)
+        rows = charging + start
+        charge_eff, usable = self.charge_efficiency[rows], self.usable_capacity[rows]
+        delivered = -np.minimum(
+            np.minimum(-requested[charging], self.max_charge_rate[rows]),
+            (usable - soc[rows]) / (charge_eff * hours),
+        )
+        soc[rows] = np.minimum(soc[rows] - delivered * hours * charge_eff, usable)
+        power[rows] = delivered
+        return power
+
+    def _step_each(self, requested: Sequence[float], hours: float, start: int) -> None:
+        # Same as `step`, one storage at a time.
+        rows = self._rows[:, start : start + len(requested)]
+        for i, (request, row) in enumerate(zip(requested, rows.T.tolist())):
+            soc, usable, max_charge, max_discharge, charge_eff, discharge_eff, _ = row
+            if request > 0:
+                delivered = min(request, max_discharge, soc * discharge_eff / hours)
+                rows[0, i] = max(soc - delivered * hours / discharge_eff, 0.0)
+            elif request < 0:
+                delivered = -min(
+                    -request, max_charge, (usable - soc) / (charge_eff * hours)
+                )
+                rows[0, i] = min(soc - delivered * hours * charge_eff, usable)
+            else:
+                delivered = 0.0
+            rows[6, i] = delivered
+
+    def step_over(
+        self, requested: np.ndarray, hours: float, start: int = 0
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as `step`, at each of many ticks in turn, given the power
+        requested from the storages from row `start` onwards at every tick
+        (storages x ticks). Returns the power delivered by every storage and its
+        state of charge after each tick. Storages don't depend on each other,
+        so each one is stepped through all the ticks before the next.
+        """
+        power = np.zeros(np.shape(requested))
+        state_of_charge = np.empty_like(power)
+        for i, requests in enumerate(np.asarray(requested).tolist(), start):
+            (
+                soc,
+                usable,
+                max_charge,
+                max_discharge,
+                charge_eff,
+                discharge_eff,
+                _,
+            ) = self._rows[:, i].tolist()
+            delivered_row, soc_row = [], []
+            delivered = 0.0
+            for request in requests:
+                if request > 0:
+                    delivered = min(request, max_discharge, soc * discharge_eff / hours)
+                    soc = max(soc - delivered * hours / discharge_eff, 0.0)
+                elif request < 0:
+                    delivered = -min(
+                        -request, max_charge, (usable - soc) / (charge_eff * hours)
+                    )
+                    soc = min(soc - delivered * hours * charge_eff, usable)
+                else:
+                    delivered = 0.0
+                delivered_row.append(delivered)
+                soc_row.append(soc)
+            self.state_of_charge[i], self.power[i] = soc, delivered
+            power[i - start] = delivered_row
+            state_of_charge[i - start] = soc_row
+        return power, state_of_charge
+
+
+class SelfConsumptionFirst:
+    """
+    Charges from surplus generation and discharges to cover any deficit, so
+    that as little as possible is imported or exported.
+    """
+
+    def request(self, net_export: float, export_price: float) -> float:
+        return -net_export
+
+    def request_over(
+        self, net_export: np.ndarray, export_price: np.ndarray
+    ) -> np.ndarray:
+        "Same as `request`, for many ticks at once."
+        return -net_export
+
+
+class PriceAware(SelfConsumptionFirst):
+    """
+    Like `SelfConsumptionFirst`, but exports surplus generation instead of
+    storing it when the export price is at least `export_above`, and also
+    discharges into the grid at full rate when it is at least
+    `discharge_above`.
+    """
+
+    def __init__(
+        self, export_above: float = float("inf"), discharge_above: float = float("inf")
+    ) -> None:
+        self.export_above = export_above
+        self.discharge_above = discharge_above
+
+    def request(self, net_export: float, export_price: float) -> float:
+        if export_price >= self.discharge_above:
+            return float("inf")
+        if net_export > 0 and export_price >= self.export_above:
+            return 0.0
+        return -net_export
+
+    def request_over(
+        self, net_export: np.ndarray, export_price: np.ndarray
+    ) -> np.ndarray:
+        "Same as `request`, for many ticks at once."
+        requests = np.where(
+            (net_export > 0) & (export_price >= self.export_above), 0.0, -net_export
+        )
+        requests[export_price >= self.discharge_above] = float("inf")
+        return requests
+
+
+DISPATCH_POLICIES = {
+    "self_consumption": SelfConsumptionFirst,
+    "price_aware": PriceAware,
+}
+
+
+def dispatch_policy_from_config(config: dict[str, any] | None):
+    config = dict(config or {})
+    return DISPATCH_POLICIES[config.pop("policy", "self_consumption")](**config)
+
+
+class StorageDispatch:
+    """
+    The dispatch policies of many prosumers sharing a `StorageFleet`, which
+    request power from every storage of theirs at once. Requests are split
+    between the storages of a prosumer in proportion to their rates, as
+    `InterconnectedSubsystem.request_storages` does.
+    """
+
+    def __init__(self, prosumers: Sequence) -> None:
+        rows, owners, charge_rates, discharge_rates = [], [], [], []
+        policies: dict[tuple, tuple[any, list[int]]] = {}
+        for owner, prosumer in enumerate(prosumers):
+            for storage in prosumer.storages:
+                rows.append(storage.fleet_row)
+                owners.append(owner)
+                charge_rates.append(storage.max_charge_rate)
+                discharge_rates.append(storage.max_discharge_rate)
+            policy = prosumer.dispatch_policy
+            key = (type(policy), tuple(sorted(vars(policy).items())))
+            policies.setdefault(key, (policy, []))[1].append(owner)
+        self.size = len(prosumers)
+        # Fleet row and owning prosumer of every storage.
+        self.rows = np.array(rows, dtype=np.intp)
+        self.owners = np.array(owners, dtype=np.intp)
+        self._policies = [
+            (policy, np.array(owners, dtype=np.intp))
+            for policy, owners in policies.values()
+        ]
+        totals, shares = [], []
+        for rates in (np.array(charge_rates), np.array(discharge_rates)):
+            total = np.bincount(self.owners, rates, self.size)
+            owned = total[self.owners]
+            totals.append(total)
+            shares.append(
+                np.divide(rates, owned, out=np.zeros(len(rates)), where=owned != 0)
+            )
+        self._rate_bounds = (-totals[0], totals[1])
+        self._charge_shares, self._discharge_shares = shares
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def request(self, net_export: np.ndarray, export_price: np.ndarray) -> np.ndarray:
+        """
+        Returns the power requested from every storage, by index in `rows`,
+        given the net export and export price of every prosumer. Both may have
+        more axes after the prosumers', e.g. for the members of an ensemble,
+        which the requests then have after the storages'.
+        """
+        request = np.empty(np.shape(net_export))
+        for policy, owners in self._policies:
+            request[owners] = policy.request_over(
+                net_export[owners], export_price[owners]
+            )
+        # Per prosumer and per storage arrays, broadcast over the other axes.
+        axes = (-1,) + (1,) * (request.ndim - 1)
+        low, high = self._rate_bounds
+        np.clip(request, low.reshape(axes), high.reshape(axes), out=request)
+        request = request[self.owners]
+        return request * np.where(
+            request > 0,
+            self._discharge_shares.reshape(axes),
+            self._charge_shares.reshape(axes),
+        )
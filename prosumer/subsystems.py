@@ -1,15 +1,43 @@
+from array import array
 from datetime import datetime
-from functools import cached_property, reduce
-from random import uniform
-from typing import Callable, Final, Optional
+from math import fsum
+from time import perf_counter
+from typing import Callable, Final, Mapping, Optional, Sequence
 
-from utils.decorators import setInterval
+import numpy as np
+from utils.clock import WALL_CLOCK, Clock
 from utils.interpolate import Curves, remap
+from utils.metrics import REGISTRY, Counter, Histogram
 from utils.mixins import states_setter
-from utils.utils import Base
+from utils.rolling import MovingAverages, RollingAverages
+from utils.scheduler import ScheduledJob, TickScheduler, get_default_scheduler
+from utils.utils import MEASURED_SOURCES, Base
 
 from prosumer.enums import ProsumerStatus
 from prosumer.mixins import SupportsExport
+from prosumer.profiles import (
+    ProfileEngine,
+    compile_lookup_table,
+    draw_profile,
+    interpolate_profile,
+    load_lookup_table,
+    load_trace,
+)
+from prosumer.storage import StorageFleet, dispatch_policy_from_config
+from prosumer.tariffs import TariffTable
+
+PHASE_SECONDS = REGISTRY.register(
+    Histogram(
+        "prosumer_subsystem_phase_seconds",
+        "Duration of each phase of a subsystem tick, by subsystem class.",
+    )
+)
+IDLE_TICKS = REGISTRY.register(
+    Counter(
+        "prosumer_idle_ticks_total",
+        "Ticks skipped by subsystems whose states couldn't change.",
+    )
+).labels()
 
 
 class SubsystemBase(Base):
@@ -18,17 +46,46 @@ class SubsystemBase(Base):
     """
 
     run_interval = 1
+    run_priority = 0
     auto_start = True
     timeseries_fields: tuple[str] = ()
     moving_avg_periods: tuple[int] = ()
+    ewma_periods: tuple[int] = ()
+    # Longest moving average, in minutes, that's computed from every sample.
+    # Longer ones are computed from 1 and 15 minute buckets.
+    moving_avg_exact_limit = 60
     auto_invoke_get_states = False
+    # Whether the subsystem sleeps through ticks that can't change its states.
+    idle_skipping = True
 
     def __init__(self, **kwargs) -> None:
         self.id_ = str(kwargs.pop("id"))
         self.auto_start = bool(kwargs.pop("auto_start", SubsystemBase.auto_start))
         self.asset_value: Optional[float] = kwargs.pop("asset_value", None)
-        self.runner: any = None
+        self.scheduler: TickScheduler = (
+            kwargs.pop("scheduler", None) or get_default_scheduler()
+        )
+        self.runner: Optional[ScheduledJob] = None
+        self.clock: Clock = kwargs.pop("clock", WALL_CLOCK)
+        self.started_at = self.clock.now()
+        self._phase_seconds = tuple(
+            PHASE_SECONDS.labels(subsystem=type(self).__name__, phase=phase)
+            for phase in ("on_run", "update_timeseries_fields", "get_states")
+        )
         self.moving_avg_periods = tuple(kwargs.pop("moving_avg_periods", []))
+        self.ewma_periods = tuple(kwargs.pop("ewma_periods", []))
+        self.moving_avg_exact_limit = kwargs.pop(
+            "moving_avg_exact_limit", SubsystemBase.moving_avg_exact_limit
+        )
+        self.idle_skipping = kwargs.pop("idle_skipping", SubsystemBase.idle_skipping)
+        # Ticks left to sleep through, when run other than by the scheduler.
+        self._idle_ticks = 0
+        self.rolling_averages: dict[str, RollingAverages | MovingAverages] = {}
+        self._timeseries_values: dict[str, float] = {}
+        # Called with the subsystem after a tick that changed its states.
+        self.on_change: Optional[Callable[[SubsystemBase], None]] = None
+        for field in self.timeseries_fields:
+            self._init_rolling_averages(field)
 
         super().__init__(**kwargs)
 
@@ -42,65 +99,160 @@ class SubsystemBase(Base):
         """
         if getattr(self, "runner", False):
             return
-        self.started_at = datetime.now()
-        self.runner = self.run()
+        self.started_at = self.clock.now()
+        self.runner = self.scheduler.schedule(
+            self.run, self.run_interval, self.run_priority
+        )
 
     def stop(self):
         """
         Stops running the subsystem, and clears the runner.
         """
-        self.runner.stop()
+        if self.runner is not None:
+            self.runner.stop()
         self.runner = None
 
-    @setInterval(run_interval)
     def run(self):
         """
         The function that executes every `run_interval` seconds once the
-        subsystem is running.
+        subsystem is running. Subsystems due at the same tick run in ascending
+        `run_priority`.
         """
+        if self._idle_ticks:
+            self._idle_ticks -= 1
+            return
+        on_run_seconds, update_seconds, get_states_seconds = self._phase_seconds
+        started_at = perf_counter()
         self.on_run()
-        self.update_timeseries_fields()
+        ran_at = perf_counter()
+        changed = self.update_timeseries_fields()
+        updated_at = perf_counter()
+        on_run_seconds.observe(ran_at - started_at)
+        update_seconds.observe(updated_at - ran_at)
+        if changed:
+            on_change = self.on_change
+            if on_change is not None:
+                on_change(self)
+        elif self.idle_skipping:
+            self._sleep(self.idle_ticks())
         if self.auto_invoke_get_states:
             self.get_states()
+            get_states_seconds.observe(perf_counter() - updated_at)
 
     def on_run(self):
         raise NotImplementedError("run")
 
-    def _ensure_timeseries_samples_fields_initialized(self):
-        # Initialize if does not exists...
-        # TODO: improve this checking logic...
-        # TODO: This heavy one time operation is being run unnecessarily every run_interval!
-        for period in self.moving_avg_periods:
-            for field in self.timeseries_fields:
-                key = f"{field}_{period}m_samples"
-                if key not in self.__dict__.keys():
-                    setattr(self, key, [])
-
-    def update_timeseries_fields(self):
-        self._ensure_timeseries_samples_fields_initialized()
-        for period in self.moving_avg_periods:
-            for field in self.timeseries_fields:
-                key = f"{field}_{period}m"
-                present_value = getattr(self, field)
-                max_samples = period * 60 // self.run_interval
-                samples = list(getattr(self, key + "_samples"))
-                samples.insert(0, present_value)
-                if len(samples) == max_samples:
-                    samples.pop()
-                setattr(self, key + "_samples", samples)
-                setattr(self, key, sum(samples) / len(samples))
+    def idle_ticks(self) -> int:
+        """
+        Number of upcoming ticks that can't change the states of the subsystem,
+        which it may sleep through.
+        """
+        return 0
+
+    def _sleep(self, ticks: int):
+        if ticks <= 0:
+            return
+        # The averages already settled, so they're advanced in one step rather
+        # than replayed on waking up.
+        for field in self.timeseries_fields:
+            self.rolling_averages[field].advance(getattr(self, field), ticks)
+        if self.runner is not None:
+            self.runner.sleep(ticks)
+        else:
+            self._idle_ticks = ticks
+        IDLE_TICKS.inc(ticks)
+
+    def _init_rolling_averages(self, field: str):
+        windows = {
+            f"{field}_{period}m": period * 60 // self.run_interval
+            for period in self.moving_avg_periods
+        }
+        ewma = {
+            f"{field}_ewma_{period}m": period * 60 // self.run_interval
+            for period in self.ewma_periods
+        }
+        exact_limit = self.moving_avg_exact_limit * 60 // self.run_interval
+        if not ewma and max(windows.values(), default=0) <= exact_limit:
+            self.rolling_averages[field] = RollingAverages(windows)
+            return
+        bucket_sizes = (
+            max(1, 60 // self.run_interval),
+            max(1, 900 // self.run_interval),
+        )
+        self.rolling_averages[field] = MovingAverages(
+            windows, ewma, exact_limit, bucket_sizes
+        )
+
+    def save_state(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        """
+        Adds the state of the subsystem to a checkpoint, under `prefix`.
+        """
+        meta[prefix + "values"] = self._timeseries_values
+        for field in self.timeseries_fields:
+            averages = self.rolling_averages[field]
+            meta[f"{prefix}{field}.labels"] = list(averages.as_dict())
+            averages.save(f"{prefix}{field}.", arrays, meta)
+
+    def restore_state(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        """
+        Restores the state saved under `prefix`. The moving averages of a field
+        that were saved with other periods start over instead.
+        """
+        self._timeseries_values.update(meta.get(prefix + "values", {}))
+        for field in self.timeseries_fields:
+            averages = self.rolling_averages[field]
+            try:
+                if meta.get(f"{prefix}{field}.labels") != list(averages.as_dict()):
+                    raise ValueError(field)
+                averages.restore(f"{prefix}{field}.", arrays, meta)
+            except (KeyError, ValueError, TypeError):
+                print(f"Not restoring the {field} averages of {prefix}: changed")
+                self._init_rolling_averages(field)
+
+    def update_timeseries_fields(self) -> bool:
+        """
+        Pushes the present value of every timeseries field into its moving
+        averages. Returns whether any value or average changed since the
+        previous tick, i.e. whether `get_states` would return anything new.
+        """
+        values, changed = self._timeseries_values, False
+        for field in self.timeseries_fields:
+            value = getattr(self, field)
+            if self.rolling_averages[field].push(value) or values.get(field) != value:
+                values[field], changed = value, True
+        return changed
+
+    def update_timeseries_fields_over(
+        self, values: Mapping[str, np.ndarray]
+    ) -> tuple[list[str], np.ndarray]:
+        """
+        Pushes the values of every timeseries field over many ticks into its
+        moving averages at once, as `update_timeseries_fields` would tick by
+        tick. Returns the names of the states `get_states` returns, and their
+        values after every tick (ticks x states).
+        """
+        names, columns = [], []
+        for field in self.timeseries_fields:
+            series = np.asarray(values[field], dtype=float)
+            averages = self.rolling_averages[field]
+            names += [field, *averages.as_dict()]
+            columns += [series[:, None], averages.push_many(series)]
+            if len(series):
+                self._timeseries_values[field] = float(series[-1])
+        return names, np.hstack(columns)
 
     def register_timeseries_fields(self, *args):
+        # Fields registered by subclasses before `SubsystemBase.__init__` get
+        # their rolling averages once `moving_avg_periods` is known.
+        if "rolling_averages" in self.__dict__:
+            for field in args:
+                self._init_rolling_averages(field)
         self.timeseries_fields += tuple([*args])
 
     def _get_timeseries_field_values(self, field: str):
         if field not in self.timeseries_fields:
             raise KeyError(field)
-        field_values = {}
-        for period in self.moving_avg_periods:
-            key = f"{field}_{period}m"
-            field_values.update({key: getattr(self, key)})
-        return field_values
+        return self.rolling_averages[field].as_dict()
 
     def get_states(self) -> dict[str, any]:
         states = {}
@@ -122,42 +274,193 @@ class SubsystemWithProfile(SubsystemBase):
 
     profile_interval: int
     profile_base_multiplier_field_name: str
+    # Midnight the profile started at, once first read or restored.
+    _date_started_at: Optional[datetime] = None
 
     def __init__(self, **kwargs) -> None:
         self.profile: dict = kwargs.pop("profile")
+        self.profile_engine: Optional[ProfileEngine] = kwargs.pop(
+            "profile_engine", None
+        )
+        self.lookup_table_dir = kwargs.pop("lookup_table_dir", None)
         self.power = 0.0
+        # Eases between slots, except for measured traces which are sampled.
+        self.profile_curve = Curves.sine
         super().__init__(**kwargs)
+        self.trace_cache_dir = self.lookup_table_dir
         self.compiled_profile = self.generate_profile()
+        if self.profile["source"] in MEASURED_SOURCES:
+            # Traces are already sampled, and too long to copy into the engine.
+            self.profile_engine, self.lookup_table_dir = None, None
+            self.profile_curve = Curves.linear
+        if self.profile_engine is not None:
+            self.profile_row = self.profile_engine.register(
+                self.compiled_profile, self.profile_interval
+            )
+        self.lookup_table: Optional[Sequence[float]] = None
+        self._load_lookup_table()
+
+    def _load_lookup_table(self):
+        # The profiles of the engine aren't looked up at all.
+        if self.lookup_table_dir is None or self.profile_engine is not None:
+            return
+        if self.profile.get("seed") is None:
+            # Its table would never be looked up again once the process exits,
+            # so it's compiled in memory rather than cached.
+            self.lookup_table = compile_lookup_table(
+                self.compiled_profile, self.profile_interval, self.run_interval
+            )
+        else:
+            self.lookup_table = load_lookup_table(
+                self.compiled_profile,
+                self.profile_interval,
+                self.run_interval,
+                self.lookup_table_dir,
+            )
 
-    def generate_profile(self) -> list:
+    def generate_profile(self) -> Sequence[float]:
         """
         Attempts to parse profile from `self.config` and generates profile
-        between `r0` and `r1` bounds for `7 days`
+        between `r0` and `r1` bounds for `7 days`. Draws are reproducible when
+        the profile sets a `seed`. Measured `csv`, `npy` and `parquet` traces
+        of one sample every `interval` seconds are memory-mapped instead, and
+        repeat once they've all elapsed.
         """
         if self.profile["source"] == "range_30m":
             base_multiplier = float(
                 getattr(self, self.profile_base_multiplier_field_name)
             )
             self.profile_interval = _RANGE_30M
-            p_bounds = zip(self.profile["r0"] * 7, self.profile["r1"] * 7)
-            return [base_multiplier * uniform(*i) for i in p_bounds]
+            return draw_profile(
+                self.profile["r0"] * 7,
+                self.profile["r1"] * 7,
+                base_multiplier,
+                self.profile.get("seed"),
+            )
+        if self.profile["source"] in MEASURED_SOURCES:
+            self.profile_interval = int(self.profile.get("interval", 60))
+            trace = load_trace(
+                self.profile["source"],
+                self.profile["path"],
+                self.profile.get("column"),
+                self.trace_cache_dir,
+            )
+            if not len(trace):
+                raise ValueError(f"{self.profile['path']} has no samples")
+            return trace
         raise NotImplementedError(f"{self.profile['source']} not supported")
 
-    @cached_property
-    def date_started_at(self):
-        d = self.started_at.date()
-        return datetime(d.year, d.month, d.day)
+    @property
+    def date_started_at(self) -> datetime:
+        if self._date_started_at is None:
+            if self.profile_engine is not None:
+                self._date_started_at = self.profile_engine.origin
+            else:
+                d = self.started_at.date()
+                self._date_started_at = datetime(d.year, d.month, d.day)
+        return self._date_started_at
+
+    @date_started_at.setter
+    def date_started_at(self, value: datetime) -> None:
+        self._date_started_at = value
+
+    def _profile_seconds(self, instant: datetime) -> float:
+        # The profile repeats once all of its slots (i.e. the week) elapsed.
+        elapsed = (instant - self.date_started_at).total_seconds()
+        return elapsed % (len(self.compiled_profile) * self.profile_interval)
 
     def get_value(self, instant: datetime | None = None):
-        instant = instant or datetime.now()
         profile = self.compiled_profile
-        delta = instant - self.date_started_at
-        start_idx = delta.seconds // self.profile_interval
-        interop_x = (delta.seconds / self.profile_interval) % 1
-        return remap(Curves.sine(interop_x), 0, 1, *profile[start_idx : start_idx + 2])
+        seconds = self._profile_seconds(instant or self.clock.now())
+        start_idx = int(seconds // self.profile_interval)
+        end_idx = (start_idx + 1) % len(profile)
+        interop_x = (seconds / self.profile_interval) % 1
+        return remap(
+            self.profile_curve(interop_x), 0, 1, profile[start_idx], profile[end_idx]
+        )
+
+    def values_at(self, start: datetime, seconds: np.ndarray) -> np.ndarray:
+        """
+        Same as `get_value`, at each of the `seconds` after `start` at once.
+        """
+        offset = (start - self.date_started_at).total_seconds()
+        return interpolate_profile(
+            self.compiled_profile,
+            self.profile_interval,
+            offset + np.asarray(seconds),
+            self.profile_curve,
+        )
+
+    def lookup_value(self, instant: datetime | None = None):
+        """
+        Same as `get_value`, but looked up from the precompiled `lookup_table`
+        at `run_interval` resolution.
+        """
+        seconds = self._profile_seconds(instant or self.clock.now())
+        return self.lookup_table[int(seconds // self.run_interval)]
+
+    def idle_ticks(self) -> int:
+        """
+        Ticks until the profile leaves its present flat stretch, e.g. a night
+        of zero generation, once the moving averages settled on its value.
+        """
+        for field in self.timeseries_fields:
+            if not self.rolling_averages[field].settled(getattr(self, field)):
+                return 0
+        profile, interval = self.compiled_profile, self.profile_interval
+        seconds = self._profile_seconds(self.clock.now())
+        index = int(seconds // interval)
+        value, slots = profile[index], len(profile)
+        if value != self.power:
+            return 0
+        # Looks a day ahead at most, so long measured traces stay cheap.
+        horizon = min(slots, 86400 // interval + 1)
+        end = index + 1
+        while end < index + horizon and profile[end % slots] == value:
+            end += 1
+        # The value eases away from the start of the last slot of the stretch.
+        return int(((end - 1) * interval - seconds) // self.run_interval)
+
+    def save_state(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        super().save_state(prefix, arrays, meta)
+        # Measured traces are saved by reference, as the files they're read from.
+        if isinstance(self.compiled_profile, list):
+            arrays[prefix + "profile"] = array("d", self.compiled_profile)
+        if self.profile_engine is None:
+            meta[prefix + "date_started_at"] = self.date_started_at.isoformat()
+
+    def restore_state(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        """
+        Also restores the drawn profile, and where it started, so that the
+        profile carries on rather than being drawn and started again.
+        """
+        super().restore_state(prefix, arrays, meta)
+        profile = self.compiled_profile
+        if prefix + "profile" in arrays and isinstance(profile, list):
+            saved = arrays[prefix + "profile"]
+            if len(saved) == len(profile):
+                profile[:] = saved.tolist()
+                if self.profile_engine is not None:
+                    self.profile_engine.update(self.profile_row, profile)
+                self._load_lookup_table()
+        if prefix + "date_started_at" in meta and self.profile_engine is None:
+            self.date_started_at = datetime.fromisoformat(
+                meta[prefix + "date_started_at"]
+            )
+
+    def value_at(self, instant: datetime) -> float:
+        """
+        The power of the subsystem at `instant`, as `on_run` computes it once
+        the engine, if any, was stepped to `instant`.
+        """
+        if self.profile_engine is not None:
+            return float(self.profile_engine.values[self.profile_row])
+        if self.lookup_table is not None:
+            return self.lookup_value(instant)
+        return self.get_value(instant)
 
     def on_run(self):
-        self.power = self.get_value()
+        self.power = self.value_at(self.clock.now())
 
 
 class Generation(SupportsExport, SubsystemWithProfile):
@@ -181,6 +484,11 @@ class Consumption(SubsystemWithProfile):
 
 
 class Storage(SupportsExport, SubsystemBase):
+    """
+    Storage system, charged and discharged by the `InterconnectedSubsystem` it
+    is part of. Its state lives in a row of that subsystem's `StorageFleet`.
+    """
+
     def __init__(self, **kwargs) -> None:
         self.technology = str(kwargs.get("technology"))
         self.max_capacity = float(kwargs.get("max_capacity"))
@@ -191,14 +499,68 @@ class Storage(SupportsExport, SubsystemBase):
         )
         self.charge_efficiency = float(kwargs.get("charge_efficiency", 0.9))
         self.discharge_efficiency = float(kwargs.get("discharge_efficiency", 0.9))
+        self.initial_state_of_charge = self.usable_capacity * float(
+            kwargs.pop("initial_state_of_charge", 0.5)
+        )
+        self.fleet: Optional[StorageFleet] = None
+        self.register_timeseries_fields("power", "state_of_charge")
+        # Run by the `InterconnectedSubsystem` right after dispatching, rather
+        # than by the scheduler.
+        kwargs["auto_start"] = False
         super().__init__(**kwargs)
 
+    def attach(self, fleet: StorageFleet) -> None:
+        self.fleet = fleet
+        self.fleet_row = fleet.add(
+            usable_capacity=self.usable_capacity,
+            max_charge_rate=self.max_charge_rate,
+            max_discharge_rate=self.max_discharge_rate,
+            charge_efficiency=self.charge_efficiency,
+            discharge_efficiency=self.discharge_efficiency,
+            state_of_charge=self.initial_state_of_charge,
+        )
+
+    @property
+    def power(self) -> float:
+        if self.fleet is None:
+            return 0.0
+        return float(self.fleet.power[self.fleet_row])
+
+    @property
+    def state_of_charge(self) -> float:
+        if self.fleet is None:
+            return self.initial_state_of_charge
+        return float(self.fleet.state_of_charge[self.fleet_row])
+
+    def save_state(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        super().save_state(prefix, arrays, meta)
+        meta[prefix + "state_of_charge"] = self.state_of_charge
+
+    def restore_state(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        super().restore_state(prefix, arrays, meta)
+        if self.fleet is not None and prefix + "state_of_charge" in meta:
+            state_of_charge = meta[prefix + "state_of_charge"]
+            self.fleet.state_of_charge[self.fleet_row] = min(
+                max(state_of_charge, 0.0), self.usable_capacity
+            )
+
     def on_run(self):
         pass
 
 
+# Ticks after which the aggregated totals are recomputed exactly.
+_RESYNC_TICKS: Final[int] = 3600
+
+
+def _shares(values: list[float]) -> array:
+    total = sum(values)
+    return array("d", [value / total if total else 0.0 for value in values])
+
+
 class InterconnectedSubsystem(SupportsExport, SubsystemBase):
 
+    # Runs after the subsystems it aggregates within the same tick.
+    run_priority = 1
     auto_invoke_get_states = True
 
     def __init__(
@@ -208,6 +570,9 @@ class InterconnectedSubsystem(SupportsExport, SubsystemBase):
         storages: list[Storage],
         set_states: Callable,
         subsystem_reporting: tuple[str],
+        storage_dispatch: Optional[dict[str, any]] = None,
+        storage_fleet: Optional[StorageFleet] = None,
+        tariff_table: Optional[TariffTable] = None,
         **kwargs,
     ) -> None:
         self.consumptions = consumptions
@@ -216,72 +581,242 @@ class InterconnectedSubsystem(SupportsExport, SubsystemBase):
         self.set_states = set_states
         self.consumption = 0.0
         self.generation = 0.0
+        self.storage = 0.0
         self.subsystem_reporting = subsystem_reporting
         self.generation_states, self.consumption_states = {}, {}
-        export_price = (
-            self.generations_weighted_unit_export_price
-            + self.storages_weighted_unit_export_price
-        )
-        super().__init__(can_export=True, export_price=export_price, **kwargs)
+        self.storage_states = {}
+        # Subsystems whose states changed since they were last aggregated, all
+        # of them to begin with, and the power they were aggregated with.
+        self._changed_generations = list(generations)
+        self._changed_consumptions = list(consumptions)
+        self._changed_storages = list(storages)
+        self._aggregated_power: dict[SubsystemBase, float] = {}
+        for subsystems, changed in (
+            (generations, self._changed_generations),
+            (consumptions, self._changed_consumptions),
+            (storages, self._changed_storages),
+        ):
+            for subsystem in subsystems:
+                subsystem.on_change = changed.append
+                self._aggregated_power[subsystem] = 0.0
+        self._aggregated_ticks = 0
+        self.dispatch_policy = dispatch_policy_from_config(storage_dispatch)
+        # Stepped by whoever shares the fleet, such as a `ProsumerHost`.
+        self._steps_storages = storage_fleet is None
+        if storage_fleet is None:
+            storage_fleet = StorageFleet()
+        self._attach_storages(storage_fleet)
+        # Stepped by whoever shares the table, such as a `ProsumerHost`.
+        self._steps_tariffs = tariff_table is None
+        now = kwargs.get("clock", WALL_CLOCK).now()
+        if tariff_table is None:
+            tariff_table = TariffTable(now)
+        self._register_tariffs(tariff_table)
+        self._export_price = self.export_price_at(now)
+        super().__init__(can_export=True, export_price=0, **kwargs)
         self.register_timeseries_fields(
             "generation",
             "consumption",
+            "storage",
             "self_consumption",
             "net_export",
             "export_price",
         )
 
-    @cached_property
+    def _register_tariffs(self, table: TariffTable):
+        # The export price of the prosumer is that of its generations,
+        # weighted by installed capacity. The prices of storages are kept in
+        # the table too, but don't weigh in.
+        rows, weights = [], []
+        for subsystem in filter(lambda x: x.export_allowed, self.generations):
+            rows.append(subsystem.register_tariff(table))
+            weights.append(subsystem.installed_capacity)
+        for subsystem in filter(lambda x: x.export_allowed, self.storages):
+            subsystem.register_tariff(table)
+        self.tariff_table = table
+        self.tariff_row = table.register_weighted(rows, weights)
+
+    @property
+    def export_price(self) -> float:
+        return self._export_price
+
+    def export_price_at(self, instant: datetime) -> float:
+        return self.tariff_table.price(self.tariff_row, instant)
+
+    def _weighted_unit_export_price(
+        self, subsystems: list[SubsystemBase], weight: str
+    ) -> float:
+        now, total, wavg_num = self.clock.now(), 0, 0
+        for sys in filter(lambda x: x.export_allowed, subsystems):
+            total += getattr(sys, weight)
+            wavg_num += getattr(sys, weight) * sys.export_price_at(now)
+        return wavg_num / total if total else 0.0
+
+    @property
     def generations_weighted_unit_export_price(self):
-        installed_capacity, wavg_num = 0, 0
-        for sys in filter(lambda x: x.export_allowed, self.generations):
-            installed_capacity += sys.installed_capacity
-            wavg_num += sys.installed_capacity * sys.export_price
-        return wavg_num / installed_capacity
+        return self._weighted_unit_export_price(self.generations, "installed_capacity")
 
-    @cached_property
+    @property
     def storages_weighted_unit_export_price(self):
-        # TODO: [Storage] Not Implemented
-        return 0
+        return self._weighted_unit_export_price(self.storages, "max_discharge_rate")
 
-    @staticmethod
-    def _system_states_and_power_reducer(acc, sys: SubsystemBase):
-        acc[0].update({sys.id_: sys.get_states()})
-        return acc[0], acc[1] + sys.power
+    def _aggregate_changes(
+        self, changed: list[SubsystemBase], states: dict[str, any], total: float
+    ) -> float:
+        """
+        Rebuilds the states of the `changed` subsystems only, and returns the
+        `total` power updated by their change in power.
+        """
+        aggregated_power = self._aggregated_power
+        for subsystem in changed:
+            states[subsystem.id_] = subsystem.get_states()
+            power = subsystem.power
+            total += power - aggregated_power[subsystem]
+            aggregated_power[subsystem] = power
+        changed.clear()
+        return total
+
+    def _resync_totals(self):
+        # Totals accumulate rounding errors from the deltas over time, so
+        # they're recomputed every so often, as in `RollingAverages._resync`.
+        power = self._aggregated_power
+        self.generation = fsum(power[subsystem] for subsystem in self.generations)
+        self.consumption = fsum(power[subsystem] for subsystem in self.consumptions)
+        self.storage = fsum(power[subsystem] for subsystem in self.storages)
 
     def get_generation_states(self) -> dict[str, any]:
-        reducer = self._system_states_and_power_reducer
-        states, self.generation = reduce(reducer, self.generations, ({}, 0))
-        return states
+        self.generation = self._aggregate_changes(
+            self._changed_generations, self.generation_states, self.generation
+        )
+        return self.generation_states
 
     def get_consumption_states(self) -> dict[str, any]:
-        reducer = self._system_states_and_power_reducer
-        states, self.consumption = reduce(reducer, self.consumptions, ({}, 0))
-        return states
+        self.consumption = self._aggregate_changes(
+            self._changed_consumptions, self.consumption_states, self.consumption
+        )
+        return self.consumption_states
 
     def get_storage_states(self) -> dict[str, any]:
-        raise NotImplementedError()
+        for storage in self.storages:
+            storage.run()
+        self._aggregate_changes(self._changed_storages, self.storage_states, 0.0)
+        # Storages mostly change every tick, and often cancel the rest of the
+        # prosumer out exactly, so their total is summed afresh rather than
+        # drifting by deltas to a net export of -0.0 or the like.
+        self.storage = fsum(storage.power for storage in self.storages)
+        return self.storage_states
+
+    def _attach_storages(self, fleet: StorageFleet):
+        self.storage_fleet, self.storage_fleet_start = fleet, len(fleet)
+        for storage in self.storages:
+            storage.attach(fleet)
+        # Requests are split between the storages in proportion to their rates.
+        charge_rates = [storage.max_charge_rate for storage in self.storages]
+        discharge_rates = [storage.max_discharge_rate for storage in self.storages]
+        self._storage_rates = (-sum(charge_rates), sum(discharge_rates))
+        self._storage_charge_shares = _shares(charge_rates)
+        self._storage_discharge_shares = _shares(discharge_rates)
+        self._storage_requests = array("d", [0.0]) * len(self.storages)
+
+    def request_storages(self) -> array:
+        """
+        Returns the power the dispatch policy requests from each storage for
+        the present generation and consumption.
+        """
+        return self._split_request(
+            self.generation - self.consumption, self.export_price
+        )
+
+    def request_storages_at(self, instant: datetime) -> array:
+        """
+        Same as `request_storages`, for the power of the subsystems at
+        `instant` rather than as of their last run, so that whoever shares
+        the storage fleet can step it before they run. The engine and the
+        tariff table must have been stepped to `instant`.
+        """
+        generation = fsum(subsystem.value_at(instant) for subsystem in self.generations)
+        consumption = fsum(
+            subsystem.value_at(instant) for subsystem in self.consumptions
+        )
+        return self._split_request(
+            generation - consumption, self.tariff_table.values[self.tariff_row]
+        )
+
+    def _split_request(self, net_export: float, export_price: float) -> array:
+        request = self.dispatch_policy.request(net_export, export_price)
+        request = min(max(request, self._storage_rates[0]), self._storage_rates[1])
+        shares = (
+            self._storage_discharge_shares
+            if request > 0
+            else self._storage_charge_shares
+        )
+        requests = self._storage_requests
+        for i, share in enumerate(shares):
+            requests[i] = request * share
+        return requests
+
+    def dispatch_storages(self):
+        """
+        Charges or discharges the storages as requested by the dispatch policy,
+        unless the storage fleet is stepped by whoever shares it.
+        """
+        if not self.storages or not self._steps_storages:
+            return
+        hours = self.run_interval / 3600
+        self.storage_fleet.step(
+            self.request_storages(), hours, self.storage_fleet_start
+        )
+
+    def dispatch_storages_over(
+        self,
+        generation: np.ndarray,
+        consumption: np.ndarray,
+        export_price: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as `dispatch_storages`, at each of many ticks in turn, given the
+        generation, consumption and export price of every tick. Returns the
+        power and state of charge of every storage after each tick (storages x
+        ticks).
+        """
+        request = np.clip(
+            self.dispatch_policy.request_over(generation - consumption, export_price),
+            *self._storage_rates,
+        )
+        requests = np.where(
+            request > 0,
+            np.multiply.outer(self._storage_discharge_shares, request),
+            np.multiply.outer(self._storage_charge_shares, request),
+        )
+        return self.storage_fleet.step_over(
+            requests, self.run_interval / 3600, self.storage_fleet_start
+        )
 
     @property
     def self_consumption(self):
-        return min(self.generation, self.consumption)
+        supply = self.generation + max(self.storage, 0)
+        demand = self.consumption + max(-self.storage, 0)
+        return min(supply, demand)
 
     @property
     def import_export_status(self):
-        if self.self_consumption < self.generation:
-            return ProsumerStatus.EXPORT
-        if self.self_consumption < self.consumption:
-            return ProsumerStatus.IMPORT
-        return ProsumerStatus.SELF_SUSTAIN
+        return ProsumerStatus.of(self.net_export)
 
     @property
     def net_export(self):
-        return self.generation - self.consumption
+        return self.generation - self.consumption + self.storage
 
     def on_run(self):
-        self.generation_states = self.get_generation_states()
-        self.consumption_states = self.get_consumption_states()
-        # TODO: update self.total_consumption with storage charge rate if charging
+        if self._steps_tariffs:
+            self.tariff_table.step(self.clock.now())
+        self._export_price = self.tariff_table.values[self.tariff_row]
+        self._aggregated_ticks += 1
+        if self._aggregated_ticks % _RESYNC_TICKS == 0:
+            self._resync_totals()
+        self.get_generation_states()
+        self.get_consumption_states()
+        self.dispatch_storages()
+        self.get_storage_states()
 
     @states_setter
     def get_states(self) -> dict[str, any]:
@@ -290,15 +825,17 @@ class InterconnectedSubsystem(SupportsExport, SubsystemBase):
             states.update(generations=self.generation_states)
         if "consumption" in self.subsystem_reporting:
             states.update(consumptions=self.consumption_states)
-        # TODO: include storage system
+        if "storage" in self.subsystem_reporting:
+            states.update(storages=self.storage_states)
         states.update(
             generation=self.generation,
             consumption=self.consumption,
+            storage=self.storage,
             self_consumption=self.self_consumption,
             net_export=self.net_export,
             status=self.import_export_status.value,
             export_price=self.export_price,
-            last_updated_at=datetime.now(),
+            last_updated_at=self.clock.now(),
         )
         states.update(super().get_states())
         return states
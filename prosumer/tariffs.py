@@ -0,0 +1,200 @@
+from array import array
+from datetime import datetime
+from math import gcd
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+from utils.utils import MEASURED_SOURCES
+
+from prosumer.profiles import load_trace
+
+# A flat price is compiled as a single slot lasting a day.
+_FLAT_INTERVAL = 86400
+
+# Most slots a weighted price table may have, i.e. 32 MiB of prices.
+_MAX_SLOTS = 1 << 22
+
+
+def compile_tariff(
+    export_price: float | dict[str, any], cache_dir: Optional[str] = None
+) -> tuple[Sequence[float], int]:
+    """
+    Compiles the export price of a subsystem into its price per slot, and the
+    slot interval in seconds. Prices repeat once all of their slots elapsed.
+
+    `export_price` is either a flat price, a `time_of_use` schedule of
+    `prices` for every `interval` seconds (1800 by default, so 48 per day),
+    or a dynamic tariff read from a `csv`, `npy` or `parquet` file of one
+    price every `interval` seconds (3600 by default), like measured profiles.
+    Dynamic tariffs are indexed where they're mapped, rather than copied.
+    """
+    if not isinstance(export_price, dict):
+        return array("d", [float(export_price)]), _FLAT_INTERVAL
+    source = export_price.get("source")
+    if source == "time_of_use":
+        prices = export_price["prices"]
+        interval = int(export_price.get("interval", 1800))
+        prices = array("d", prices)
+    elif source in MEASURED_SOURCES:
+        prices = load_trace(
+            source, export_price["path"], export_price.get("column"), cache_dir
+        )
+        interval = int(export_price.get("interval", 3600))
+    else:
+        raise NotImplementedError(f"{source} tariffs not supported")
+    if not len(prices) or interval <= 0:
+        raise ValueError(f"Tariff of {len(prices)} prices every {interval}s")
+    return prices, interval
+
+
+class TariffTable:
+    """
+    Export prices of the subsystems of many prosumers, and the weighted
+    export price of each prosumer compiled into a per slot lookup table, so
+    that the price of a tick is an index into it rather than a weighted sum.
+
+    A prosumer's table spans the least common multiple of the periods of its
+    subsystems' schedules, in slots of the greatest common divisor of their
+    intervals. `step` looks up the price of every prosumer at once, computing
+    the slot once per distinct grid. Changing some prices of a schedule only
+    recompiles the slots of the tables they fall in.
+    """
+
+    def __init__(self, origin: Optional[datetime] = None) -> None:
+        origin = origin or datetime.now()
+        self.origin = datetime(origin.year, origin.month, origin.day)
+        # (prices, interval) of every registered subsystem.
+        self.schedules: list[tuple[Sequence[float], int]] = []
+        # Weighted export price of every prosumer, as of the last step.
+        self.values = array("d")
+        # (subsystem rows, normalized weights) of every prosumer.
+        self._members: list[tuple[list[int], list[float]]] = []
+        self._tables: list[array] = []
+        self._intervals: list[int] = []
+        # Prosumers whose table includes the schedule, by subsystem row.
+        self._prosumers_of: list[list[int]] = []
+        # Prosumers by the (interval, slots) of their table.
+        self._grids: dict[tuple[int, int], list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def register(self, prices: Sequence[float], interval: int) -> int:
+        """
+        Adds the compiled schedule of a subsystem, and returns its row. The
+        prices are kept by reference, and updated in place by `update`,
+        except for mapped ones, which are copied when they first change.
+        """
+        self.schedules.append((prices, interval))
+        self._prosumers_of.append([])
+        return len(self.schedules) - 1
+
+    def register_weighted(self, rows: list[int], weights: list[float]) -> int:
+        """
+        Compiles the export price of a prosumer, weighting the schedules of
+        its subsystem `rows` by `weights`, and returns its index in `values`.
+        """
+        total = sum(weights)
+        weights = [weight / total if total else 0.0 for weight in weights]
+        interval, period = 0, 1
+        for row in rows:
+            prices, row_interval = self.schedules[row]
+            row_period = len(prices) * row_interval
+            interval = gcd(interval, row_interval)
+            period = period * row_period // gcd(period, row_period)
+        interval = interval or _FLAT_INTERVAL
+        slots = max(1, period // interval)
+        if slots > _MAX_SLOTS:
+            raise ValueError(
+                f"Tariffs of periods {period}s in slots of {interval}s need"
+                f" {slots} slots, more than {_MAX_SLOTS}"
+            )
+        prosumer = len(self.values)
+        self._members.append((list(rows), weights))
+        self._tables.append(array("d", [0.0]) * slots)
+        self._intervals.append(interval)
+        for row in rows:
+            self._prosumers_of[row].append(prosumer)
+        self._grids.setdefault((interval, slots), []).append(prosumer)
+        self._compile(prosumer, range(slots))
+        self.values.append(self._tables[prosumer][0])
+        return prosumer
+
+    def _compile(self, prosumer: int, slots: Iterable[int]) -> None:
+        table, interval = self._tables[prosumer], self._intervals[prosumer]
+        rows, weights = self._members[prosumer]
+        members = [(*self.schedules[row], weight) for row, weight in zip(rows, weights)]
+        for slot in slots:
+            seconds = slot * interval
+            table[slot] = sum(
+                weight * prices[seconds // row_interval % len(prices)]
+                for prices, row_interval, weight in members
+            )
+
+    def update(self, row: int, prices: Sequence[float], start: int = 0) -> None:
+        """
+        Replaces the prices of a subsystem's schedule from slot `start`, e.g.
+        when the next day's dynamic prices are published, and recompiles only
+        the slots of the prosumers' tables that they fall in.
+        """
+        schedule, row_interval = self.schedules[row]
+        if isinstance(schedule, memoryview):
+            # Mapped read only, and shared by whoever reads the same file.
+            schedule = array("d", schedule)
+            self.schedules[row] = (schedule, row_interval)
+        if start < 0 or start + len(prices) > len(schedule):
+            raise ValueError(
+                f"Prices for slots {start} to {start + len(prices)} of a"
+                f" schedule of {len(schedule)}"
+            )
+        schedule[start : start + len(prices)] = array("d", prices)
+        period = len(schedule) * row_interval
+        for prosumer in self._prosumers_of[row]:
+            interval = self._intervals[prosumer]
+            ratio = row_interval // interval
+            # The schedule repeats within the table, so each of its changed
+            # slots covers `ratio` slots of the table once per repetition.
+            self._compile(
+                prosumer,
+                (
+                    offset + slot * ratio + k
+                    for offset in range(
+                        0, len(self._tables[prosumer]), period // interval
+                    )
+                    for slot in range(start, start + len(prices))
+                    for k in range(ratio)
+                ),
+            )
+
+    def price(self, prosumer: int, instant: datetime) -> float:
+        """
+        Returns the weighted export price of a prosumer at `instant`.
+        """
+        table, interval = self._tables[prosumer], self._intervals[prosumer]
+        elapsed = (instant - self.origin).total_seconds()
+        return table[int(elapsed // interval) % len(table)]
+
+    def prices_at(
+        self, prosumer: int, start: datetime, seconds: np.ndarray
+    ) -> np.ndarray:
+        """
+        Returns the weighted export price of a prosumer at each of the
+        `seconds` after `start`, e.g. to simulate many ticks at once.
+        """
+        table, interval = self._tables[prosumer], self._intervals[prosumer]
+        elapsed = (start - self.origin).total_seconds() + np.asarray(seconds)
+        slots = (elapsed // interval).astype(np.intp) % len(table)
+        return np.frombuffer(table)[slots]
+
+    def step(self, instant: Optional[datetime] = None) -> array:
+        """
+        Looks up the weighted export price of every prosumer at `instant`, and
+        stores them in `values`.
+        """
+        elapsed = ((instant or datetime.now()) - self.origin).total_seconds()
+        tables, values = self._tables, self.values
+        for (interval, slots), prosumers in self._grids.items():
+            slot = int(elapsed // interval) % slots
+            for prosumer in prosumers:
+                values[prosumer] = tables[prosumer][slot]
+        return values
@@ -0,0 +1,36 @@
+"""
+Fixtures shared by the tests and the benchmarks.
+"""
+
+
+def sample_config(vp_address: str = "::1") -> dict[str, any]:
+    """
+    A prosumer of one generation, consumption and storage each, with flat
+    profiles, as built by the tests and the benchmarks.
+    """
+    profile = {"source": "range_30m", "r0": [0.2] * 48, "r1": [0.8] * 48}
+    return {
+        "location": "0, 0",
+        "moving_avg_periods": [1, 5, 15, 30, 60],
+        "subsystem_reporting": ["generation", "storage"],
+        "settings": {"vpAddress": vp_address},
+        "generations": [
+            {
+                "id": 3,
+                "installed_capacity": 10.2,
+                "export_price": 5,
+                "$profile": profile,
+            }
+        ],
+        "consumptions": [{"id": 1, "peak_demand": 7, "$profile": profile}],
+        "storages": [
+            {
+                "id": 2,
+                "technology": "Li-Ion",
+                "max_capacity": 20,
+                "usable_capacity": 18,
+                "max_charge_rate": 5,
+                "export_price": 10,
+            }
+        ],
+    }
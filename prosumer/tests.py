@@ -1,3 +1,1664 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from math import exp
+from pathlib import Path
+from random import Random
+from statistics import fmean
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import yaml
+from django.conf import settings
+from django.test import SimpleTestCase
+from utils.clock import SimulationClock
+from utils.metrics import Histogram
+from utils.rolling import (
+    BatchedRollingAverages,
+    BucketedAverages,
+    ExponentialAverages,
+    RollingAverages,
+)
+from utils.scheduler import SKIPPED_TICKS, ScheduledJob, TickScheduler
+from virtual_prosumer.config_loader import ConfigError, load_config
+
+from prosumer import api
+from prosumer.apps import ProsumerConfig
+from prosumer.checkpoint import Checkpointer
+from prosumer.ensemble import (
+    ENSEMBLE_FIELDS,
+    member_config,
+    run_ensemble,
+    simulate_members,
+)
+from prosumer.enums import ProsumerStatus
+from prosumer.factory import build_prosumer, online_states, subsystems_of
+from prosumer.fleet import ColumnarFleet, steps_columnar
+from prosumer.host import ProsumerHost
+from prosumer.mqtt import SNAPSHOT_SERIALIZERS, MqttClientPool, ProsumerPublisher
+from prosumer.profiles import (
+    ProfileEngine,
+    compile_lookup_table,
+    load_lookup_table,
+    load_trace,
+)
+from prosumer.recorder import StateRecorder, write_npy
+from prosumer.runtime import ProsumerRuntime
+from prosumer.sharding import ShardedFleet
+from prosumer.simulation import JsonLinesWriter, simulate
+from prosumer.storage import PriceAware, SelfConsumptionFirst, StorageFleet
+from prosumer.subsystems import Consumption, Generation
+from prosumer.tariffs import TariffTable
+from prosumer.testing import sample_config
+from prosumer.transport import (
+    CONNACK,
+    CONNECT,
+    DISCONNECT,
+    PINGREQ,
+    PINGRESP,
+    PUBACK,
+    PUBLISH,
+    AsyncMqttTransport,
+    encode_packet,
+    read_packet,
+)
+
+
+class ConfigLoaderTestCase(SimpleTestCase):
+    def write_config(self, directory: str, config: dict[str, any]) -> Path:
+        path = Path(directory) / "prosumer.yaml"
+        with open(path, "w", encoding="utf-8") as file:
+            yaml.safe_dump(config, file)
+        return path
+
+    def test_validates_whole_config_at_once(self):
+        config = sample_config()
+        config["settings"].update(server="localhost", mqttPort=1883)
+        config["generations"][0]["installed_capacity"] = "lots"
+        config["storages"].append(dict(config["storages"][0]))
+        consumption = config["consumptions"][0]
+        consumption["$profile"] = {"source": "range_30m", "r0": [0.5] * 48}
+        with TemporaryDirectory() as directory:
+            with self.assertRaises(ConfigError) as raised:
+                load_config(self.write_config(directory, config), cache_dir=None)
+        errors = str(raised.exception).splitlines()
+        self.assertEqual(len(errors), 3, errors)
+        self.assertIn("generations[0].installed_capacity: expected", errors[0])
+
+    def test_subsystems_are_optional(self):
+        config = sample_config()
+        config["settings"].update(server="localhost", mqttPort=1883)
+        del config["consumptions"], config["storages"], config["moving_avg_periods"]
+        config["api"] = None
+        with TemporaryDirectory() as directory:
+            config = load_config(self.write_config(directory, config), cache_dir=None)
+        prosumer = build_prosumer(config, lambda states: None, auto_start=False)
+        self.assertEqual((len(prosumer.consumptions), len(prosumer.storages)), (0, 0))
+        self.assertEqual(online_states(config)["storages"], [])
+
+    def test_cache_is_keyed_by_file_and_environment(self):
+        config = sample_config()
+        config["settings"].update(server="${PROSUMER_MQTT_SERVER}", mqttPort=1883)
+        with TemporaryDirectory() as directory:
+            path, cache_dir = self.write_config(directory, config), Path(directory)
+            with mock.patch.dict(os.environ, PROSUMER_MQTT_SERVER="a"):
+                self.assertEqual(
+                    load_config(path, cache_dir)["settings"]["server"], "a"
+                )
+                self.assertEqual(len(list(cache_dir.glob("*.pickle"))), 1)
+                self.assertEqual(
+                    load_config(path, cache_dir)["settings"]["server"], "a"
+                )
+                self.assertEqual(len(list(cache_dir.glob("*.pickle"))), 1)
+            with mock.patch.dict(os.environ, PROSUMER_MQTT_SERVER="b"):
+                self.assertEqual(
+                    load_config(path, cache_dir)["settings"]["server"], "b"
+                )
+            self.assertEqual(len(list(cache_dir.glob("*.pickle"))), 2)
+
+
+class RollingAveragesTestCase(SimpleTestCase):
+    def test_matches_naive_moving_average(self):
+        sizes = {"1": 1, "5": 5, "60": 60}
+        window = RollingAverages(sizes)
+        rng = Random(0)
+        samples = []
+        for _ in range(250):
+            samples.append(rng.uniform(0, 10))
+            window.push(samples[-1])
+            for i, size in enumerate(sizes.values()):
+                recent = samples[-size:]
+                self.assertAlmostEqual(window.averages[i], sum(recent) / len(recent))
+
+    def test_bucketed_averages_approximate_the_window(self):
+        window = BucketedAverages({"12": 12, "40": 40}, bucket_sizes=(4,))
+        rng = Random(0)
+        samples = []
+        for _ in range(250):
+            samples.append(rng.uniform(0, 10))
+            window.push(samples[-1])
+            for i, size in enumerate((12, 40)):
+                recent = samples[-size:]
+                if len(samples) % 4 == 0:
+                    self.assertAlmostEqual(window.averages[i], fmean(recent))
+                else:
+                    # Only the oldest bucket is approximated.
+                    self.assertLess(abs(window.averages[i] - fmean(recent)), 10 / 3)
+
+    def test_batched_averages_match_each_series(self):
+        sizes = {"1": 1, "7": 7, "60": 60}
+        batched = BatchedRollingAverages(sizes, 130)
+        windows = [RollingAverages(sizes) for _ in range(130)]
+        rng = np.random.default_rng(0)
+        for _ in range(250):
+            values = rng.uniform(0, 10, len(windows))
+            averages = batched.push(values)
+            for window, value in zip(windows, values.tolist()):
+                window.push(value)
+            np.testing.assert_allclose(
+                averages,
+                np.array([window.averages for window in windows]).T,
+                rtol=0,
+                atol=1e-12,
+            )
+
+    def test_exponential_averages_follow_steps(self):
+        averages = ExponentialAverages({"10": 10})
+        averages.push(0)
+        for _ in range(10):
+            averages.push(1)
+        self.assertAlmostEqual(averages.averages[0], 1 - exp(-1))
+
+
+class ProfilesTestCase(SimpleTestCase):
+    def build(self, profile_engine=None, seed=None, peak_demand=7, **kwargs):
+        rng = Random(peak_demand)
+        r0 = [rng.uniform(0, 0.5) for _ in range(48)]
+        profile = {"source": "range_30m", "r0": r0, "r1": [x + 0.5 for x in r0]}
+        return Consumption(
+            id=1,
+            peak_demand=peak_demand,
+            profile={**profile, "seed": seed},
+            profile_engine=profile_engine,
+            auto_start=False,
+            **kwargs,
+        )
+
+    def test_seeded_profiles_are_reproducible(self):
+        self.assertEqual(
+            self.build(seed=42).compiled_profile, self.build(seed=42).compiled_profile
+        )
+        self.assertNotEqual(
+            self.build(seed=42).compiled_profile, self.build(seed=43).compiled_profile
+        )
+
+    def test_engine_matches_scalar_path(self):
+        engine = ProfileEngine(datetime(2022, 6, 1))
+        subsystems = [self.build(engine, seed=i, peak_demand=i + 1) for i in range(10)]
+        for seconds in range(0, 8 * 86400, 397):
+            instant = engine.origin + timedelta(seconds=seconds)
+            values = engine.step(instant)
+            for subsystem in subsystems:
+                self.assertEqual(
+                    values[subsystem.profile_row], subsystem.get_value(instant)
+                )
+
+    def test_engine_rejects_mismatched_profiles(self):
+        engine = ProfileEngine()
+        engine.register([0.0] * 336, 1800)
+        with self.assertRaises(ValueError):
+            engine.register([0.0] * 48, 1800)
+
+    def test_profiles_span_the_whole_week(self):
+        subsystem = self.build(seed=1)
+        subsystem.date_started_at = datetime(2022, 6, 1)
+        day_two = subsystem.date_started_at + timedelta(days=1)
+        self.assertEqual(subsystem.get_value(day_two), subsystem.compiled_profile[48])
+        week_later = subsystem.date_started_at + timedelta(days=7)
+        self.assertEqual(subsystem.get_value(week_later), subsystem.compiled_profile[0])
+
+    def test_lookup_table_matches_interpolation(self):
+        with TemporaryDirectory() as directory:
+            subsystem = self.build(seed=1)
+            subsystem.date_started_at = datetime(2022, 6, 1)
+            subsystem.lookup_table = load_lookup_table(
+                subsystem.compiled_profile, 1800, 1, directory
+            )
+            self.assertEqual(len(subsystem.lookup_table), 7 * 86400)
+            for seconds in range(0, 7 * 86400, 1013):
+                instant = subsystem.date_started_at + timedelta(seconds=seconds)
+                self.assertAlmostEqual(
+                    subsystem.lookup_value(instant),
+                    subsystem.get_value(instant),
+                    places=5,
+                )
+
+    def test_lookup_tables_of_seeded_profiles_only_are_cached(self):
+        with TemporaryDirectory() as directory:
+            unseeded = self.build(lookup_table_dir=directory)
+            computed = self.build(ProfileEngine(), seed=1, lookup_table_dir=directory)
+            self.assertIsNone(computed.lookup_table)
+            self.assertEqual(list(Path(directory).iterdir()), [])
+            # Unseeded profiles are still looked up, from a table in memory.
+            unseeded.date_started_at = datetime(2022, 6, 1)
+            instant = unseeded.date_started_at + timedelta(hours=30, seconds=7)
+            self.assertAlmostEqual(
+                unseeded.value_at(instant), unseeded.get_value(instant), places=5
+            )
+            self.assertEqual(len(unseeded.lookup_table), 7 * 86400)
+            seeded = self.build(seed=1, lookup_table_dir=directory)
+            self.assertEqual(len(seeded.lookup_table), 7 * 86400)
+            self.assertEqual(len(list(Path(directory).iterdir())), 1)
+
+    def test_least_recently_used_lookup_tables_are_evicted(self):
+        with TemporaryDirectory() as directory:
+            tables, paths = [], []
+            for i in range(3):
+                tables.append(load_lookup_table([i, i + 1], 2, 1, directory, 2))
+                paths.append(max(Path(directory).iterdir(), key=os.path.getmtime))
+                # File times may be coarser than the time between tables.
+                os.utime(paths[-1], ns=(i, i))
+            self.assertEqual(sorted(Path(directory).iterdir()), sorted(paths[1:]))
+            # Tables already mapped stay readable once evicted.
+            self.assertEqual(
+                tables[0].tolist(), compile_lookup_table([0, 1], 2, 1).tolist()
+            )
+            load_lookup_table([0, 1], 2, 1, directory, 2)
+            self.assertEqual(
+                sorted(Path(directory).iterdir()), sorted([paths[0], paths[2]])
+            )
+
+    def test_measured_traces_are_mapped_and_shared(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory)
+            samples = [float(i % 7) for i in range(200)]
+            with open(path / "load.csv", "w", encoding="utf-8") as file:
+                file.write("timestamp,power\n")
+                file.writelines(f"{i},{value}\n" for i, value in enumerate(samples))
+            write_npy(path / "load.npy", array("d", samples))
+
+            subsystems = [
+                Consumption(
+                    id=i,
+                    peak_demand=7,
+                    profile={"source": source, "path": path / f"load.{source}"},
+                    profile_engine=ProfileEngine(),
+                    lookup_table_dir=directory,
+                    auto_start=False,
+                )
+                for i, source in enumerate(("csv", "npy", "csv"))
+            ]
+            self.assertIs(
+                subsystems[0].compiled_profile, subsystems[2].compiled_profile
+            )
+            origin = datetime(2022, 6, 1)
+            for subsystem in subsystems:
+                self.assertIsNone(subsystem.profile_engine)
+                self.assertEqual(list(subsystem.compiled_profile), samples)
+                subsystem.date_started_at = origin
+                instant = origin + timedelta(seconds=90)
+                self.assertEqual(subsystem.get_value(instant), 1.5)
+                instant = origin + timedelta(seconds=200 * 60 + 30)
+                self.assertEqual(subsystem.get_value(instant), 0.5)
+
+    def test_npy_columns_are_indexed(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory, "columns.npy")
+            np.save(path, np.arange(12, dtype=float).reshape(4, 3))
+            self.assertEqual(list(load_trace("npy", path)), [0, 3, 6, 9])
+            self.assertEqual(list(load_trace("npy", path, -1)), [2, 5, 8, 11])
+            for column in ("power", 3):
+                with self.assertRaises(ValueError):
+                    load_trace("npy", path, column)
+            cube = Path(directory, "cube.npy")
+            np.save(cube, np.zeros((2, 2, 2)))
+            with self.assertRaisesRegex(ValueError, "not a 1-D or 2-D array"):
+                load_trace("npy", cube)
+
+            config = sample_config()
+            config["settings"].update(server="localhost", mqttPort=1883)
+            config["consumptions"][0]["$profile"] = {
+                "source": "npy",
+                "path": str(path),
+                "column": "power",
+            }
+            config_path = Path(directory) / "prosumer.yaml"
+            with open(config_path, "w", encoding="utf-8") as file:
+                yaml.safe_dump(config, file)
+            with self.assertRaises(ConfigError) as raised:
+                load_config(config_path, cache_dir=None)
+            self.assertIn("$profile.column: expected int", str(raised.exception))
+
+    def test_csv_traces_skip_blank_lines_and_locate_bad_cells(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory, "load.csv").resolve()
+            path.write_text("power\n1\n\n2\n\n", encoding="utf-8")
+            self.assertEqual(list(load_trace("csv", path, cache_dir=directory)), [1, 2])
+            path = path.with_name("bad.csv")
+            path.write_text("power\n1\n\nn/a\n", encoding="utf-8")
+            with self.assertRaises(ValueError) as raised:
+                load_trace("csv", path, cache_dir=directory)
+            self.assertTrue(str(raised.exception).startswith(f"{path}:4: "))
+            self.assertEqual(list(Path(directory).glob("*.tmp")), [])
+
+
+class RecordingMqttClient:
+    def __init__(self) -> None:
+        self.published = []
+
+    def publish(self, topic: str, payload: str, retain: bool = False, qos: int = 0):
+        self.published.append((topic, payload))
+
+
+class ProsumerPublisherTestCase(SimpleTestCase):
+    def test_publishes_changes_outside_deadbands_only(self):
+        client = RecordingMqttClient()
+        publisher = ProsumerPublisher(
+            client, "::a", deadbands={"power": {"absolute": 0.1}}
+        )
+        publisher.set_states({"power": 1.0, "status": "IMPORTING"})
+        publisher.set_states({"power": 1.05, "status": "IMPORTING"})
+        publisher.set_states({"power": 1.2, "status": "EXPORTING"})
+        self.assertEqual(
+            client.published,
+            [
+                ("prosumers/a/power", "1.0"),
+                ("prosumers/a/status", "IMPORTING"),
+                ("prosumers/a/power", "1.2"),
+                ("prosumers/a/status", "EXPORTING"),
+            ],
+        )
+
+    def test_heartbeat_republishes_unchanged_states(self):
+        client = RecordingMqttClient()
+        publisher = ProsumerPublisher(client, "::a", heartbeat=0)
+        publisher.set_states({"power": 1.0})
+        publisher.set_states({"power": 1.0})
+        self.assertEqual(len(client.published), 2)
+
+    def test_pooled_publishers_are_invalidated_when_their_client_connects(self):
+        with mock.patch("prosumer.mqtt.Client") as client_class:
+            client_class.side_effect = lambda **_kwargs: mock.MagicMock()
+            pool = MqttClientPool("localhost", 1883, size=2)
+        publishers = [pool.publisher_for(f"::{i}") for i in range(3)]
+        for publisher in publishers:
+            publisher.set_states({"power": 1.0})
+        first = pool.clients[0]
+        # paho hands the userdata the client was created with to `on_connect`.
+        userdata = client_class.call_args_list[0].kwargs["userdata"]
+        first.on_connect(first, userdata, {}, 0)
+        for publisher in publishers:
+            publisher.set_states({"power": 1.0})
+        self.assertEqual([client.publish.call_count for client in pool.clients], [4, 1])
+
+    def test_snapshot_mode_publishes_one_message_per_tick(self):
+        client = RecordingMqttClient()
+        publisher = ProsumerPublisher(client, "::a", mode="snapshot")
+        publisher.publish_states({"power": 1.0, "generations": {"3": {"power": 2}}})
+        topic, payload = client.published[0]
+        self.assertEqual(len(client.published), 1)
+        self.assertEqual(topic, "prosumers/a/snapshot")
+        self.assertEqual(
+            json.loads(payload), {"power": 1.0, "generations": {"3": {"power": 2}}}
+        )
+
+    def test_snapshot_serializers_write_the_same_json(self):
+        states = {"power": 1.5, "last_updated_at": datetime(2022, 6, 1, 12, 30, 0, 25)}
+        payloads = {SNAPSHOT_SERIALIZERS["json"]()(states)}
+        with mock.patch("prosumer.mqtt.orjson", None):
+            payloads.add(SNAPSHOT_SERIALIZERS["json"]()(states))
+        self.assertEqual(
+            payloads, {b'{"power":1.5,"last_updated_at":"2022-06-01T12:30:00.000025"}'}
+        )
+
+    def test_planned_publishing_matches_recursive(self):
+        states = {"power": 1.0, "$meta": 0, "generations": {"3": {"power": 2}}}
+        recursive, planned = RecordingMqttClient(), RecordingMqttClient()
+        ProsumerPublisher(recursive, "::a").set_states(states)
+        publisher = ProsumerPublisher(planned, "::a")
+        publisher.publish_topics(states)
+        self.assertEqual(planned.published, recursive.published)
+
+        states["generations"]["4"] = {"power": 3, "history": [1, 2]}
+        publisher.publish_topics(states)
+        self.assertEqual(
+            planned.published[len(recursive.published) :],
+            [
+                ("prosumers/a/generations/4/power", "3"),
+                ("prosumers/a/generations/4/history/0", "1"),
+                ("prosumers/a/generations/4/history/1", "2"),
+            ],
+        )
+
+
+class BrokerStandIn:
+    """
+    Accepts MQTT connections on a local port, and records what's published.
+    PUBACKs are only sent while `acking` is set, and PINGRESPs while `ponging`
+    is.
+    """
+
+    def __init__(self) -> None:
+        self.published: list[tuple[str, bytes]] = []
+        self.connects = 0
+        self.disconnected = threading.Event()
+        self.acking = threading.Event()
+        self.acking.set()
+        self.ponging = threading.Event()
+        self.ponging.set()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.serve, "127.0.0.1", 0, reuse_address=True)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def serve(self, reader, writer):
+        while True:
+            try:
+                packet_type, flags, body = await read_packet(reader)
+            except asyncio.IncompleteReadError:
+                # Dropped by the client.
+                return
+            if packet_type == CONNECT:
+                self.connects += 1
+                writer.write(encode_packet(CONNACK, 0, b"\0\0"))
+            elif packet_type == PINGREQ and self.ponging.is_set():
+                writer.write(encode_packet(PINGRESP, 0, b""))
+            elif packet_type == PUBLISH:
+                (length,) = struct.unpack("!H", body[:2])
+                topic, rest = body[2 : 2 + length].decode(), body[2 + length :]
+                if flags & 0x06:
+                    while not self.acking.is_set():
+                        await asyncio.sleep(0.01)
+                    writer.write(encode_packet(PUBACK, 0, rest[:2]))
+                    rest = rest[2:]
+                self.published.append((topic, rest))
+            elif packet_type == DISCONNECT:
+                self.disconnected.set()
+                writer.close()
+                return
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.server.close)
+
+
+class AsyncMqttTransportTestCase(SimpleTestCase):
+    def setUp(self):
+        self.broker = BrokerStandIn()
+        self.addCleanup(self.broker.close)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_coalesces_unsent_values_per_topic(self):
+        transport = AsyncMqttTransport("127.0.0.1", self.broker.port, "a")
+        transport.publish("a", 1, retain=True)
+        transport.publish("b", 1, retain=True)
+        transport.publish("a", 2, retain=True)
+        transport.loop_start()
+        transport.disconnect()
+        transport.loop_stop(timeout=5)
+        self.wait_for(self.broker.disconnected.is_set)
+        self.assertEqual(self.broker.published, [("a", b"2"), ("b", b"1")])
+
+    def test_limits_messages_in_flight(self):
+        self.broker.acking.clear()
+        transport = AsyncMqttTransport(
+            "127.0.0.1", self.broker.port, "a", qos=1, max_inflight=2
+        )
+        transport.loop_start()
+        for topic in "abcde":
+            transport.publish(topic, 1)
+        self.wait_for(lambda: transport.queued == 3)
+        time.sleep(0.1)
+        self.assertEqual(transport.queued, 3)
+        self.broker.acking.set()
+        transport.disconnect()
+        transport.loop_stop(timeout=5)
+        self.wait_for(self.broker.disconnected.is_set)
+        self.assertEqual([topic for topic, _ in self.broker.published], list("abcde"))
+
+    def test_reconnects_when_pings_go_unanswered(self):
+        self.broker.ponging.clear()
+        transport = AsyncMqttTransport(
+            "127.0.0.1",
+            self.broker.port,
+            "a",
+            keepalive=1,
+            ping_timeout=0.1,
+            reconnect_delay=0.01,
+        )
+        transport.loop_start()
+        self.wait_for(lambda: self.broker.connects >= 2)
+        self.broker.ponging.set()
+        transport.publish("a", 1)
+        transport.disconnect()
+        transport.loop_stop(timeout=5)
+        self.wait_for(self.broker.disconnected.is_set)
+        self.assertEqual(self.broker.published, [("a", b"1")])
+
+    def test_reconnects_after_unexpected_errors(self):
+        on_connect = mock.Mock(side_effect=[RuntimeError("bug"), None])
+        transport = AsyncMqttTransport(
+            "127.0.0.1",
+            self.broker.port,
+            "a",
+            reconnect_delay=0.01,
+            on_connect=on_connect,
+        )
+        transport.publish("a", 1)
+        with mock.patch("traceback.print_exc"):
+            transport.loop_start()
+            self.wait_for(transport.connected.is_set)
+        transport.disconnect()
+        transport.loop_stop(timeout=5)
+        self.wait_for(self.broker.disconnected.is_set)
+        self.assertEqual(on_connect.call_count, 2)
+        self.assertEqual(self.broker.published, [("a", b"1")])
+
+
+class StorageFleetTestCase(SimpleTestCase):
+    def test_state_of_charge_is_bounded(self):
+        fleet = StorageFleet()
+        row = fleet.add(10, 2, 4, 0.9, 0.8, 5)
+        fleet.step([-100], hours=1)
+        self.assertEqual(fleet.power[row], -2)
+        self.assertAlmostEqual(fleet.state_of_charge[row], 5 + 2 * 0.9)
+        for _ in range(10):
+            fleet.step([-100], hours=1)
+        self.assertEqual(fleet.state_of_charge[row], 10)
+        fleet.step([100], hours=1)
+        self.assertEqual(fleet.power[row], 4)
+        self.assertAlmostEqual(fleet.state_of_charge[row], 10 - 4 / 0.8)
+        for _ in range(10):
+            fleet.step([100], hours=1)
+        self.assertEqual(fleet.state_of_charge[row], 0)
+        self.assertEqual(fleet.step([100], hours=1)[row], 0)
+
+    def test_steps_many_storages_as_one_by_one(self):
+        rng, fleets = Random(4), [StorageFleet(), StorageFleet()]
+        for _ in range(40):
+            storage = [rng.uniform(1, 6) for _ in range(3)]
+            storage += [rng.uniform(0.8, 1), rng.uniform(0.8, 1), rng.uniform(0, 6)]
+            for fleet in fleets:
+                fleet.add(*storage)
+        for _ in range(500):
+            requested = [rng.choice((0, rng.uniform(-8, 8))) for _ in range(40)]
+            fleets[0].step(requested, hours=1 / 60)
+            for row, request in enumerate(requested):
+                fleets[1].step([request], hours=1 / 60, start=row)
+            self.assertEqual(fleets[0].power.tolist(), fleets[1].power.tolist())
+            self.assertEqual(
+                fleets[0].state_of_charge.tolist(), fleets[1].state_of_charge.tolist()
+            )
+
+    def test_policies(self):
+        self.assertEqual(SelfConsumptionFirst().request(-3, 5), 3)
+        policy = PriceAware(export_above=5, discharge_above=10)
+        self.assertEqual(policy.request(2, 4), -2)
+        self.assertEqual(policy.request(2, 5), 0)
+        self.assertEqual(policy.request(-2, 5), 2)
+        self.assertEqual(policy.request(2, 10), float("inf"))
+
+
+class TariffsTestCase(SimpleTestCase):
+    def _config(self, directory: str) -> dict[str, any]:
+        config = sample_config()
+        config["generations"][0]["export_price"] = {
+            "source": "time_of_use",
+            "prices": [float(i % 12) for i in range(48)],
+        }
+        with open(Path(directory) / "prices.csv", "w", encoding="utf-8") as file:
+            file.write("hour,price\n")
+            file.writelines(f"{i},{10 + i % 5}\n" for i in range(72))
+        config["generations"].append(
+            {
+                "id": 4,
+                "installed_capacity": 5,
+                "export_price": {
+                    "source": "csv",
+                    "path": str(Path(directory) / "prices.csv"),
+                },
+                "$profile": config["generations"][0]["$profile"],
+            }
+        )
+        return config
+
+    def _weighted_prices(self, prosumer, instants: list[datetime]) -> list[float]:
+        prices = []
+        for instant in instants:
+            first, second = prosumer.generations
+            total = first.installed_capacity + second.installed_capacity
+            prices.append(
+                (
+                    first.installed_capacity * first.export_price_at(instant)
+                    + second.installed_capacity * second.export_price_at(instant)
+                )
+                / total
+            )
+        return prices
+
+    def test_storages_dont_weigh_in(self):
+        path = Path(__file__).parent.parent / "prosumer.yaml"
+        prosumer = build_prosumer(
+            load_config(path, cache_dir=None), None, auto_start=False
+        )
+        self.assertEqual(prosumer.storages[0].export_price, 10)
+        self.assertEqual(prosumer.export_price, 5)
+
+    def test_weighted_prices_are_looked_up(self):
+        start = datetime(2024, 6, 1)
+        instants = [start + timedelta(minutes=minutes) for minutes in range(0, 9000, 7)]
+        with TemporaryDirectory() as directory:
+            config = self._config(directory)
+            clock, states = SimulationClock(start), []
+            prosumer = build_prosumer(
+                config, states.append, clock=clock, auto_start=False
+            )
+            table = TariffTable(start)
+            shared = [
+                build_prosumer(config, None, tariff_table=table, auto_start=False)
+                for _ in range(2)
+            ]
+        self.assertEqual(len(table), 2)
+        self.assertEqual(prosumer.generations[1].export_price_at(start), 10)
+        self.assertEqual(
+            prosumer.generations[1].export_price_at(start + timedelta(hours=73)), 11
+        )
+        expected = self._weighted_prices(prosumer, instants)
+        for instant, price in zip(instants, expected):
+            self.assertAlmostEqual(prosumer.export_price_at(instant), price)
+            table.step(instant)
+            for other in shared:
+                other.on_run()
+                self.assertAlmostEqual(other.export_price, price)
+        clock.instant = instants[-1]
+        prosumer.on_run()
+        prosumer.get_states()
+        self.assertAlmostEqual(states[-1]["export_price"], expected[-1])
+
+    def test_updates_recompile_what_they_change(self):
+        start = datetime(2024, 6, 1)
+        instants = [
+            start + timedelta(minutes=minutes) for minutes in range(0, 4320, 10)
+        ]
+        with TemporaryDirectory() as directory:
+            prosumer = build_prosumer(
+                self._config(directory),
+                None,
+                clock=SimulationClock(start),
+                auto_start=False,
+            )
+        table = prosumer.tariff_table
+        generation, measured = prosumer.generations
+        compiled = list(table._tables[prosumer.tariff_row])
+        measured.update_export_prices([20, 21], start=30)
+        generation.update_export_prices([0.5], start=3)
+        changed = [
+            slot
+            for slot, (before, after) in enumerate(
+                zip(compiled, table._tables[prosumer.tariff_row])
+            )
+            if before != after
+        ]
+        # 2 hours of measured prices and half an hour of generation prices a day.
+        self.assertEqual(changed, [3, 51, 60, 61, 62, 63, 99])
+        for instant, price in zip(instants, self._weighted_prices(prosumer, instants)):
+            self.assertAlmostEqual(prosumer.export_price_at(instant), price)
+        self.assertEqual(measured.export_price_at(start + timedelta(hours=30)), 20)
+        # The trace itself is left as it was, for whoever else maps it.
+        trace = load_trace("csv", Path(directory) / "prices.csv")
+        self.assertEqual(list(trace[30:32]), [10, 11])
+        with self.assertRaises(ValueError):
+            measured.update_export_prices([1, 2], start=71)
+
+
+class TickSchedulerTestCase(SimpleTestCase):
+    interval = 0.02
+
+    def schedule(self, scheduler: TickScheduler, jobs: dict, done: threading.Event):
+        """
+        Schedules each of `jobs`, name -> (function, interval, priority), as
+        one that records `(deadline, priority, name)` of its ticks in `calls`
+        before calling `function(handle, calls)`, and stops them once `done`.
+        """
+        calls, handles = [], {}
+
+        def job(name, function):
+            def run():
+                handle = handles[name]
+                calls.append((handle.deadline, handle.priority, name))
+                function(handle, calls)
+
+            return run
+
+        # Holds the timer thread off until every job has been scheduled.
+        with scheduler._condition:
+            for name, (function, interval, priority) in jobs.items():
+                handles[name] = scheduler.schedule(
+                    job(name, function), interval, priority
+                )
+        self.assertTrue(done.wait(5))
+        for handle in handles.values():
+            handle.stop()
+        return calls, handles
+
+    def test_runs_due_jobs_by_deadline_then_priority(self):
+        done = threading.Event()
+
+        def until_done(_handle, calls):
+            if len(calls) >= 20:
+                done.set()
+
+        calls, _ = self.schedule(
+            TickScheduler(),
+            {
+                # Aggregators are scheduled before their subsystems, and
+                # still run after them.
+                "aggregator": (until_done, self.interval, 1),
+                "leaf": (until_done, self.interval, 0),
+                "slow_leaf": (until_done, 2 * self.interval, 0),
+                "engine": (until_done, self.interval, -1),
+            },
+            done,
+        )
+        self.assertEqual(calls, sorted(calls, key=lambda call: call[:2]))
+        # Jobs of the same priority first run in the order they were scheduled.
+        first = [name for deadline, _, name in calls if deadline == calls[0][0]]
+        self.assertEqual(first[:2], ["engine", "leaf"])
+        self.assertEqual(first[-1], "aggregator")
+
+    def test_overruns_skip_missed_ticks(self):
+        done, skipped = threading.Event(), SKIPPED_TICKS.value
+
+        def overrun_once(_handle, calls):
+            if len(calls) == 1:
+                time.sleep(3.5 * self.interval)
+            elif len(calls) == 2:
+                done.set()
+
+        calls, _ = self.schedule(
+            TickScheduler(), {"job": (overrun_once, self.interval, 0)}, done
+        )
+        ticks = [round(deadline / self.interval) for deadline, *_ in calls[:2]]
+        # Ticks missed during the overrun aren't replayed.
+        self.assertGreaterEqual(ticks[1] - ticks[0], 4)
+        self.assertGreaterEqual(SKIPPED_TICKS.value - skipped, ticks[1] - ticks[0] - 1)
+
+    def test_sleeping_skips_ticks(self):
+        done = threading.Event()
+
+        def sleep_once(handle, calls):
+            if len(calls) == 1:
+                handle.sleep(2)
+            elif len(calls) == 2:
+                done.set()
+
+        calls, _ = self.schedule(
+            TickScheduler(), {"job": (sleep_once, self.interval, 0)}, done
+        )
+        ticks = [round(deadline / self.interval) for deadline, *_ in calls[:2]]
+        self.assertGreaterEqual(ticks[1] - ticks[0], 3)
+
+    def test_stopped_jobs_no_longer_run(self):
+        done = threading.Event()
+
+        def stop_after_three(handle, calls):
+            if len(calls) == 3:
+                handle.stop()
+                done.set()
+
+        scheduler = TickScheduler()
+        calls, handles = self.schedule(
+            scheduler, {"job": (stop_after_three, self.interval, 0)}, done
+        )
+        time.sleep(5 * self.interval)
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(handles["job"].stopped)
+        # A stopped job is dropped once it's due.
+        self.assertEqual(scheduler._heap, [])
+
+
+class MetricsTestCase(SimpleTestCase):
+    def test_histogram_exposition(self):
+        histogram = Histogram("test_seconds", "Test.", (0.1, 1))
+        child = histogram.labels(phase="a")
+        for value in (0.05, 0.5, 5):
+            child.observe(value)
+        self.assertEqual(
+            histogram.render()[2:],
+            [
+                'test_seconds_bucket{phase="a",le="0.1"} 1',
+                'test_seconds_bucket{phase="a",le="1"} 2',
+                'test_seconds_bucket{phase="a",le="+Inf"} 3',
+                'test_seconds_sum{phase="a"} 5.55',
+                'test_seconds_count{phase="a"} 3',
+            ],
+        )
+
+    def test_ticks_are_instrumented(self):
+        subsystem = Consumption(
+            id=1,
+            peak_demand=7,
+            profile={"source": "range_30m", "r0": [0.2] * 48, "r1": [0.8] * 48},
+            auto_start=False,
+        )
+        on_run_seconds = subsystem._phase_seconds[0]
+        count = on_run_seconds.count
+        subsystem.run()
+        self.assertEqual(on_run_seconds.count, count + 1)
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'prosumer_subsystem_phase_seconds_count{phase="on_run",'
+            'subsystem="Consumption"}',
+            response.content.decode(),
+        )
+
+
+class InterconnectedSubsystemTestCase(SimpleTestCase):
+    def test_aggregates_changed_subsystems_only(self):
+        prosumer = build_prosumer(
+            sample_config(), lambda states: None, auto_start=False
+        )
+        generation, consumption = prosumer.generations[0], prosumer.consumptions[0]
+        prosumer.on_run()
+        consumption_states = prosumer.consumption_states[consumption.id_]
+
+        generation.run()
+        prosumer.on_run()
+        self.assertGreater(generation.power, 0)
+        self.assertEqual(prosumer.generation, generation.power)
+        self.assertEqual(
+            prosumer.generation_states[generation.id_]["power"], generation.power
+        )
+        self.assertIs(prosumer.consumption_states[consumption.id_], consumption_states)
+
+
+class RecordingMqttClientPool:
+    "Stand-in for `MqttClientPool`, with one recording client per prosumer."
+
+    def __init__(self) -> None:
+        self.clients: dict[str, RecordingMqttClient] = {}
+
+    def publisher_for(self, vp_address: str, publishing=None) -> ProsumerPublisher:
+        client = self.clients[vp_address] = RecordingMqttClient()
+        return ProsumerPublisher(client, vp_address, **(publishing or {}))
+
+
+def seeded_configs() -> list[dict[str, any]]:
+    configs = []
+    for i in range(1, 5):
+        config = sample_config(f"::{i:x}")
+        config["moving_avg_periods"] = [1, 2]
+        for kind in ("generations", "consumptions"):
+            for subsystem in config[kind]:
+                profile = dict(subsystem["$profile"], seed=f"{i}:{kind}")
+                subsystem["$profile"] = profile
+        configs.append(config)
+    storage = configs[1]["storages"][0]
+    configs[1]["storages"].append(
+        {**storage, "id": 4, "max_charge_rate": 3, "max_discharge_rate": 4}
+    )
+    configs[1]["storage_dispatch"] = {"policy": "price_aware", "export_above": 4}
+    configs[1]["generations"][0]["export_price"] = {
+        "source": "time_of_use",
+        "prices": [1, 6] * 24,
+    }
+    configs[2]["storages"] = []
+    configs[2]["subsystem_reporting"] = ["consumption"]
+    configs[3]["moving_avg_periods"] = [1]
+    return configs
+
+
+class ManualScheduler:
+    "Stand-in for `TickScheduler` running every job by priority when ticked."
+
+    def __init__(self) -> None:
+        self.jobs: list[ScheduledJob] = []
+
+    def schedule(self, function, interval: float, priority: int = 0) -> ScheduledJob:
+        job = ScheduledJob(function, interval, priority)
+        self.jobs.append(job)
+        return job
+
+    def tick(self) -> None:
+        for job in sorted(self.jobs, key=lambda job: job.priority):
+            if not job.stopped:
+                job.function()
+
+
+class ProsumerHostTestCase(SimpleTestCase):
+    def test_hosts_fleet_on_shared_scheduler(self):
+        configs = [sample_config(f"::{i:x}") for i in range(1, 4)]
+        # Stepped as objects rather than by the columnar fleet.
+        configs[2]["publishing"] = {"heartbeat": 60}
+        # Sections the schema allows to leave out.
+        del configs[1]["storages"], configs[2]["storages"]
+        del configs[2]["moving_avg_periods"]
+        pool = RecordingMqttClientPool()
+        host = ProsumerHost(configs, pool, TickScheduler())
+        engine, engine_sizes = host.profile_engine, []
+        step = engine.step
+
+        def recording_step(instant=None):
+            engine_sizes.append(len(engine))
+            return step(instant)
+
+        with mock.patch.object(engine, "step", side_effect=recording_step):
+            host.start()
+            try:
+                deadline = time.monotonic() + 5
+                while time.monotonic() < deadline and not all(
+                    f"prosumers/{address[2:]}/net_export" in dict(client.published)
+                    for address, client in pool.clients.items()
+                ):
+                    time.sleep(0.05)
+            finally:
+                host.stop()
+        # The engine is only stepped once every prosumer registered with it.
+        self.assertEqual(engine_sizes[0], 2 * len(configs))
+        self.assertEqual(len(host.fleet), 2)
+        for address, client in pool.clients.items():
+            topics = dict(client.published)
+            self.assertEqual(topics[f"prosumers/{address[2:]}/isOnline"], "False")
+            self.assertIn(f"prosumers/{address[2:]}/generations/3/power", topics)
+        self.assertEqual(host.prosumers, [])
+
+    def test_steps_every_storage_once_per_tick(self):
+        configs, start = seeded_configs(), datetime(2024, 6, 1, 11, 50)
+        # Stepped as objects rather than by the columnar fleet.
+        configs[1]["ewma_periods"] = [1]
+        configs[3]["ewma_periods"] = [1]
+        clock, engine = SimulationClock(start), ProfileEngine(start)
+        tariffs = TariffTable(start)
+        subsystems, expected = [], []
+        for config in configs:
+            client = RecordingMqttClient()
+            publisher = ProsumerPublisher(client, config["settings"]["vpAddress"])
+            publisher.set_states(online_states(config))
+            prosumer = build_prosumer(
+                config,
+                publisher.publish_states,
+                profile_engine=engine,
+                tariff_table=tariffs,
+                clock=clock,
+                auto_start=False,
+            )
+            subsystems += subsystems_of(prosumer)
+            expected.append(client)
+        host_clock, scheduler = SimulationClock(start), ManualScheduler()
+        pool = RecordingMqttClientPool()
+        host = ProsumerHost(configs, pool, scheduler, host_clock)
+        host.start()
+        self.assertEqual(len(host.fleet), 2)
+        self.assertIs(host.fleet.storage_fleet, host.storage_fleet)
+        self.assertEqual(
+            len(host.storage_fleet), sum(len(c["storages"]) for c in configs)
+        )
+        with mock.patch.object(
+            host.storage_fleet, "step", wraps=host.storage_fleet.step
+        ) as step:
+            for _ in range(300):
+                for subsystem_clock in (clock, host_clock):
+                    subsystem_clock.advance(1)
+                engine.step(clock.now())
+                tariffs.step(clock.now())
+                for subsystem in subsystems:
+                    subsystem.run()
+                scheduler.tick()
+        self.assertEqual(step.call_count, 300)
+        for config, expected_client in zip(configs, expected):
+            client = pool.clients[config["settings"]["vpAddress"]]
+            self.assertEqual(client.published, expected_client.published)
+
+
+class ColumnarFleetTestCase(SimpleTestCase):
+    def test_publishes_what_the_subsystems_would(self):
+        configs, start = seeded_configs(), datetime(2024, 6, 1, 11, 50)
+        self.assertTrue(all(steps_columnar(config) for config in configs))
+        clock, engine = SimulationClock(start), ProfileEngine(start)
+        tariffs = TariffTable(start)
+        subsystems, expected = [], []
+        for config in configs:
+            client = RecordingMqttClient()
+            publisher = ProsumerPublisher(client, config["settings"]["vpAddress"])
+            prosumer = build_prosumer(
+                config,
+                publisher.publish_states,
+                profile_engine=engine,
+                tariff_table=tariffs,
+                clock=clock,
+                auto_start=False,
+            )
+            subsystems += subsystems_of(prosumer)
+            expected.append(client)
+        fleet_clock = SimulationClock(start)
+        clients = [RecordingMqttClient() for _ in configs]
+        fleet = ColumnarFleet(
+            configs,
+            [
+                ProsumerPublisher(client, config["settings"]["vpAddress"])
+                for client, config in zip(clients, configs)
+            ],
+            ProfileEngine(start),
+            TariffTable(start),
+            fleet_clock,
+        )
+        # Laps the rings of the 2 minute averages a few times.
+        for _ in range(400):
+            for subsystem_clock in (clock, fleet_clock):
+                subsystem_clock.advance(1)
+            engine.step(clock.now())
+            tariffs.step(clock.now())
+            for subsystem in subsystems:
+                subsystem.run()
+            fleet.profile_engine.step(fleet_clock.now())
+            fleet.tariff_table.step(fleet_clock.now())
+            fleet.tick(fleet_clock.now())
+        for client, expected_client in zip(clients, expected):
+            self.assertEqual(client.published, expected_client.published)
+
+    def test_invalidated_publishers_publish_everything_again(self):
+        configs, start = seeded_configs()[:2], datetime(2024, 6, 1, 11, 50)
+        clients = [RecordingMqttClient() for _ in configs]
+        publishers = [
+            ProsumerPublisher(client, config["settings"]["vpAddress"])
+            for client, config in zip(clients, configs)
+        ]
+        fleet = ColumnarFleet(
+            configs, publishers, ProfileEngine(start), TariffTable(start)
+        )
+        fleet.profile_engine.step(start)
+        published = []
+        for _ in range(2):
+            fleet.tick(start)
+            published.append([len(client.published) for client in clients])
+        publishers[1].invalidate()
+        fleet.tick(start)
+        # Every state of the invalidated prosumer is published again, as on the
+        # first tick, unlike those of the other.
+        self.assertEqual(len(clients[1].published) - published[1][1], published[0][1])
+        self.assertLess(len(clients[0].published) - published[1][0], published[0][0])
+
+    def test_publishes_a_nan_net_export_as_self_sustaining(self):
+        start = datetime(2024, 6, 1, 11, 50)
+        config = seeded_configs()[0]
+        config["consumptions"][0]["peak_demand"] = float("nan")
+        client = RecordingMqttClient()
+        fleet = ColumnarFleet(
+            [config],
+            [ProsumerPublisher(client, config["settings"]["vpAddress"])],
+            ProfileEngine(start),
+            TariffTable(start),
+        )
+        fleet.profile_engine.step(start)
+        fleet.tick(start)
+        self.assertIn(("prosumers/1/status", "SELF SUSTAINING"), client.published)
+
+
+class IdleSkippingTestCase(SimpleTestCase):
+    def test_skipping_flat_stretches_keeps_states(self):
+        daylight = [0.0] * 14 + [0.5, 0.7] * 12 + [0.0] * 10
+        generations = []
+        for skipping in (False, True):
+            clock = SimulationClock(datetime(2024, 6, 1))
+            generation = Generation(
+                id=3,
+                installed_capacity=10,
+                export_price=5,
+                profile={"source": "range_30m", "r0": daylight, "r1": daylight},
+                moving_avg_periods=[1, 60],
+                moving_avg_exact_limit=30,
+                idle_skipping=skipping,
+                clock=clock,
+                auto_start=False,
+            )
+            generations.append((clock, generation))
+        for _ in range(86400 + 3600):
+            for clock, generation in generations:
+                clock.advance(1)
+                generation.run()
+            (_, always), (_, skipping) = generations
+            self.assertEqual(always.get_states(), skipping.get_states())
+        self.assertGreater(generations[1][1]._idle_ticks, 0)
+
+
+class CheckpointTestCase(SimpleTestCase):
+    def _build(self, config: dict[str, any]):
+        clock, states = SimulationClock(datetime(2024, 6, 1)), []
+        prosumer = build_prosumer(config, states.append, clock=clock, auto_start=False)
+        return clock, prosumer, states
+
+    def _run(self, clock: SimulationClock, prosumer, ticks: int) -> None:
+        for _ in range(ticks):
+            clock.advance(1)
+            for subsystem in subsystems_of(prosumer):
+                subsystem.run()
+
+    def test_restored_prosumer_carries_on(self):
+        config = dict(
+            sample_config(),
+            moving_avg_periods=[1, 90],
+            ewma_periods=[30],
+            moving_avg_exact_limit=30,
+        )
+        clock, prosumer, states = self._build(config)
+        self._run(clock, prosumer, 5400)
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "prosumer.ckpt"
+            Checkpointer(prosumer, path).save()
+            restored_clock, restored, restored_states = self._build(config)
+            self.assertTrue(Checkpointer(restored, path).restore())
+        self.assertEqual(
+            restored.generations[0].compiled_profile,
+            prosumer.generations[0].compiled_profile,
+        )
+        self.assertEqual(
+            restored.storages[0].state_of_charge, prosumer.storages[0].state_of_charge
+        )
+        restored_clock.instant = clock.instant
+        self._run(clock, prosumer, 600)
+        self._run(restored_clock, restored, 600)
+        self.assertEqual(restored_states[-1]["generations"], states[-1]["generations"])
+        self.assertEqual(restored_states[-1]["storages"], states[-1]["storages"])
+        # Totals are summed afresh rather than from deltas, so may differ in ulps.
+        for field, value in states[-1].items():
+            if isinstance(value, float):
+                self.assertAlmostEqual(restored_states[-1][field], value, msg=field)
+
+    def test_restored_profile_keeps_its_start(self):
+        clock, prosumer, _ = self._build(sample_config())
+        self._run(clock, prosumer, 60)
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "prosumer.ckpt"
+            Checkpointer(prosumer, path).save()
+            restored = build_prosumer(
+                sample_config(),
+                lambda states: None,
+                clock=SimulationClock(datetime(2024, 6, 3, 12)),
+                auto_start=False,
+            )
+            Checkpointer(restored, path).restore()
+        for subsystem in (*restored.generations, *restored.consumptions):
+            self.assertEqual(subsystem.date_started_at, datetime(2024, 6, 1))
+
+    def test_changed_periods_start_over(self):
+        clock, prosumer, _ = self._build(sample_config())
+        self._run(clock, prosumer, 120)
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "prosumer.ckpt"
+            checkpointer = Checkpointer(prosumer, path)
+            self.assertFalse(checkpointer.restore())
+            checkpointer.save()
+            config = dict(sample_config(), moving_avg_periods=[1, 5, 15, 30, 90])
+            _, restored, _ = self._build(config)
+            with mock.patch("builtins.print"):
+                self.assertTrue(Checkpointer(restored, path).restore())
+        averages = restored.generations[0].rolling_averages["power"]
+        self.assertEqual(set(averages.as_dict().values()), {0.0})
+        self.assertEqual(
+            restored.storages[0].state_of_charge, prosumer.storages[0].state_of_charge
+        )
+
+
+class StateApiTestCase(SimpleTestCase):
+    def setUp(self):
+        self.clock = SimulationClock(datetime(2024, 6, 1, 12))
+        self.snapshots = api.SnapshotCache(history=60)
+        self.prosumer = build_prosumer(
+            sample_config(), self.snapshots, clock=self.clock, auto_start=False
+        )
+        patcher = mock.patch.object(api, "SNAPSHOTS", self.snapshots)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, ticks: int) -> None:
+        for _ in range(ticks):
+            self.clock.advance(1)
+            for subsystem in subsystems_of(self.prosumer):
+                subsystem.run()
+
+    def test_snapshots_are_kept_only_when_served(self):
+        config = dict(sample_config(), api={"history": 60})
+        for serves_api in (False, True):
+            runtime = ProsumerRuntime(config, serves_api)
+            runtime.mqtt_client = mock.Mock()
+            runtime.initialize_subsystems()
+            for subsystem in subsystems_of(runtime.master_subsystem):
+                subsystem.stop()
+            self.assertEqual(runtime.snapshots is not None, serves_api)
+
+    def test_serves_snapshot_of_last_tick(self):
+        self.assertEqual(self.client.get("/api/state").status_code, 503)
+        states = []
+        self.snapshots.forward = states.append
+        self._run(90)
+        response = self.client.get("/api/state")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.content), json.loads(api.serialize(states[-1]))
+        )
+        etag = response["ETag"]
+        cached = self.client.get("/api/state", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+
+        storage = self.client.get("/api/state/storages/2")
+        self.assertEqual(
+            json.loads(storage.content),
+            json.loads(api.serialize(states[-1]["storages"]["2"])),
+        )
+        self.assertEqual(self.client.get("/api/state/consumptions/1").status_code, 404)
+        history = json.loads(self.client.get("/api/history?seconds=10").content)
+        self.assertEqual(len(history["timestamp"]), 10)
+        self.assertEqual(history["net_export"][-1], states[-1]["net_export"])
+        history = json.loads(self.client.get("/api/history").content)
+        self.assertEqual(len(history["generation"]), 60)
+        self.assertEqual(self.client.get("/api/history?seconds=x").status_code, 400)
+        # Unchanged subsystems keep their states object, body and ETag.
+        self.snapshots(states[-1])
+        self.assertEqual(
+            self.client.get(
+                "/api/state/storages/2", HTTP_IF_NONE_MATCH=storage["ETag"]
+            ).status_code,
+            304,
+        )
+        self.assertEqual(
+            self.client.get("/api/state", HTTP_IF_NONE_MATCH=etag).status_code, 200
+        )
+
+    def test_streams_every_tick(self):
+        async def stream_ticks(ticks: int) -> list[dict]:
+            received, sent = asyncio.Queue(), []
+            await received.put({"type": "websocket.connect"})
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) > ticks:
+                    await received.put({"type": "websocket.disconnect"})
+                else:
+                    loop.call_soon(self._run, 1)
+
+            loop = asyncio.get_running_loop()
+            await asyncio.wait_for(api.stream({}, received.get, send), 5)
+            return sent
+
+        self._run(1)
+        sent = asyncio.run(stream_ticks(3))
+        self.assertEqual(sent[0], {"type": "websocket.accept"})
+        timestamps = [
+            json.loads(message["text"])["last_updated_at"] for message in sent[1:]
+        ]
+        self.assertEqual(len(set(timestamps)), 3)
+
+
+class SimulationTestCase(SimpleTestCase):
+    def _seeded_config(self) -> dict[str, any]:
+        config = sample_config()
+        for kind in ("generations", "consumptions"):
+            for subsystem in config[kind]:
+                subsystem["$profile"] = dict(subsystem["$profile"], seed=kind)
+        return config
+
+    def assertStatesAlmostEqual(self, expected: dict, states: dict):
+        self.assertEqual(list(expected), list(states))
+        for key, value in expected.items():
+            if isinstance(value, dict):
+                self.assertStatesAlmostEqual(value, states[key])
+            elif isinstance(value, float):
+                self.assertAlmostEqual(value, states[key], places=9, msg=key)
+            else:
+                self.assertEqual(value, states[key], key)
+
+    def assertSimulatesTickByTick(
+        self, config: dict[str, any], hours: int = 2
+    ) -> list[dict]:
+        start = datetime(2024, 6, 1, 7, 50)
+        end = start + timedelta(hours=hours)
+        ticks = hours * 3600
+        # Subsystem states are updated in place by the next tick.
+        serialize, expected, states = SNAPSHOT_SERIALIZERS["json"](), [], []
+        clock = SimulationClock(start)
+        prosumer = build_prosumer(
+            config,
+            lambda tick: expected.append(json.loads(serialize(tick))),
+            clock=clock,
+            auto_start=False,
+        )
+        for _ in range(ticks):
+            clock.advance(1)
+            for subsystem in subsystems_of(prosumer):
+                subsystem.run()
+        result = simulate(
+            config, start, end, lambda tick: states.append(json.loads(serialize(tick)))
+        )
+        self.assertEqual(result["ticks"], ticks)
+        self.assertEqual(len(states), ticks)
+        self.assertEqual(states[-1]["last_updated_at"], end.isoformat())
+        for expected_tick, tick in zip(expected, states):
+            self.assertStatesAlmostEqual(expected_tick, tick)
+        return states
+
+    def test_matches_running_the_subsystems_tick_by_tick(self):
+        states = self.assertSimulatesTickByTick(self._seeded_config())
+        self.assertTrue(any(tick["storages"]["2"]["power"] for tick in states))
+
+    def test_matches_running_variants_tick_by_tick(self):
+        with TemporaryDirectory() as directory:
+            trace = Path(directory, "load.npy")
+            np.save(trace, np.linspace(1, 6, 500, dtype=np.float32))
+            price_aware = self._seeded_config()
+            price_aware["generations"][0]["export_price"] = {
+                "source": "time_of_use",
+                "prices": [1, 6] * 24,
+            }
+            price_aware["storage_dispatch"] = {
+                "policy": "price_aware",
+                "export_above": 4,
+            }
+            measured = self._seeded_config()
+            measured["consumptions"][0]["$profile"] = {
+                "source": "npy",
+                "path": str(trace),
+                "interval": 30,
+            }
+            variants = {
+                "ewma": dict(self._seeded_config(), ewma_periods=[1, 30]),
+                # Windows beyond the exact limit are rolled up into buckets.
+                "bucketed": dict(
+                    self._seeded_config(),
+                    moving_avg_periods=[1, 90],
+                    moving_avg_exact_limit=30,
+                ),
+                "reporting": dict(
+                    self._seeded_config(), subsystem_reporting=["consumption"]
+                ),
+                "price_aware": price_aware,
+                "measured": measured,
+            }
+            for name, config in variants.items():
+                with self.subTest(name):
+                    self.assertSimulatesTickByTick(
+                        config, 2 if name == "bucketed" else 1
+                    )
+
+    def test_hands_a_nan_net_export_as_self_sustaining(self):
+        config, start, statuses = self._seeded_config(), datetime(2024, 6, 1), set()
+        config["consumptions"][0]["peak_demand"] = float("nan")
+        simulate(
+            config,
+            start,
+            start + timedelta(minutes=1),
+            lambda tick: statuses.add(tick["status"]),
+        )
+        self.assertEqual(statuses, {ProsumerStatus.SELF_SUSTAIN.value})
+
+    def test_writes_every_nth_tick(self):
+        config, start = self._seeded_config(), datetime(2024, 6, 1)
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "simulation.jsonl"
+            with open(path, "w", encoding="utf-8") as file:
+                simulate(
+                    config,
+                    start,
+                    start + timedelta(hours=1),
+                    JsonLinesWriter(file, 600),
+                )
+            lines = path.read_text(encoding="utf-8").splitlines()
+        self.assertEqual(
+            [json.loads(line)["last_updated_at"] for line in lines],
+            [(start + timedelta(seconds=1 + 600 * i)).isoformat() for i in range(6)],
+        )
+
+    def test_records_every_tick_and_hands_every_nth(self):
+        config, start, states = self._seeded_config(), datetime(2024, 6, 1, 9), []
+        with TemporaryDirectory() as directory:
+            recorder = StateRecorder(directory, chunk_size=1000)
+            simulate(
+                config,
+                start,
+                start + timedelta(hours=1),
+                states.append,
+                recorder=recorder,
+                every=600,
+            )
+            paths = sorted(Path(directory, "net_export").iterdir())
+            chunks = [np.load(path) for path in paths]
+            power = np.load(Path(directory, "storages/2/power/000003.npy"))
+        self.assertEqual([len(chunk) for chunk in chunks], [1000] * 3 + [600])
+        net_export = np.concatenate(chunks)
+        self.assertEqual(len(states), 6)
+        for i, tick in enumerate(states):
+            self.assertEqual(tick["net_export"], net_export[600 * i])
+        self.assertEqual(states[-1]["storages"]["2"]["power"], power[0])
+
+
+class StateRecorderTestCase(SimpleTestCase):
+    def test_npy_files_load_with_numpy(self):
+        with TemporaryDirectory() as directory:
+            for size in (0, 1, 5, 1000):
+                path = Path(directory, f"{size}.npy")
+                column = array("d", [i / 3 for i in range(size)])
+                write_npy(path, column)
+                loaded = np.load(path, mmap_mode="r")
+                self.assertEqual(loaded.dtype, np.float64)
+                self.assertEqual(loaded.shape, (size,))
+                self.assertEqual(loaded.tolist(), column.tolist())
+                # The data starts on a 64 byte boundary, as numpy writes it.
+                self.assertEqual(loaded.offset % 64, 0)
+                del loaded
+            self.assertEqual(list(Path(directory).glob("*.tmp")), [])
+
+    def test_flushes_every_chunk(self):
+        clock, forwarded = SimulationClock(datetime(2024, 6, 1, 12)), []
+        with TemporaryDirectory() as directory:
+            recorder = StateRecorder(directory, forward=forwarded.append, chunk_size=4)
+            prosumer = build_prosumer(
+                sample_config(), recorder, clock=clock, auto_start=False
+            )
+            recorder.bind(prosumer)
+            expected = []
+            for _ in range(10):
+                clock.advance(1)
+                for subsystem in subsystems_of(prosumer):
+                    subsystem.run()
+                expected.append(
+                    [forwarded[-1][state] for state in ("storage", "net_export")]
+                    + [prosumer.storages[0].power]
+                )
+            self.assertEqual(recorder.rows, 2)
+            recorder.flush()
+            self.assertEqual((recorder.rows, recorder.chunk), (0, 3))
+            recorded = {}
+            for name in ("timestamp", "storage", "net_export", "storages/2/power"):
+                paths = sorted(Path(directory, name).iterdir())
+                self.assertEqual([path.name for path in paths][-1], "000002.npy")
+                recorded[name] = np.concatenate([np.load(path) for path in paths])
+        self.assertEqual(len(forwarded), 10)
+        self.assertEqual(
+            recorded["timestamp"].tolist(),
+            [tick["last_updated_at"].timestamp() for tick in forwarded],
+        )
+        self.assertEqual(
+            np.column_stack(
+                [
+                    recorded[name]
+                    for name in ("storage", "net_export", "storages/2/power")
+                ]
+            ).tolist(),
+            expected,
+        )
+
+
+class EnsembleTestCase(SimpleTestCase):
+    def test_matches_simulation_of_member(self):
+        config, start = sample_config(), datetime(2024, 6, 1, 8, 10)
+        # Surplus is exported rather than stored every other half hour.
+        config["generations"][0]["export_price"] = {
+            "source": "time_of_use",
+            "prices": [1, 6] * 24,
+        }
+        config["storage_dispatch"] = {"policy": "price_aware", "export_above": 4}
+        end = start + timedelta(hours=2)
+        means = simulate_members([config], range(2), start, end, seed=3)
+        for member in range(2):
+            states = []
+            simulate(member_config(config, "3:0", member), start, end, states.append)
+            for i in range(4):
+                ticks = states[i * 1800 : (i + 1) * 1800]
+                for field in ENSEMBLE_FIELDS:
+                    self.assertAlmostEqual(
+                        means[field][i][member], fmean(tick[field] for tick in ticks)
+                    )
+
+    def test_rejects_measured_traces(self):
+        config, start = sample_config(), datetime(2024, 6, 1)
+        config["consumptions"][0]["$profile"] = {"source": "npy", "path": "load.npy"}
+        with self.assertRaisesRegex(ValueError, "range_30m profiles only"):
+            run_ensemble(config, 2, start, start + timedelta(hours=1))
+
+    def test_bands_are_reproducible_and_ordered(self):
+        config, start = dict(sample_config(), storages=[]), datetime(2024, 6, 1)
+        end = start + timedelta(hours=12)
+        bands = run_ensemble(config, 50, start, end, seed="a")
+        self.assertEqual(bands, run_ensemble(config, 50, start, end, seed="a"))
+        self.assertEqual(len(bands["slots"]), 24)
+        for field in ENSEMBLE_FIELDS:
+            for low, median, high in zip(*bands[field].values()):
+                self.assertLessEqual(low, median)
+                self.assertLessEqual(median, high)
+        self.assertLess(bands["generation"][5][20], bands["generation"][95][20])
+
+
+class ShardedFleetTestCase(SimpleTestCase):
+    def test_matches_in_process_and_survives_crashes(self):
+        configs = []
+        for i in range(4):
+            config = sample_config(f"::{i:x}")
+            config["generations"][0]["$profile"]["seed"] = i
+            config["consumptions"][0]["$profile"]["seed"] = i
+            configs.append(config)
+        origin = datetime(2024, 6, 1)
+        fleet = ShardedFleet(configs, workers=2, tick_timeout=10, origin=origin)
+        self.addCleanup(fleet.stop)
+        fleet.start()
+
+        clock, engine = SimulationClock(origin), ProfileEngine(origin)
+        prosumers = [
+            build_prosumer(
+                config,
+                lambda states: None,
+                profile_engine=engine,
+                clock=clock,
+                auto_start=False,
+            )
+            for config in configs
+        ]
+        for _ in range(3):
+            clock.advance(3600)
+            engine.step(clock.instant)
+            for prosumer in prosumers:
+                for subsystem in subsystems_of(prosumer):
+                    subsystem.run()
+            totals = dict(fleet.tick(clock.instant))
+        self.assertAlmostEqual(
+            totals["generation"], sum(prosumer.generation for prosumer in prosumers)
+        )
+        # A worker skipped mid tick only leaves torn rows in the half of the
+        # array that isn't read until it finished.
+        torn = fleet.size * (1 - fleet._workers[0].written)
+        fleet.values[torn : torn + fleet.size] = array("d", [float("nan")]) * fleet.size
+        self.assertEqual(fleet._aggregate(clock.instant), totals)
+
+        fleet._workers[0].process.kill()
+        fleet._workers[0].process.join()
+        fleet.tick(clock.advance(1))
+        self.assertEqual(fleet.restarts, 1)
+        deadline = time.monotonic() + 10
+        while not fleet._workers[0].ready and time.monotonic() < deadline:
+            fleet.tick(clock.advance(1))
+            time.sleep(0.05)
+        self.assertTrue(fleet._workers[0].ready)
+
+
+class AsgiTestCase(SimpleTestCase):
+    def test_asgi_application_streams_the_prosumer(self):
+        def connect_to_grid(runtime):
+            runtime.mqtt_client = mock.Mock()
+
+        async def first_tick() -> list[dict]:
+            received, sent = asyncio.Queue(), []
+            await received.put({"type": "websocket.connect"})
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 2:
+                    await received.put({"type": "websocket.disconnect"})
+
+            scope = {"type": "websocket", "path": "/api/stream"}
+            await asyncio.wait_for(asgi.application(scope, received.get, send), 5)
+            return sent
+
+        with mock.patch.object(
+            ProsumerRuntime,
+            "connect_to_grid",
+            autospec=True,
+            side_effect=connect_to_grid,
+        ), mock.patch.object(ProsumerConfig, "runtime", None), mock.patch.object(
+            api, "SNAPSHOTS", None
+        ), mock.patch.dict(
+            settings.PROSUMER_CONFIG, api=None
+        ):
+            # Started on import, as by an ASGI server, which doesn't set RUN_MAIN.
+            sys.modules.pop("virtual_prosumer.asgi", None)
+            asgi = importlib.import_module("virtual_prosumer.asgi")
+            try:
+                sent = asyncio.run(first_tick())
+            finally:
+                ProsumerConfig.runtime.stop()
+        self.assertEqual(sent[0], {"type": "websocket.accept"})
+        self.assertIn("net_export", json.loads(sent[1]["text"]))
+
+
+class StandaloneRuntimeTestCase(SimpleTestCase):
+    def test_starts_without_importing_django(self):
+        script = (
+            "import sys\n"
+            "from prosumer.__main__ import main\n"
+            "from virtual_prosumer.config_loader import load_config\n"
+            "from prosumer.factory import build_prosumer\n"
+            "from prosumer.runtime import ProsumerRuntime\n"
+            "runtime = ProsumerRuntime(load_config('prosumer.yaml'))\n"
+            "build_prosumer(runtime.config, print, auto_start=False)\n"
+            "print(sorted(name for name in sys.modules if name.startswith('django')))\n"
+        )
+        env = {
+            **os.environ,
+            "PROSUMER_LOCATION": "0, 0",
+            "PROSUMER_MQTT_SERVER": "127.0.0.1",
+            "PROSUMER_MQTT_PORT": "1883",
+            "PROSUMER_VP_ADDRESS": "::1",
+        }
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=Path(__file__).parent.parent,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.stdout.splitlines()[-1], "[]")
@@ -0,0 +1,311 @@
+"""
+A minimal asyncio MQTT 3.1.1 client, for publishing retained states.
+"""
+
+import asyncio
+import struct
+import threading
+import traceback
+from itertools import count, islice
+from typing import Callable, Optional
+
+from utils.metrics import REGISTRY, Counter
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+COALESCED = REGISTRY.register(
+    Counter(
+        "prosumer_mqtt_coalesced_total",
+        "Queued MQTT messages replaced by a newer one for the same topic.",
+    )
+).labels()
+
+
+def encode_string(value: str | bytes) -> bytes:
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack("!H", len(data)) + data
+
+
+def encode_packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    header, length = bytearray([packet_type << 4 | flags]), len(body)
+    while True:
+        length, byte = divmod(length, 128)
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+async def read_packet(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    """
+    Reads one packet, and returns its type, its flags and its body.
+    """
+    first = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+
+def connect_packet(
+    client_id: str, keepalive: int, will: Optional[tuple[str, bytes, bool]] = None
+) -> bytes:
+    flags, payload = 0x02, encode_string(client_id)  # clean session
+    if will is not None:
+        topic, will_payload, retain = will
+        flags |= 0x04 | (0x20 if retain else 0)
+        payload += encode_string(topic) + encode_string(will_payload)
+    variable_header = encode_string("MQTT") + struct.pack("!BBH", 4, flags, keepalive)
+    return encode_packet(CONNECT, 0, variable_header + payload)
+
+
+def publish_packet(
+    topic: str, payload: bytes, retain: bool, qos: int = 0, packet_id: int = 0
+) -> bytes:
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return encode_packet(PUBLISH, qos << 1 | retain, body + payload)
+
+
+def _to_bytes(payload: any) -> bytes:
+    if payload is None:
+        return b""
+    if isinstance(payload, bytes):
+        return payload
+    return str(payload).encode()
+
+
+class AsyncMqttTransport:
+    """
+    Publishes MQTT messages from any thread, over a connection served by an
+    asyncio loop in a thread of its own.
+
+    Unsent messages are queued per topic, for at most `max_queued` topics. A
+    message for a topic that's still queued replaces the queued one, so a slow
+    broker receives the latest retained value of each topic rather than a
+    backlog of superseded ones. Once the queue is full, `publish` blocks the
+    calling thread until there's room, pushing back on the tick instead of
+    growing without bound.
+
+    Queued messages are written in batches of up to `batch_size` before
+    draining the socket. With `qos` 1, at most `max_inflight` messages await
+    their PUBACK, and the rest stay queued, where they can still be replaced.
+    Messages unacknowledged when the connection drops are queued again on
+    reconnect, unless superseded meanwhile.
+
+    A PINGREQ is sent every half `keepalive`, and a connection whose PINGRESP
+    doesn't arrive within `ping_timeout` is dropped as half-open. Whatever
+    drops the connection, it's reconnected after `reconnect_delay`.
+
+    `on_connect` is called from the thread of the loop, and may race with the
+    threads publishing.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        port: int,
+        client_id: str,
+        qos: int = 0,
+        max_queued: int = 10000,
+        max_inflight: int = 20,
+        batch_size: int = 100,
+        keepalive: int = 60,
+        ping_timeout: float = 10,
+        reconnect_delay: float = 1,
+        on_connect: Optional[Callable[["AsyncMqttTransport"], None]] = None,
+    ) -> None:
+        if qos not in (0, 1):
+            raise ValueError(f"Unsupported QoS: {qos}")
+        self.server = server
+        self.port = port
+        self.client_id = client_id
+        self.qos = qos
+        self.max_queued = max_queued
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.keepalive = keepalive
+        self.ping_timeout = ping_timeout
+        self.reconnect_delay = reconnect_delay
+        self.on_connect = on_connect
+        self.connected = threading.Event()
+        # topic -> (payload, retain), oldest first.
+        self._queue: dict[str, tuple[bytes, bool]] = {}
+        self._queue_changed = threading.Condition()
+        # packet id -> (topic, payload, retain)
+        self._unacked: dict[int, tuple[str, bytes, bool]] = {}
+        self._packet_ids = count()
+        self._will: Optional[tuple[str, bytes, bool]] = None
+        self._stopping = False
+        self._loop = asyncio.new_event_loop()
+        self._wakeup = asyncio.Event()
+        self._acked = asyncio.Event()
+        self._ponged = asyncio.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def will_set(
+        self, topic: str, payload: any = None, qos: int = 0, retain: bool = False
+    ) -> None:
+        self._will = (topic, _to_bytes(payload), retain)
+
+    def publish(self, topic: str, payload: any = None, retain: bool = False) -> None:
+        message = (_to_bytes(payload), retain)
+        with self._queue_changed:
+            if topic in self._queue:
+                COALESCED.inc()
+            else:
+                while len(self._queue) >= self.max_queued and not self._stopping:
+                    self._queue_changed.wait()
+            was_empty = not self._queue
+            self._queue[topic] = message
+        if was_empty:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _take(self, size: int) -> list[tuple[str, tuple[bytes, bool]]]:
+        with self._queue_changed:
+            batch = [
+                (topic, self._queue.pop(topic))
+                for topic in list(islice(self._queue, size))
+            ]
+            if batch:
+                self._queue_changed.notify_all()
+        return batch
+
+    def _requeue_unacked(self) -> None:
+        with self._queue_changed:
+            for topic, payload, retain in self._unacked.values():
+                self._queue.setdefault(topic, (payload, retain))
+        self._unacked.clear()
+
+    async def _wait_for_acks(self, limit: int) -> None:
+        while len(self._unacked) > limit:
+            self._acked.clear()
+            await self._acked.wait()
+
+    async def _send(self, writer: asyncio.StreamWriter) -> None:
+        while True:
+            self._wakeup.clear()
+            size = self.batch_size
+            if self.qos:
+                await self._wait_for_acks(self.max_inflight - 1)
+                size = min(size, self.max_inflight - len(self._unacked))
+            batch = self._take(size)
+            if not batch:
+                if self._stopping:
+                    await self._wait_for_acks(0)
+                    writer.write(encode_packet(DISCONNECT, 0, b""))
+                    await writer.drain()
+                    return
+                await self._wakeup.wait()
+                continue
+            for topic, (payload, retain) in batch:
+                packet_id = 0
+                if self.qos:
+                    packet_id = next(self._packet_ids) % 0xFFFF + 1
+                    self._unacked[packet_id] = (topic, payload, retain)
+                writer.write(
+                    publish_packet(topic, payload, retain, self.qos, packet_id)
+                )
+            await writer.drain()
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            packet_type, _flags, body = await read_packet(reader)
+            if packet_type == PUBACK:
+                (packet_id,) = struct.unpack("!H", body[:2])
+                self._unacked.pop(packet_id, None)
+                self._acked.set()
+            elif packet_type == PINGRESP:
+                self._ponged.set()
+
+    async def _ping(self, writer: asyncio.StreamWriter) -> None:
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self._ponged.clear()
+            writer.write(encode_packet(PINGREQ, 0, b""))
+            try:
+                await asyncio.wait_for(self._ponged.wait(), self.ping_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError(
+                    f"No PINGRESP within {self.ping_timeout}s"
+                ) from None
+
+    async def _serve_connection(self) -> None:
+        reader, writer = await asyncio.open_connection(self.server, self.port)
+        try:
+            writer.write(connect_packet(self.client_id, self.keepalive, self._will))
+            packet_type, _flags, body = await read_packet(reader)
+            if packet_type != CONNACK or body[1] != 0:
+                raise ConnectionError(f"Connection refused with code {body[1]}")
+            self._requeue_unacked()
+            self.connected.set()
+            print("MQTT Client connected")
+            if self.on_connect is not None:
+                self.on_connect(self)
+            tasks = [
+                asyncio.create_task(self._send(writer)),
+                asyncio.create_task(self._receive(reader)),
+                asyncio.create_task(self._ping(writer)),
+            ]
+            try:
+                done, _pending = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                for task in tasks:
+                    task.cancel()
+            for task in done:
+                task.result()
+        finally:
+            self.connected.clear()
+            writer.close()
+
+    async def _run(self) -> None:
+        # Connects even if already stopping, to send what's still queued. A
+        # served connection only ends without an error once it's all sent.
+        while True:
+            try:
+                await self._serve_connection()
+                return
+            except (OSError, asyncio.IncompleteReadError) as error:
+                print(f"MQTT Client Disconnected! {error!r}")
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"MQTT Client Disconnected! {error!r}")
+                traceback.print_exc()
+            with self._queue_changed:
+                if self._stopping and not self._queue and not self._unacked:
+                    return
+            await asyncio.sleep(self.reconnect_delay)
+
+    def loop_start(self) -> None:
+        """
+        Starts connecting and publishing from a thread of its own.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._loop.run_until_complete, args=(self._run(),), daemon=True
+            )
+            self._thread.start()
+
+    def disconnect(self) -> None:
+        """
+        Disconnects once every queued message has been sent and acknowledged.
+        """
+        with self._queue_changed:
+            self._stopping = True
+            self._queue_changed.notify_all()
+        self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def loop_stop(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -1,3 +1,78 @@
-from django.shortcuts import render
+from math import isfinite
 
-# Create your views here.
+from django.http import HttpRequest, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
+from utils.metrics import REGISTRY
+
+from prosumer import api
+
+
+def metrics(_request: HttpRequest) -> HttpResponse:
+    """
+    Serves the metrics of this process in the Prometheus text format.
+    """
+    return HttpResponse(
+        REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def _not_ready() -> HttpResponse:
+    response = HttpResponse(status=503)
+    response["Retry-After"] = "1"
+    return response
+
+
+def _cached(request: HttpRequest, etag: str, body: bytes) -> HttpResponse:
+    # Dashboards polling every tick mostly get a 304 for unchanged states.
+    etags = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in etags or "*" in etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+@require_safe
+def state(request: HttpRequest) -> HttpResponse:
+    """
+    Serves the states of the last tick, as published over MQTT.
+    """
+    snapshot = api.SNAPSHOTS and api.SNAPSHOTS.snapshot
+    if not snapshot:
+        return _not_ready()
+    return _cached(request, snapshot.etag, snapshot.body)
+
+
+@require_safe
+def subsystem_state(request: HttpRequest, entity: str, id_: str) -> HttpResponse:
+    """
+    Serves the states of one reported subsystem, e.g. `generations/3`.
+    """
+    snapshot = api.SNAPSHOTS and api.SNAPSHOTS.snapshot
+    if not snapshot:
+        return _not_ready()
+    cached = snapshot.subsystem(entity, id_)
+    if cached is None:
+        return HttpResponse(status=404)
+    return _cached(request, *cached)
+
+
+@require_safe
+def history(request: HttpRequest) -> HttpResponse:
+    """
+    Serves the aggregate states of the last `seconds`, or of every tick kept.
+    """
+    snapshot = api.SNAPSHOTS and api.SNAPSHOTS.snapshot
+    if not snapshot:
+        return _not_ready()
+    seconds = request.GET.get("seconds")
+    try:
+        seconds = float(seconds) if seconds is not None else None
+    except ValueError:
+        seconds = float("nan")
+    if seconds is not None and not isfinite(seconds):
+        return HttpResponse("seconds: expected a number", status=400)
+    return _cached(request, *snapshot.history_window(seconds))
@@ -0,0 +1,93 @@
+import json
+import mmap
+import os
+from array import array
+from pathlib import Path
+
+# Magic and format version of checkpoint files.
+MAGIC = b"PROSUMERCKPT\x00\x01"
+
+# Arrays are aligned to 8 bytes within the file, so they can be cast in place.
+_ALIGNMENT = 8
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % _ALIGNMENT)
+
+
+def write_checkpoint(
+    path: str | Path, meta: dict[str, any], arrays: dict[str, array]
+) -> None:
+    """
+    Atomically writes a checkpoint of scalar `meta` values and of named arrays:
+    the magic, the length of a JSON header, the header, then the raw arrays.
+    The previous checkpoint stays intact until the new one replaced it.
+    """
+    path = Path(path)
+    layout, offset = {}, 0
+    for name, values in arrays.items():
+        layout[name] = (values.typecode, offset, len(values))
+        size = len(values) * values.itemsize
+        offset += size + len(_padding(size))
+    header = json.dumps({"meta": meta, "arrays": layout}).encode()
+    header += b" " * (-(len(MAGIC) + 4 + len(header)) % _ALIGNMENT)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(4, "little"))
+        file.write(header)
+        for values in arrays.values():
+            file.write(values)
+            file.write(_padding(len(values) * values.itemsize))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class Checkpoint:
+    """
+    A checkpoint written by `write_checkpoint`, memory-mapped for reading. Its
+    arrays are views into the mapping, valid until the checkpoint is closed.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = len(MAGIC) + 4
+            if self._mmap[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a checkpoint")
+            length = int.from_bytes(self._mmap[len(MAGIC) : start], "little")
+            header = json.loads(self._mmap[start : start + length])
+        except Exception:
+            self._mmap.close()
+            raise
+        self.meta: dict[str, any] = header["meta"]
+        self._layout: dict[str, list] = header["arrays"]
+        self._data_start = start + length
+        self._views: list[memoryview] = []
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._layout
+
+    def __getitem__(self, name: str) -> memoryview:
+        typecode, offset, count = self._layout[name]
+        start = self._data_start + offset
+        size = count * array(typecode).itemsize
+        if start + size > len(self._mmap):
+            raise ValueError(f"Checkpoint array {name} is truncated")
+        view = memoryview(self._mmap)[start : start + size].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def close(self) -> None:
+        for view in self._views:
+            view.release()
+        self._views.clear()
+        self._mmap.close()
+
+    def __enter__(self) -> "Checkpoint":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
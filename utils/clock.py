@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+
+class Clock:
+    """
+    Wall clock time.
+    """
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+
+class SimulationClock(Clock):
+    """
+    Clock that only moves when advanced, for running simulations faster (or
+    slower) than real time.
+    """
+
+    def __init__(self, start: datetime) -> None:
+        self.instant = start
+
+    def now(self) -> datetime:
+        return self.instant
+
+    def advance(self, seconds: float) -> datetime:
+        self.instant += timedelta(seconds=seconds)
+        return self.instant
+
+
+WALL_CLOCK = Clock()
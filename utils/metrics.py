@@ -0,0 +1,151 @@
+from bisect import bisect_left
+from typing import Callable, Optional
+
+# Default histogram buckets, in seconds, from 10us to 1s.
+DURATION_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    type_name: str
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._children: dict[tuple, any] = {}
+
+    def labels(self, **labels: str):
+        """
+        Returns the child of the metric with the given label values, which
+        should be looked up once and kept rather than looked up per sample.
+        """
+        key = tuple(sorted(labels.items()))
+        if key not in self._children:
+            self._children[key] = self._new_child()
+        return self._children[key]
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for key, child in list(self._children.items()):
+            lines += child.render(self.name, dict(key))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def render(self, name: str, labels: dict[str, str]) -> list[str]:
+        return [f"{name}{_format_labels(labels)} {self.value}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+    _new_child = _CounterChild
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: dict[str, str]) -> list[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            bucket_labels = _format_labels({**labels, "le": str(bound)})
+            lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {self.count}")
+        return lines
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, buckets: tuple = DURATION_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """
+        Evaluates `function` for the value whenever the gauge is rendered.
+        """
+        self.function = function
+
+    def render(self, name: str, labels: dict[str, str]) -> list[str]:
+        value = self.function() if self.function else self.value
+        return [f"{name}{_format_labels(labels)} {value}"]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+    _new_child = _GaugeChild
+
+
+class MetricsRegistry:
+    """
+    Metrics of this process, rendered in the Prometheus text exposition format.
+
+    Samples are plain attribute updates without locks, so that instrumenting
+    the hot path stays cheap. A scrape racing with a tick may see a sample
+    partially applied, which evens out by the next scrape.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.setdefault(metric.name, metric)
+        return self.metrics[metric.name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,536 @@
+from array import array
+from math import exp, fsum
+from typing import Mapping, Sequence
+
+import numpy as np
+
+
+def _copy_into(target: array, source: Sequence[float]) -> None:
+    # Checkpoints of other window sizes don't fit, rather than being truncated.
+    if len(source) != len(target):
+        raise ValueError(f"Expected {len(target)} values, got {len(source)}")
+    memoryview(target)[:] = source
+
+
+def _push_each(averages, values: Sequence[float]) -> np.ndarray:
+    # Pushes the samples one at a time, for averages that depend on the order
+    # of every push before.
+    rows = np.empty((len(values), len(averages.averages)))
+    for row, value in zip(rows, values):
+        averages.push(value)
+        row[:] = averages.averages
+    return rows
+
+
+class RollingAverages:
+    """
+    Moving averages of a single field over several window sizes.
+
+    All windows share one preallocated ring buffer sized to the largest window,
+    and each window keeps a running sum, so that `push` is O(number of windows)
+    and does not allocate.
+    """
+
+    __slots__ = ("labels", "sizes", "averages", "_samples", "_sums", "_head", "_count")
+
+    def __init__(self, windows: dict[str, int]) -> None:
+        self.labels = tuple(windows.keys())
+        self.sizes = tuple(max(1, int(size)) for size in windows.values())
+        self.averages = array("d", [0.0] * len(self.sizes))
+        self._samples = array("d", [0.0] * max(self.sizes, default=1))
+        self._sums = array("d", [0.0] * len(self.sizes))
+        self._head = 0
+        self._count = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self._samples)
+
+    def push(self, value: float) -> bool:
+        """
+        Appends a sample, evicting the oldest sample of every full window.
+        Returns whether any of the averages changed.
+        """
+        samples, sums, averages = self._samples, self._sums, self.averages
+        capacity, head, count = len(samples), self._head, self._count
+        value, changed = float(value), False
+        for i, size in enumerate(self.sizes):
+            if count >= size:
+                sums[i] += value - samples[head - size]
+                average = sums[i] / size
+            else:
+                sums[i] += value
+                average = sums[i] / (count + 1)
+            if average != averages[i]:
+                averages[i], changed = average, True
+        samples[head] = value
+        self._count = min(count + 1, capacity)
+        self._head = (head + 1) % capacity
+        if self._head == 0:
+            self._resync()
+        return changed
+
+    def push_many(self, values: Sequence[float]) -> np.ndarray:
+        """
+        Pushes every sample of `values` in turn, and returns the averages after
+        each of them (samples x windows). The windows are averaged from one
+        cumulative sum over the samples, rather than pushed one at a time.
+        """
+        values = np.asarray(values, dtype=float)
+        samples = np.frombuffer(self._samples)
+        capacity, head, count = len(samples), self._head, self._count
+        # The samples of the ring, oldest first, followed by the new ones.
+        series = np.concatenate((np.roll(samples, -head)[capacity - count :], values))
+        sums = np.concatenate(([0.0], np.cumsum(series)))
+        ends = np.arange(count + 1, len(series) + 1)
+        rows = np.empty((len(values), len(self.sizes)))
+        for i, size in enumerate(self.sizes):
+            starts = np.maximum(ends - size, 0)
+            rows[:, i] = (sums[ends] - sums[starts]) / (ends - starts)
+        if not len(values):
+            return rows
+        self._head = (head + len(values)) % capacity
+        self._count = min(count + len(values), capacity)
+        newest = series[len(series) - self._count :]
+        samples[(self._head - self._count + np.arange(self._count)) % capacity] = newest
+        for i, size in enumerate(self.sizes):
+            self._sums[i] = fsum(newest[len(newest) - min(size, self._count) :])
+        self.averages[:] = array("d", rows[-1])
+        return rows
+
+    def settled(self, value: float) -> bool:
+        """
+        Whether pushing `value` can never change the averages, as every window
+        is full of it.
+        """
+        samples = self._samples
+        return (
+            self._count == len(samples)
+            and all(average == value for average in self.averages)
+            and samples.count(value) == len(samples)
+        )
+
+    def advance(self, value: float, pushes: int) -> None:
+        """
+        Advances the averages as if `value` had been pushed `pushes` times, in
+        one step. Only valid once they've `settled` on `value`.
+        """
+        capacity = len(self._samples)
+        laps, self._head = divmod(self._head + pushes, capacity)
+        if laps:
+            # Where the ticks replayed one by one would have resynced.
+            self._resync()
+
+    def _resync(self) -> None:
+        # Running sums accumulate rounding errors over time. Once per lap of
+        # the ring (i.e. amortized O(1) per push) they're recomputed exactly.
+        samples, capacity = self._samples, len(self._samples)
+        for i, size in enumerate(self.sizes):
+            size = min(size, self._count)
+            self._sums[i] = fsum(samples[capacity - size :]) if size else 0.0
+
+    def save(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        """
+        Adds the state of the averages to a checkpoint, under `prefix`.
+        """
+        arrays[prefix + "samples"] = self._samples
+        arrays[prefix + "sums"] = self._sums
+        arrays[prefix + "averages"] = self.averages
+        meta[prefix + "position"] = (self._head, self._count)
+
+    def restore(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        """
+        Restores the state saved under `prefix`. Raises `KeyError` or
+        `ValueError` if it was saved with other windows.
+        """
+        _copy_into(self._samples, arrays[prefix + "samples"])
+        _copy_into(self._sums, arrays[prefix + "sums"])
+        _copy_into(self.averages, arrays[prefix + "averages"])
+        self._head, self._count = meta[prefix + "position"]
+
+    def as_dict(self) -> dict[str, float]:
+        return dict(zip(self.labels, self.averages))
+
+
+class BatchedRollingAverages:
+    """
+    The `RollingAverages` of many series with the same windows, kept as arrays
+    (windows x series) and pushed one sample of every series at once.
+
+    Rather than every sum being recomputed once per lap of the ring, each push
+    recomputes those of a slice of the series, so that a lap resyncs them all
+    without stalling the push that completes it.
+    """
+
+    def __init__(self, windows: dict[str, int], series: int) -> None:
+        self.labels = tuple(windows.keys())
+        self.sizes = tuple(max(1, int(size)) for size in windows.values())
+        self.averages = np.zeros((len(self.sizes), series))
+        self._samples = np.zeros((max(self.sizes, default=1), series))
+        self._sums = np.zeros((len(self.sizes), series))
+        self._head = 0
+        self._count = 0
+        # Series resynced per push, so that a lap of the ring covers them all.
+        self._resync_width = -(-series // len(self._samples))
+
+    def push(self, values: np.ndarray) -> np.ndarray:
+        """
+        Appends a sample of every series, evicting the oldest sample of every
+        full window, and returns the averages.
+        """
+        samples, sums, averages = self._samples, self._sums, self.averages
+        capacity, head, count = len(samples), self._head, self._count
+        for i, size in enumerate(self.sizes):
+            if count >= size:
+                sums[i] += values - samples[head - size]
+                np.divide(sums[i], size, out=averages[i])
+            else:
+                sums[i] += values
+                np.divide(sums[i], count + 1, out=averages[i])
+        samples[head] = values
+        self._count = min(count + 1, capacity)
+        self._head = (head + 1) % capacity
+        first = head * self._resync_width
+        self._resync(slice(first, first + self._resync_width))
+        return averages
+
+    def _resync(self, series: slice) -> None:
+        samples, head = self._samples, self._head
+        for i, size in enumerate(self.sizes):
+            size = min(size, self._count)
+            window = samples[max(head - size, 0) : head, series].sum(axis=0)
+            if size > head:
+                window += samples[head - size :, series].sum(axis=0)
+            self._sums[i, series] = window
+
+
+class _BucketTier:
+    """
+    Buckets of `width` samples each, as a ring of their sums and counts, and
+    the windows that are averaged over them.
+    """
+
+    __slots__ = (
+        "width",
+        "sums",
+        "counts",
+        "head",
+        "filled",
+        "partial_sum",
+        "partial_count",
+        "windows",
+        "window_sums",
+        "window_counts",
+    )
+
+    def __init__(self, width: int, windows: list[tuple[int, int]]) -> None:
+        self.width = width
+        # (index into the averages, number of buckets)
+        self.windows = windows
+        size = max(buckets for _, buckets in windows)
+        self.sums = array("d", [0.0] * size)
+        self.counts = array("d", [0.0] * size)
+        self.head = 0
+        self.filled = 0
+        self.partial_sum = 0.0
+        self.partial_count = 0
+        # Sums and counts of the newest `buckets - 1` complete buckets.
+        self.window_sums = array("d", [0.0] * len(windows))
+        self.window_counts = array("d", [0.0] * len(windows))
+
+    def close(self) -> None:
+        sums, counts, size = self.sums, self.counts, len(self.sums)
+        partial_sum, partial_count = self.partial_sum, self.partial_count
+        sums[self.head], counts[self.head] = partial_sum, partial_count
+        self.head = head = (self.head + 1) % size
+        self.filled = filled = min(self.filled + 1, size)
+        window_sums, window_counts = self.window_sums, self.window_counts
+        for i, (_, buckets) in enumerate(self.windows):
+            window_sums[i] += partial_sum
+            window_counts[i] += partial_count
+            if filled >= buckets:
+                evicted = head - buckets
+                window_sums[i] -= sums[evicted]
+                window_counts[i] -= counts[evicted]
+        self.partial_sum, self.partial_count = 0.0, 0
+        if head == 0:
+            self._resync()
+
+    def _resync(self) -> None:
+        # Recomputes the running sums once per lap of the ring, as in
+        # `RollingAverages._resync`.
+        size = len(self.sums)
+        for i, (_, buckets) in enumerate(self.windows):
+            newest = min(buckets - 1, self.filled)
+            self.window_sums[i] = fsum(self.sums[size - newest :]) if newest else 0.0
+            self.window_counts[i] = fsum(self.counts[size - newest :]) if newest else 0
+
+    def save(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        for name in ("sums", "counts", "window_sums", "window_counts"):
+            arrays[prefix + name] = getattr(self, name)
+        meta[prefix + "position"] = (
+            self.head,
+            self.filled,
+            self.partial_sum,
+            self.partial_count,
+        )
+
+    def restore(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        for name in ("sums", "counts", "window_sums", "window_counts"):
+            _copy_into(getattr(self, name), arrays[prefix + name])
+        position = meta[prefix + "position"]
+        self.head, self.filled, self.partial_sum, self.partial_count = position
+
+
+class BucketedAverages:
+    """
+    Moving averages of a single field over long windows, from samples rolled
+    up into buckets, so that memory is bounded by the number of buckets rather
+    than samples.
+
+    Each bucket size in `bucket_sizes` (in samples, e.g. 1 minute and 15
+    minutes worth) forms a tier, and every window is averaged over the finest
+    tier that covers it in at most `max_buckets` buckets. A window of N buckets
+    is the open bucket plus the newest complete ones, with the oldest of them
+    weighted by the part of it that's still inside the window.
+
+    Only that oldest bucket is approximated, as if its samples were evenly
+    spread over it. The error against the exact window is thus at most the
+    spread of the samples within that one bucket divided by N, e.g. 1/96 of it
+    for a 24 hour window of 15 minute buckets, and zero for a constant field or
+    whenever the window ends on a bucket boundary.
+    """
+
+    __slots__ = ("labels", "averages", "_tiers")
+
+    def __init__(
+        self,
+        windows: dict[str, int],
+        bucket_sizes: tuple[int, ...] = (60, 900),
+        max_buckets: int = 240,
+    ) -> None:
+        self.labels = tuple(windows.keys())
+        self.averages = array("d", [0.0] * len(windows))
+        tier_windows: dict[int, list[tuple[int, int]]] = {}
+        for index, size in enumerate(windows.values()):
+            width = next(
+                (width for width in bucket_sizes if size <= width * max_buckets),
+                bucket_sizes[-1],
+            )
+            buckets = max(1, round(size / width))
+            tier_windows.setdefault(width, []).append((index, buckets))
+        self._tiers = tuple(
+            _BucketTier(width, tier_windows[width])
+            for width in bucket_sizes
+            if width in tier_windows
+        )
+
+    def push(self, value: float) -> bool:
+        """
+        Adds a sample to the open bucket of every tier, closing the full ones.
+        Returns whether any of the averages changed.
+        """
+        value, averages, changed = float(value), self.averages, False
+        for tier in self._tiers:
+            tier.partial_sum += value
+            tier.partial_count += 1
+            if tier.partial_count == tier.width:
+                tier.close()
+            sums, counts, head, filled = tier.sums, tier.counts, tier.head, tier.filled
+            # Weight of the oldest bucket that's still inside the windows.
+            weight = 1 - tier.partial_count / tier.width
+            partial_sum, partial_count = tier.partial_sum, tier.partial_count
+            window_sums, window_counts = tier.window_sums, tier.window_counts
+            for i, (index, buckets) in enumerate(tier.windows):
+                total = partial_sum + window_sums[i]
+                count = partial_count + window_counts[i]
+                if filled >= buckets:
+                    total += weight * sums[head - buckets]
+                    count += weight * counts[head - buckets]
+                average = total / count if count else 0.0
+                if average != averages[index]:
+                    averages[index], changed = average, True
+        return changed
+
+    def push_many(self, values: Sequence[float]) -> np.ndarray:
+        """
+        Pushes every sample of `values` in turn, and returns the averages after
+        each of them (samples x windows).
+        """
+        return _push_each(self, values)
+
+    def settled(self, value: float) -> bool:
+        """
+        Whether pushing `value` can never change the averages, as every bucket
+        is full of it.
+        """
+        if any(average != value for average in self.averages):
+            return False
+        for tier in self._tiers:
+            full_sum = value * tier.width
+            if (
+                tier.filled < len(tier.sums)
+                or tier.partial_sum != value * tier.partial_count
+                or any(count != tier.width for count in tier.counts)
+                or any(total != full_sum for total in tier.sums)
+            ):
+                return False
+        return True
+
+    def advance(self, value: float, pushes: int) -> None:
+        """
+        Advances the averages as if `value` had been pushed `pushes` times, in
+        one step. Only valid once they've `settled` on `value`, where only the
+        phase of the buckets is left to advance.
+        """
+        for tier in self._tiers:
+            closed, tier.partial_count = divmod(tier.partial_count + pushes, tier.width)
+            tier.partial_sum = value * tier.partial_count
+            laps, tier.head = divmod(tier.head + closed, len(tier.sums))
+            if laps:
+                tier._resync()
+
+    def save(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        arrays[prefix + "averages"] = self.averages
+        for i, tier in enumerate(self._tiers):
+            tier.save(f"{prefix}{i}.", arrays, meta)
+
+    def restore(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        _copy_into(self.averages, arrays[prefix + "averages"])
+        for i, tier in enumerate(self._tiers):
+            tier.restore(f"{prefix}{i}.", arrays, meta)
+
+    def as_dict(self) -> dict[str, float]:
+        return dict(zip(self.labels, self.averages))
+
+
+class ExponentialAverages:
+    """
+    Exponentially weighted moving averages of a single field, for horizons too
+    long to keep even in buckets. Each takes O(1) memory.
+
+    A horizon of N samples is the time constant of the average: the newest N
+    samples weigh about 63% of it, and the average follows a step in the field
+    by 63% after N samples and by 95% after 3N. It isn't a window average, so
+    it lags a changing field more than the exact window of N samples would.
+    """
+
+    __slots__ = ("labels", "averages", "_alphas", "_started")
+
+    def __init__(self, horizons: dict[str, int]) -> None:
+        self.labels = tuple(horizons.keys())
+        self.averages = array("d", [0.0] * len(horizons))
+        self._alphas = tuple(1 - exp(-1 / max(1, size)) for size in horizons.values())
+        self._started = False
+
+    def push(self, value: float) -> bool:
+        value, averages = float(value), self.averages
+        if not self._started:
+            self._started = True
+            changed = any(average != value for average in averages)
+            for i in range(len(averages)):
+                averages[i] = value
+            return changed
+        changed = False
+        for i, alpha in enumerate(self._alphas):
+            average = averages[i] + alpha * (value - averages[i])
+            if average != averages[i]:
+                averages[i], changed = average, True
+        return changed
+
+    def push_many(self, values: Sequence[float]) -> np.ndarray:
+        """
+        Pushes every sample of `values` in turn, and returns the averages after
+        each of them (samples x horizons).
+        """
+        return _push_each(self, values)
+
+    def settled(self, value: float) -> bool:
+        """
+        Whether the averages reached a fixed point at `value`, where pushing
+        it changes them no more, which takes long after a step in the field.
+        """
+        return self._started and all(
+            average + alpha * (value - average) == average
+            for average, alpha in zip(self.averages, self._alphas)
+        )
+
+    def advance(self, value: float, pushes: int) -> None:
+        # Nothing to advance at a fixed point.
+        pass
+
+    def save(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        arrays[prefix + "averages"] = self.averages
+        meta[prefix + "started"] = self._started
+
+    def restore(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        _copy_into(self.averages, arrays[prefix + "averages"])
+        self._started = meta[prefix + "started"]
+
+    def as_dict(self) -> dict[str, float]:
+        return dict(zip(self.labels, self.averages))
+
+
+class MovingAverages:
+    """
+    Moving averages of a single field: exact windows of up to `exact_limit`
+    samples, `BucketedAverages` for longer ones, and `ExponentialAverages`.
+    """
+
+    __slots__ = ("_parts",)
+
+    def __init__(
+        self,
+        windows: dict[str, int],
+        ewma: dict[str, int] | None = None,
+        exact_limit: int = 3600,
+        bucket_sizes: tuple[int, ...] = (60, 900),
+    ) -> None:
+        exact = {label: size for label, size in windows.items() if size <= exact_limit}
+        bucketed = {
+            label: size for label, size in windows.items() if size > exact_limit
+        }
+        self._parts = []
+        if exact:
+            self._parts.append(RollingAverages(exact))
+        if bucketed:
+            self._parts.append(BucketedAverages(bucketed, bucket_sizes))
+        if ewma:
+            self._parts.append(ExponentialAverages(ewma))
+
+    def push(self, value: float) -> bool:
+        changed = False
+        for part in self._parts:
+            changed = part.push(value) or changed
+        return changed
+
+    def push_many(self, values: Sequence[float]) -> np.ndarray:
+        """
+        Pushes every sample of `values` in turn, and returns the averages after
+        each of them, in the order of `as_dict`.
+        """
+        return np.hstack(
+            [part.push_many(values) for part in self._parts]
+            or [np.empty((len(values), 0))]
+        )
+
+    def settled(self, value: float) -> bool:
+        return all(part.settled(value) for part in self._parts)
+
+    def advance(self, value: float, pushes: int) -> None:
+        for part in self._parts:
+            part.advance(value, pushes)
+
+    def save(self, prefix: str, arrays: dict[str, array], meta: dict[str, any]):
+        for i, part in enumerate(self._parts):
+            part.save(f"{prefix}{i}.", arrays, meta)
+
+    def restore(self, prefix: str, arrays: Mapping, meta: dict[str, any]):
+        for i, part in enumerate(self._parts):
+            part.restore(f"{prefix}{i}.", arrays, meta)
+
+    def as_dict(self) -> dict[str, float]:
+        averages = {}
+        for part in self._parts:
+            averages.update(part.as_dict())
+        return averages
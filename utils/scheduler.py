@@ -0,0 +1,131 @@
+import heapq
+import threading
+import traceback
+from itertools import count
+from time import monotonic
+from typing import Callable, Optional
+
+from utils.metrics import REGISTRY, Counter, Histogram
+
+TICK_LATENESS = REGISTRY.register(
+    Histogram(
+        "prosumer_tick_lateness_seconds",
+        "Delay between the deadline of a tick and when its job started.",
+        (1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 5),
+    )
+).labels()
+SKIPPED_TICKS = REGISTRY.register(
+    Counter(
+        "prosumer_skipped_ticks_total",
+        "Ticks skipped because a job overran its interval.",
+    )
+).labels()
+
+
+class ScheduledJob:
+    """
+    Handle of a periodic job registered with a `TickScheduler`.
+    """
+
+    __slots__ = ("function", "interval", "priority", "tick", "stopped")
+
+    def __init__(self, function: Callable, interval: float, priority: int) -> None:
+        self.function = function
+        self.interval = interval
+        self.priority = priority
+        self.tick = int(monotonic() // interval) + 1
+        self.stopped = False
+
+    @property
+    def deadline(self) -> float:
+        return self.tick * self.interval
+
+    def sleep(self, ticks: int):
+        """
+        Skips the next `ticks` ticks of the job. Called from within the job.
+        """
+        self.tick += ticks
+
+    def stop(self):
+        """
+        Stops the job. It's dropped the next time it becomes due.
+        """
+        self.stopped = True
+
+
+class TickScheduler:
+    """
+    Runs periodic jobs from a single timer thread.
+
+    Deadlines are whole multiples of a job's interval on the monotonic clock,
+    so jobs with the same interval tick together and never drift. Jobs that
+    are due at the same deadline run in ascending `priority`, and in the order
+    they were scheduled within the same priority.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple] = []
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(
+        self, function: Callable, interval: float, priority: int = 0
+    ) -> ScheduledJob:
+        """
+        Runs `function` every `interval` seconds, starting at the next multiple
+        of `interval`.
+        """
+        job = ScheduledJob(function, interval, priority)
+        with self._condition:
+            self._push(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return job
+
+    def _push(self, job: ScheduledJob):
+        entry = (job.deadline, job.priority, next(self._sequence), job)
+        heapq.heappush(self._heap, entry)
+
+    def _loop(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                delay = self._heap[0][0] - monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                job: ScheduledJob = heapq.heappop(self._heap)[-1]
+                if job.stopped:
+                    continue
+                TICK_LATENESS.observe(-delay)
+                self._condition.release()
+                try:
+                    job.function()
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc()
+                finally:
+                    self._condition.acquire()
+                # Ticks missed due to an overrun are skipped, not replayed.
+                next_tick = max(job.tick + 1, int(monotonic() // job.interval) + 1)
+                if next_tick > job.tick + 1:
+                    SKIPPED_TICKS.inc(next_tick - job.tick - 1)
+                job.tick = next_tick
+                self._push(job)
+
+
+_default_scheduler: Optional[TickScheduler] = None
+
+
+def get_default_scheduler() -> TickScheduler:
+    """
+    Returns the process wide scheduler, creating it on first use.
+    """
+    global _default_scheduler  # pylint: disable=global-statement
+    if _default_scheduler is None:
+        _default_scheduler = TickScheduler()
+    return _default_scheduler
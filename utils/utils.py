@@ -1,3 +1,8 @@
+# Profile and tariff sources read from measured traces on disk, rather than
+# generated.
+MEASURED_SOURCES = ("csv", "npy", "parquet")
+
+
 def acclimate_dict_for_kwargs(source: dict[str, any]) -> dict[str, any]:
     return {
         k.removeprefix("$"): (
@@ -1,7 +1,10 @@
 """
 ASGI config for virtual_prosumer project.
 
-It exposes the ASGI callable as a module-level variable named ``application``.
+It exposes the ASGI callable as a module-level variable named ``application``,
+and starts the prosumer, as ASGI servers don't run the autoreloader that
+starts it under runserver. WebSocket connections to ``/api/stream`` stream
+the states of the prosumer, and everything else is handled by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
@@ -9,8 +12,21 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
+from django.apps import apps
 from django.core.asgi import get_asgi_application
 
+from prosumer.api import stream
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "virtual_prosumer.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+apps.get_app_config("prosumer").start_runtime()
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "websocket":
+        return await django_application(scope, receive, send)
+    if scope["path"] == "/api/stream":
+        return await stream(scope, receive, send)
+    await receive()
+    await send({"type": "websocket.close"})
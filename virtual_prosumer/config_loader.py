@@ -1,16 +1,42 @@
+import hashlib
 import os
+import pickle
 import re
+from pathlib import Path
+from typing import Iterable, Optional
 
 import yaml
-from yaml.loader import SafeLoader
+from utils.utils import MEASURED_SOURCES
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
 
 path_matcher = re.compile(r"\$\{([^}^{]+)\}")
 
+# Compiled configs are cached here, by the hash of their file and of the
+# environment variables they reference.
+CONFIG_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "prosumer"
+    / "configs"
+)
+
+# Bumped whenever the compiled form of a config changes, to drop old caches.
+_CACHE_VERSION = 1
+
 
 class UnconfiguredEnvironmentError(KeyError):
     pass
 
 
+class ConfigError(ValueError):
+    """
+    Raised with every problem found in a prosumer config, one per line.
+    """
+
+
 def path_constructor(_loader, node):
     """Extract the matched value, expand env variable, and replace the match"""
     value = node.value
@@ -22,10 +48,243 @@ def path_constructor(_loader, node):
         raise UnconfiguredEnvironmentError(env_var) from env_no_exist
 
 
-yaml.add_implicit_resolver("!path", path_matcher, None, SafeLoader)
-yaml.add_constructor("!path", path_constructor, SafeLoader)
+class ConfigLoader(_SafeLoader):
+    """
+    Safe loader of prosumer configs, parsing with libyaml when available.
+    """
+
+
+# Only plain scalars starting with `$` are matched against the pattern.
+yaml.add_implicit_resolver("!path", path_matcher, ["$"], ConfigLoader)
+yaml.add_constructor("!path", path_constructor, ConfigLoader)
+
+_NUMBER = (int, float)
+# A flat price, or a tariff compiled by `compile_tariff`.
+_PRICE = (int, float, dict)
+_ID = (int, str)
+
+# Types of the keys of each section, and which of them are required. Other
+# keys are allowed, as subsystems keep any extra key as an attribute.
+_SCHEMA = {
+    "location": (str, True),
+    "settings": (dict, True),
+    "moving_avg_periods": (list, False),
+    "generations": (list, False),
+    "consumptions": (list, False),
+    "storages": (list, False),
+    "ewma_periods": (list, False),
+    "moving_avg_exact_limit": (_NUMBER, False),
+    "idle_skipping": (bool, False),
+    "subsystem_reporting": (list, False),
+    "storage_dispatch": (dict, False),
+    "publishing": (dict, False),
+    "mqtt_transport": (dict, False),
+    "recording": (dict, False),
+    "checkpoint": (dict, False),
+    # Left empty, as a bare `api:`, to serve it with the defaults.
+    "api": ((dict, type(None)), False),
+    "profile_lookup_tables": (str, False),
+}
+_SETTINGS_SCHEMA = {
+    "server": (str, True),
+    "mqttPort": ((int, str), True),
+    "vpAddress": (str, True),
+}
+_SUBSYSTEM_SCHEMAS = {
+    "generations": {
+        "id": (_ID, True),
+        "installed_capacity": (_NUMBER, True),
+        "export_price": (_PRICE, True),
+        "asset_value": (_NUMBER, False),
+        "$profile": (dict, True),
+    },
+    "consumptions": {
+        "id": (_ID, True),
+        "peak_demand": (_NUMBER, True),
+        "asset_value": (_NUMBER, False),
+        "$profile": (dict, True),
+    },
+    "storages": {
+        "id": (_ID, True),
+        "max_capacity": (_NUMBER, True),
+        "usable_capacity": (_NUMBER, True),
+        "max_charge_rate": (_NUMBER, True),
+        "max_discharge_rate": (_NUMBER, False),
+        "charge_efficiency": (_NUMBER, False),
+        "discharge_efficiency": (_NUMBER, False),
+        "initial_state_of_charge": (_NUMBER, False),
+        "export_price": (_PRICE, True),
+        "asset_value": (_NUMBER, False),
+    },
+}
+_REPORTED_SUBSYSTEMS = ("generation", "consumption", "storage")
+
+
+def _type_names(types: type | tuple) -> str:
+    types = types if isinstance(types, tuple) else (types,)
+    return " or ".join(t.__name__ for t in types)
+
+
+def _check_keys(
+    section: dict, schema: dict[str, tuple], where: str, errors: list[str]
+) -> None:
+    for key, (types, required) in schema.items():
+        if key not in section:
+            if required:
+                errors.append(f"{where}{key}: required")
+            continue
+        value = section[key]
+        # bool is an int, but never a valid number here.
+        if not isinstance(value, types) or (
+            isinstance(value, bool) and types is not bool
+        ):
+            errors.append(
+                f"{where}{key}: expected {_type_names(types)},"
+                f" got {type(value).__name__}"
+            )
+
+
+def _check_trace(section: dict, where: str, errors: list[str]) -> None:
+    # Columns of npy files are unnamed, so only their index is allowed.
+    column = (int,) if section["source"] == "npy" else _ID
+    schema = {"path": (str, True), "column": (column, False)}
+    _check_keys(section, schema, where, errors)
+
+
+def _check_profile(profile: dict, where: str, errors: list[str]) -> None:
+    source = profile.get("source")
+    if source == "range_30m":
+        for bound in ("r0", "r1"):
+            values = profile.get(bound)
+            if not isinstance(values, list) or len(values) != 48:
+                errors.append(f"{where}{bound}: expected a list of 48 numbers")
+            elif not all(isinstance(value, _NUMBER) for value in values):
+                errors.append(f"{where}{bound}: expected numbers only")
+    elif source in MEASURED_SOURCES:
+        _check_trace(profile, where, errors)
+    else:
+        errors.append(f"{where}source: unsupported profile source {source!r}")
+
+
+def _check_tariff(tariff: dict, where: str, errors: list[str]) -> None:
+    source = tariff.get("source")
+    if source == "time_of_use":
+        prices = tariff.get("prices")
+        if not isinstance(prices, list) or not prices:
+            errors.append(f"{where}prices: expected a list of numbers")
+        elif not all(isinstance(price, _NUMBER) for price in prices):
+            errors.append(f"{where}prices: expected numbers only")
+    elif source in MEASURED_SOURCES:
+        _check_trace(tariff, where, errors)
+    else:
+        errors.append(f"{where}source: unsupported tariff source {source!r}")
+    interval = tariff.get("interval", 1)
+    if not isinstance(interval, int) or interval <= 0:
+        errors.append(f"{where}interval: expected positive whole seconds")
+
+
+def validate_config(config: any, name: str = "config") -> dict[str, any]:
+    """
+    Checks a prosumer config against the schema all at once, rather than as
+    each subsystem reads it. Raises a `ConfigError` listing every problem.
+    """
+    if not isinstance(config, dict):
+        raise ConfigError(f"{name}: expected a mapping")
+    errors = []
+    _check_keys(config, _SCHEMA, "", errors)
+    if isinstance(config.get("settings"), dict):
+        _check_keys(config["settings"], _SETTINGS_SCHEMA, "settings.", errors)
+    for key in ("moving_avg_periods", "ewma_periods"):
+        periods = config.get(key)
+        if isinstance(periods, list) and not all(
+            isinstance(period, int) and period > 0 for period in periods
+        ):
+            errors.append(f"{key}: expected positive whole minutes")
+    reporting = config.get("subsystem_reporting")
+    if isinstance(reporting, list):
+        for kind in set(reporting) - set(_REPORTED_SUBSYSTEMS):
+            errors.append(f"subsystem_reporting: unknown subsystem {kind!r}")
+    for kind, schema in _SUBSYSTEM_SCHEMAS.items():
+        subsystems = config.get(kind)
+        if not isinstance(subsystems, list):
+            continue
+        ids = set()
+        for i, subsystem in enumerate(subsystems):
+            where = f"{kind}[{i}]."
+            if not isinstance(subsystem, dict):
+                errors.append(f"{kind}[{i}]: expected a mapping")
+                continue
+            _check_keys(subsystem, schema, where, errors)
+            if subsystem.get("id") in ids:
+                errors.append(f"{where}id: duplicate id {subsystem['id']}")
+            ids.add(subsystem.get("id"))
+            if isinstance(subsystem.get("$profile"), dict):
+                _check_profile(subsystem["$profile"], f"{where}$profile.", errors)
+            if isinstance(subsystem.get("export_price"), dict):
+                _check_tariff(
+                    subsystem["export_price"], f"{where}export_price.", errors
+                )
+    if errors:
+        raise ConfigError("\n".join(f"{name}: {error}" for error in errors))
+    return config
+
+
+def _cache_key(source: bytes) -> str:
+    # Env vars are expanded while loading, so their values are part of the key.
+    digest = hashlib.sha256(f"{_CACHE_VERSION}:".encode())
+    digest.update(source)
+    for env_var in sorted(set(re.findall(rb"\$\{([^}^{]+)\}", source))):
+        value = os.environ.get(env_var.decode())
+        digest.update(b"\0" + env_var + b"=" + (value or "\0").encode())
+    return digest.hexdigest()
+
+
+def load_config(
+    path: str | Path = "prosumer.yaml",
+    cache_dir: Optional[str | Path] = CONFIG_CACHE_DIR,
+) -> dict[str, any]:
+    """
+    Loads and validates a prosumer config. The validated config is cached in
+    `cache_dir`, unless None, and unpickled from there by later loads of the
+    same file with the same environment, skipping the YAML parser.
+    """
+    with open(path, "rb") as file:
+        source = file.read()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = Path(cache_dir) / f"{_cache_key(source)}.pickle"
+        try:
+            with open(cache_path, "rb") as file:
+                return pickle.load(file)
+        except FileNotFoundError:
+            pass
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            print(f"Ignoring corrupt config cache {cache_path}")
+    config = validate_config(yaml.load(source, Loader=ConfigLoader), str(path))
+    if cache_path is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as file:
+                pickle.dump(config, file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as error:
+            print(f"Couldn't cache config {path}: {error}")
+    return config
 
 
-def load_config() -> dict[str, any]:
-    with open("prosumer.yaml", "r", encoding="utf-8") as file:
-        return yaml.safe_load(file)
+def load_configs(
+    paths: Iterable[str | Path],
+    cache_dir: Optional[str | Path] = CONFIG_CACHE_DIR,
+) -> list[dict[str, any]]:
+    """
+    Loads prosumer configs from the given files, and from every `.yaml` or
+    `.yml` file in the given directories.
+    """
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files += sorted(p for p in path.iterdir() if p.suffix in (".yaml", ".yml"))
+        else:
+            files.append(path)
+    return [load_config(file, cache_dir) for file in files]
@@ -16,6 +16,16 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from prosumer import views
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", views.metrics, name="metrics"),
+    path("api/state", views.state, name="state"),
+    path(
+        "api/state/<str:entity>/<str:id_>",
+        views.subsystem_state,
+        name="subsystem-state",
+    ),
+    path("api/history", views.history, name="history"),
 ]